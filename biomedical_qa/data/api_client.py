@@ -0,0 +1,123 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ApiClient(object):
+    """Concurrent client for JSON APIs such as Olelo and cTAKES.
+
+    Requests are sent from a pool of threads that share a keep-alive connection pool,
+    so at most max_in_flight requests are in flight at any time. Identical requests
+    that are in flight at the same time are sent only once. Failed requests (connection
+    errors, 429 & 5xx responses) are retried with exponential backoff.
+    """
+
+
+    def __init__(self, url, max_in_flight=8, max_retries=4, backoff=0.5, timeout=60):
+        """
+        :param url: URL that is queried with GET requests.
+        :param max_in_flight: Maximum number of concurrent requests.
+        :param max_retries: Number of retries before a request fails.
+        :param backoff: Seconds to wait before the first retry, doubled for every further retry.
+        :param timeout: Timeout of a single request in seconds.
+        """
+
+        self.url = url
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight, pool_block=True)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_in_flight)
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.num_requests = 0
+        self.num_retries = 0
+        self.num_coalesced = 0
+
+
+    def submit(self, params):
+        """
+        Sends a request in the background.
+        :param params: Dict of query parameters.
+        :return: concurrent.futures.Future of the decoded JSON response.
+        """
+
+        key = json.dumps(params, sort_keys=True)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.num_coalesced += 1
+                return future
+            future = self._executor.submit(self._request, params)
+            self._in_flight[key] = future
+
+        future.add_done_callback(lambda f: self._forget(key, f))
+        return future
+
+
+    def get_json(self, params):
+        """Sends a request and returns the decoded JSON response."""
+
+        return self.submit(params).result()
+
+
+    def _forget(self, key, future):
+
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+
+    def _request(self, params):
+
+        for attempt in range(self.max_retries + 1):
+
+            if attempt > 0:
+                with self._lock:
+                    self.num_retries += 1
+                # Exponential backoff with jitter, so that concurrent retries spread out
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(1.0, 1.5))
+
+            with self._lock:
+                self.num_requests += 1
+
+            try:
+                response = self._session.get(self.url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                print("Request failed: %s. Retrying..." % e)
+                continue
+
+            if response.ok:
+                return json.loads(response.text)
+
+            retryable = response.status_code == 429 or response.status_code >= 500
+            if not retryable or attempt == self.max_retries:
+                print("Params:", str(params))
+                response.raise_for_status()
+            print("Got status code %d: %s" % (response.status_code, response.text))
+            print("Retrying...")
+
+
+    def get_stats_string(self):
+
+        return "API client: %d requests, %d retries, %d coalesced" % (
+            self.num_requests, self.num_retries, self.num_coalesced)
+
+
+    def close(self):
+
+        self._executor.shutdown(wait=True)
+        self._session.close()
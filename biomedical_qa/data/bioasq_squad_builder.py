@@ -1,8 +1,7 @@
 import logging
 import re
 
-from nltk import RegexpTokenizer
-
+from biomedical_qa.data.tokenizer import Tokenizer
 
 
 def ensure_list_depth_2(l):
@@ -54,7 +53,7 @@ class BioAsqSquadBuilder(object):
         if self._types is None:
             self._types = ["factoid", "list"]
 
-        self._tokenizer = RegexpTokenizer(r'\w+|[^\w\s]')
+        self._tokenizer = Tokenizer()
         self._context_token_limit = context_token_limit
         self._include_synonyms = include_synonyms
         self._include_answer_spans = include_answer_spans
@@ -179,7 +178,7 @@ class BioAsqSquadBuilder(object):
             snippets_set.add(snippet)
 
             # Keep token limit
-            snippet_length = len(self._tokenizer.tokenize(snippet))
+            snippet_length = len(self._tokenizer.span_tokenize(snippet))
             if self._context_token_limit > 0 and \
                         num_tokens + snippet_length > self._context_token_limit:
                 self._stats["contexts_truncated"] += 1
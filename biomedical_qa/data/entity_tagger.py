@@ -1,9 +1,16 @@
 import abc
-import json
-import requests
+import bisect
+import gc
+import hashlib
+import multiprocessing
+import os
 
 import tensorflow as tf
 
+from biomedical_qa.data.api_client import ApiClient
+from biomedical_qa.data.lexicon import Lexicon, is_lexicon
+from biomedical_qa.data.tagger_cache import DEFAULT_MEMORY_CACHE_SIZE, TagStore, get_namespace
+from biomedical_qa.data.tokenizer import Tokenizer
 from biomedical_qa.data.umls import build_term2types, build_concept2types
 
 
@@ -12,8 +19,12 @@ tf.app.flags.DEFINE_string("entity_tagger", None, "[dictionary, olelo, ctakes],
 tf.app.flags.DEFINE_string("olelo_url", "https://ares.epic.hpi.uni-potsdam.de/CJosfa64Kz46H7M6/rest/api1/analyze", "Olelo URL.")
 tf.app.flags.DEFINE_string("ctakes_url", "http://localhost:9876/ctakes", "CTakes URL.")
 tf.app.flags.DEFINE_string("entity_blacklist_file", None, "Blacklist file.")
-tf.app.flags.DEFINE_string("terms_file", None, "UML Terms file (MRCONSO.RRF).")
+tf.app.flags.DEFINE_string("terms_file", None, "UML Terms file (MRCONSO.RRF) or a lexicon compiled by compile_umls_lexicon.")
 tf.app.flags.DEFINE_string("types_file", None, "UMLS Types file (MRSTY.RRF).")
+tf.app.flags.DEFINE_string("tagger_cache_dir", None, "Directory to cache tagging results in, or None.")
+tf.app.flags.DEFINE_integer("tagger_memory_cache_size", DEFAULT_MEMORY_CACHE_SIZE, "Number of tagging results cached in memory.")
+tf.app.flags.DEFINE_integer("tagger_max_requests", 8, "Maximum number of concurrent requests of the Olelo / cTAKES taggers.")
+tf.app.flags.DEFINE_integer("tagger_num_workers", 0, "If > 0, the dictionary tagger tags batches in this many forked processes that share its dictionary.")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -21,6 +32,9 @@ FLAGS = tf.app.flags.FLAGS
 # Maximum entity length in tokens
 MAX_ENTITY_LENGTH = 10
 
+# Maximum number of texts per task of a tagger pool worker
+POOL_CHUNK_SIZE = 64
+
 
 class EntityTagger(object):
 
@@ -35,43 +49,198 @@ class EntityTagger(object):
         self.num_types = len(self.types_set)
         self.type2id = {type: i for i, type in enumerate(sorted(self.types_set))}
         self.id2type = {id: type for type, id in self.type2id.items()}
+        self._mask_type_ids = {}
+
+
+    def types_to_mask(self, types):
+        """Returns the bitmask of a set of type strings: bit i is set iff type i is in types."""
+
+        mask = 0
+        for type in types:
+            mask |= 1 << self.type2id[type]
+        return mask
+
+
+    def mask_to_type_ids(self, mask):
+        """Inverse of types_to_mask() that returns the set of type ids."""
+
+        type_ids = self._mask_type_ids.get(mask)
+        if type_ids is None:
+            type_ids = frozenset(i for i in range(mask.bit_length()) if mask >> i & 1)
+            self._mask_type_ids[mask] = type_ids
+        return type_ids
 
 
     @abc.abstractmethod
-    def tag(self, text, tokenizer):
+    def tag_masks(self, text, tokenizer):
         """
         Tags a given text.
         :param text: String.
-        :param tokenizer: tokenizer.tokenize(text) should return the tokens.
+        :param tokenizer: tokenizer.span_tokenize(text) should return the (start, end)
+                offsets of the tokens, e.g. biomedical_qa.data.tokenizer.Tokenizer.
+        :return: (masks, found_entities) where
+            - masks is a list<int> with one type bitmask per token, see types_to_mask()
+            - found_entities is a set<string> of all the entities found
+        """
+        raise NotImplementedError()
+
+
+    def tag(self, text, tokenizer):
+        """
+        Tags a given text, like tag_masks().
         :return: (tags, tag_ids, found_entities) where
             - tags is a list<set<type_string>> with one entry per token
             - tag_ids is a list<set<type_id>> with one entry per token
             - found_entities is a set<string> of all the entities found
         """
-        raise NotImplementedError()
+
+        return self._masks_to_sets(self.tag_masks(text, tokenizer))
+
+
+    def tag_many_masks(self, texts, tokenizer):
+        """
+        Tags several texts. Implementations may batch, deduplicate or parallelize the work.
+        :param texts: Iterable of strings.
+        :param tokenizer: See tag_masks().
+        :return: List of tag_masks() results, in the order of texts.
+        """
+
+        texts = list(texts)
+        self.prefetch(texts, tokenizer)
+        return [self.tag_masks(text, tokenizer) for text in texts]
+
+
+    def tag_many(self, texts, tokenizer):
+        """Like tag_many_masks(), but returns tag() results."""
+
+        return [self._masks_to_sets(result) for result in self.tag_many_masks(texts, tokenizer)]
+
+
+    def _masks_to_sets(self, masks_result):
+
+        masks, found_entities = masks_result
+        tag_ids = [set(self.mask_to_type_ids(mask)) for mask in masks]
+        tags = [set(self.id2type[id] for id in ids) for ids in tag_ids]
+        return tags, tag_ids, found_entities
+
+
+    def get_config(self):
+        """Returns a JSON serializable dict of all settings that influence the tags."""
+
+        return {"type": type(self).__name__}
+
+
+    def after_fork(self):
+        """Called in forked worker processes before the first tag() call."""
+
+        pass
+
+
+    def close(self):
+        """Releases worker processes and connections. Tagging afterwards happens in process."""
+
+        pass
+
+
+    def load(self):
+        """Loads what is otherwise loaded on first use, e.g. before forking workers that should share it."""
+
+        pass
+
+
+    def prefetch(self, texts, tokenizer):
+        """
+        Hints that texts are going to be tagged, so that taggers can start working on
+        them in the background. Each prefetched text should be passed to tag() once.
+        """
+
+        pass
 
 
     def _get_token_offsets(self, text, tokenizer):
-        offsets = []
-        offset = 0
-        for token in tokenizer.tokenize(text):
-            offset = text.index(token, offset)
-            offsets.append((offset, offset + len(token)))
-            offset += len(token)
-        return offsets
+        return list(tokenizer.span_tokenize(text))
 
 
 class DictionaryEntityTagger(EntityTagger):
 
 
     def __init__(self, terms_file, types_file, case_sensitive=False, blacklist_file=None):
+        """
+        :param terms_file: UMLS terms file (MRCONSO.RRF), or a lexicon directory written
+                by biomedical_qa.data.lexicon.compile_lexicon(). A lexicon is memory
+                mapped instead of parsed, types_file is ignored in that case.
+        """
 
+        self.terms_file = terms_file
+        self.types_file = types_file
+        self.blacklist_file = blacklist_file
         self.case_sensitive = case_sensitive
-        self.term2types, self.types_set = build_term2types(terms_file, types_file, case_sensitive)
         self.blacklist = self._read_blacklist_file(blacklist_file) \
                             if blacklist_file is not None else set()
 
-        self.initialize_properties(self.types_set)
+        if is_lexicon(terms_file):
+            self.lexicon = Lexicon(terms_file, case_sensitive)
+            self.types_set = set(self.lexicon.types)
+            self.initialize_properties(self.types_set)
+            self._trie = None
+        else:
+            self.lexicon = None
+            term2types, self.types_set = build_term2types(terms_file, types_file, case_sensitive)
+            self.initialize_properties(self.types_set)
+            # The trie holds all that tag() needs, the dictionary is not kept
+            self._trie = self._build_trie(term2types)
+
+
+    def _build_trie(self, term2types):
+        """
+        Builds a token level trie of all terms that can be found by tag().
+        :param term2types: {term -> types}, see build_term2types().
+        Edges are labeled with a term's first token, then with the separating
+        whitespace plus the next token, so that a path spells the term exactly.
+        :return: Nested dicts, the None key of a node holds (term, type mask)
+                if a term ends at that node.
+        """
+
+        print("Building term trie...")
+
+        tokenizer = Tokenizer()
+        mask_cache = {}
+        root = {}
+        for term, types in term2types.items():
+
+            if term.lower() in self.blacklist:
+                continue
+
+            keys = self._get_trie_keys(term, tokenizer.span_tokenize(term))
+            # Terms that are not token aligned or too long can never be found
+            if keys is None or len(keys) >= MAX_ENTITY_LENGTH:
+                continue
+
+            types_key = frozenset(types)
+            if types_key not in mask_cache:
+                mask_cache[types_key] = self.types_to_mask(types_key)
+
+            node = root
+            for key in keys:
+                node = node.setdefault(key, {})
+            node[None] = (term, mask_cache[types_key])
+
+        return root
+
+
+    @staticmethod
+    def _get_trie_keys(text, token_offsets):
+        # Returns [token_0, gap_1 + token_1, ...], or None if text is not exactly covered by its tokens
+
+        if not token_offsets or token_offsets[0][0] != 0 or token_offsets[-1][1] != len(text):
+            return None
+
+        keys = []
+        previous_end = 0
+        for start, end in token_offsets:
+            keys.append(text[previous_end:end])
+            previous_end = end
+        return keys
 
 
     def _read_blacklist_file(self, blacklist_file):
@@ -84,137 +253,298 @@ class DictionaryEntityTagger(EntityTagger):
         return set([l.strip() for l in lines])
 
 
-    def tag(self, text, tokenizer):
+    @classmethod
+    def make_config(cls, terms_file, types_file, blacklist_file, case_sensitive):
+        """Returns the get_config() of a tagger with these settings without creating it."""
+
+        return {
+            "type": cls.__name__,
+            "terms_file": terms_file,
+            "types_file": types_file,
+            "blacklist_file": blacklist_file,
+            "case_sensitive": case_sensitive,
+        }
+
+
+    def get_config(self):
+
+        return self.make_config(self.terms_file, self.types_file,
+                                self.blacklist_file, self.case_sensitive)
+
+
+    def tag_many_masks(self, texts, tokenizer):
+        """Normalizes & tags each distinct text only once, e.g. snippets shared by questions."""
+
+        texts = list(texts)
+        results = {}
+        for text in texts:
+            if text not in results:
+                results[text] = self.tag_masks(text, tokenizer)
+
+        # Copy the results of repeated texts, so that callers may modify them
+        seen = set()
+        tag_results = []
+        for text in texts:
+            masks, found_entities = results[text]
+            if text in seen:
+                masks = list(masks)
+                found_entities = set(found_entities)
+            seen.add(text)
+            tag_results.append((masks, found_entities))
+        return tag_results
+
+
+    def tag_masks(self, text, tokenizer):
+        """
+        Tags all terms that consist of up to MAX_ENTITY_LENGTH - 1 tokens. For each
+        token, the term trie is walked as long as the following tokens continue a term.
+        The tokenizer must produce the same tokens as biomedical_qa.data.tokenizer.Tokenizer.
+        """
         if not self.case_sensitive:
             text = text.lower()
         token_offsets = self._get_token_offsets(text, tokenizer)
-        tags = [set() for _ in token_offsets]
-        tag_ids = [set() for _ in token_offsets]
+        if self.lexicon is not None:
+            return self._tag_with_lexicon(text, token_offsets)
+
+        masks = [0] * len(token_offsets)
         found_entities = set()
 
-        for entity_length in range(1, MAX_ENTITY_LENGTH):
-            for i in range(len(token_offsets)):
+        # First token of a term / following token including the preceding whitespace
+        first_keys = [text[start:end] for start, end in token_offsets]
+        next_keys = [text[previous_end:end] for (_, previous_end), (_, end)
+                     in zip([(0, 0)] + token_offsets, token_offsets)]
+
+        for i in range(len(token_offsets)):
+
+            node = self._trie.get(first_keys[i])
+            j = i
+            while node is not None:
+
+                entry = node.get(None)
+                if entry is not None:
+                    term, mask = entry
+                    found_entities.add(term)
+                    for token_index in range(i, j + 1):
+                        masks[token_index] |= mask
+
+                j += 1
+                if j == len(token_offsets):
+                    break
+                node = node.get(next_keys[j])
+
+        return masks, found_entities
 
-                if i + entity_length > len(token_offsets):
-                    continue
 
-                start_offset, _ = token_offsets[i]
-                _, end_offset = token_offsets[i + entity_length - 1]
+    def _tag_with_lexicon(self, text, token_offsets):
+        # Like the trie walk, but extends candidates while some lexicon term starts with them
+
+        masks = [0] * len(token_offsets)
+        found_entities = set()
+
+        for i in range(len(token_offsets)):
+
+            start_offset, _ = token_offsets[i]
+            for j in range(i, min(i + MAX_ENTITY_LENGTH - 1, len(token_offsets))):
+
+                _, end_offset = token_offsets[j]
                 candidate_string = text[start_offset:end_offset]
+                index, has_prefix = self.lexicon.prefix_search(candidate_string)
+                if not has_prefix:
+                    break
 
-                if candidate_string.lower() in self.blacklist:
+                if index < 0 or candidate_string.lower() in self.blacklist:
+                    continue
+                mask = self.lexicon.get_type_mask(index)
+                if mask == 0:
                     continue
 
-                if candidate_string in self.term2types:
-                    found_entities.add(candidate_string)
-                    for token_index in range(i, i + entity_length):
-                        types = self.term2types[candidate_string]
-                        type_ids = set([self.type2id[type] for type in types])
-                        tags[token_index].update(types)
-                        tag_ids[token_index].update(type_ids)
+                found_entities.add(candidate_string)
+                for token_index in range(i, j + 1):
+                    masks[token_index] |= mask
 
-        return tags, tag_ids, found_entities
+        return masks, found_entities
 
 
 class ApiEntityTagger(EntityTagger):
 
 
-    def __init__(self, types_file, url):
+    def __init__(self, types_file, url, max_in_flight=8):
+        """
+        :param types_file: UMLS types file (MRSTY.RRF).
+        :param url: URL of the tagging service.
+        :param max_in_flight: Maximum number of concurrent requests.
+        """
 
         self.url = url
+        self.types_file = types_file
+        self.max_in_flight = max_in_flight
         self.cui2types, self.types_set = build_concept2types(types_file)
         self.initialize_properties(self.types_set)
-        self.session = None
+        self.cui2mask = {cui: self.types_to_mask(types) for cui, types in self.cui2types.items()}
+        self.client = None
+        # text -> [response future, number of pending tag() calls]
+        self._prefetched = {}
 
 
-    def tag(self, text, tokenizer):
+    def after_fork(self):
+
+        # The parent's request threads & HTTP connections are not usable in the child
+        self.client = None
+        self._prefetched = {}
+
+
+    def close(self):
+
+        if self.client is not None:
+            self.client.close()
+        self.client = None
+        self._prefetched = {}
+
+
+    def prefetch(self, texts, tokenizer):
+        """Sends the requests for texts concurrently, tag() then uses their responses."""
+
+        client = self._get_client()
+        for text in texts:
+            entry = self._prefetched.get(text)
+            if entry is None:
+                self._prefetched[text] = [client.submit(self._get_params(text)), 1]
+            else:
+                entry[1] += 1
+
+
+    def tag_masks(self, text, tokenizer):
         offsets = self._get_token_offsets(text, tokenizer)
+        token_index = self._index_token_offsets(offsets)
 
-        tags = [set() for _ in offsets]
-        tag_ids = [set() for _ in offsets]
+        masks = [0] * len(offsets)
         found_entities = set()
 
-        for token_range, entity_string in self._query_api(text, offsets):
+        for token_range, entity_string in self._query_api(text, token_index):
 
-            if entity_string not in self.cui2types:
+            mask = self.cui2mask.get(entity_string)
+            if mask is None:
                 # Unknown entity type
                 continue
 
             start_index, end_index = token_range
-            types = self.cui2types[entity_string]
-            type_ids = set([self.type2id[type] for type in types])
-
             for token_index in range(start_index, end_index + 1):
-                tags[token_index].update(types)
-                tag_ids[token_index].update(type_ids)
+                masks[token_index] |= mask
 
             char_start = offsets[start_index][0]
             char_end = offsets[end_index][1]
             found_entities.add(text[char_start:char_end])
 
-        return tags, tag_ids, found_entities
+        return masks, found_entities
+
 
+    @classmethod
+    def make_config(cls, types_file, url):
+        """Returns the get_config() of a tagger with these settings without creating it."""
 
-    def _find_token_range(self, offsets, entity_start, entity_end):
+        return {
+            "type": cls.__name__,
+            "url": url,
+            "types_file": types_file,
+        }
 
-        for start_index in range(len(offsets)):
 
-            start, _ = offsets[start_index]
+    def get_config(self):
 
-            if start == entity_start:
-                for end_index in range(start_index, len(offsets)):
+        return self.make_config(self.types_file, self.url)
 
-                    _, end = offsets[end_index]
-                    if end == entity_end:
-                        return (start_index, end_index)
+
+    @staticmethod
+    def _index_token_offsets(offsets):
+        """
+        Indexes the tokens of a text by char offsets, so that _find_token_range() does not scan them.
+        :param offsets: List of (start, end) char offsets of the tokens.
+        :return: ({start -> [token indices]}, {end -> [token indices]}) with ascending indices.
+        """
+
+        start2indices = {}
+        end2indices = {}
+        for index, (start, end) in enumerate(offsets):
+            start2indices.setdefault(start, []).append(index)
+            end2indices.setdefault(end, []).append(index)
+        return start2indices, end2indices
+
+
+    @staticmethod
+    def _find_token_range(token_index, entity_start, entity_end):
+        """
+        Finds the tokens that span exactly the chars [entity_start, entity_end).
+        :param token_index: Result of _index_token_offsets().
+        :return: (start_index, end_index) of the first such tokens, or None if the
+                entity is not aligned with tokens.
+        """
+
+        start2indices, end2indices = token_index
+        end_indices = end2indices.get(entity_end)
+        if end_indices is None:
+            return None
+
+        for start_index in start2indices.get(entity_start, ()):
+            # First token ending at entity_end that does not precede the start token
+            i = bisect.bisect_left(end_indices, start_index)
+            if i < len(end_indices):
+                return (start_index, end_indices[i])
 
         return None
 
 
     @abc.abstractmethod
-    def _query_api(self, text, token_offsets):
-        """Yields (token_range, entity_string) tuples."""
+    def _query_api(self, text, token_index):
+        """
+        Yields (token_range, entity_string) tuples.
+        :param token_index: Token offsets of text, indexed by _index_token_offsets().
+        """
 
         raise NotImplementedError()
 
 
-    def _request_json_with_retry(self, params):
+    @abc.abstractmethod
+    def _get_params(self, text):
+        """Returns the query parameters to tag text."""
+
+        raise NotImplementedError()
 
-        if self.session is None:
-            self.session = requests.Session()
 
-        response = self.session.get(self.url, params=params)
+    def _get_client(self):
 
-        if response.status_code != 200:
-            print("Params:", str(params))
-            for _ in range(3):
-                print("Got status code %d: %s" % (response.status_code, response.text))
-                print("Retrying...")
-                response = self.session.get(self.url, params=params)
-                if response.status_code == 200:
-                    print("Recovered!")
-                    break
+        if self.client is None:
+            self.client = ApiClient(self.url, self.max_in_flight)
+        return self.client
 
-        response.raise_for_status()
 
-        return json.loads(response.text)
+    def _request_json(self, text):
+        # Uses the prefetched response if there is one
+
+        entry = self._prefetched.get(text)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._prefetched[text]
+            return entry[0].result()
+
+        return self._get_client().get_json(self._get_params(text))
 
 
 class OleloEntityTagger(ApiEntityTagger):
 
 
-    def __init__(self, types_file, olelo_url):
+    def __init__(self, types_file, olelo_url, max_in_flight=8):
 
-        ApiEntityTagger.__init__(self, types_file, olelo_url)
+        ApiEntityTagger.__init__(self, types_file, olelo_url, max_in_flight)
 
 
-    def _query_api(self, text, token_offsets):
+    def _query_api(self, text, token_index):
 
         olelo_response = self._query_olelo(text)
 
         for entity in olelo_response["entities"]:
 
-            token_range = self._find_token_range(token_offsets,
+            token_range = self._find_token_range(token_index,
                                                  entity["offset"],
                                                  entity["offset"] + len(entity["text"]))
 
@@ -227,19 +557,23 @@ class OleloEntityTagger(ApiEntityTagger):
 
     def _query_olelo(self, text):
 
-        params = {"question": text}
-        return self._request_json_with_retry(params)["umls"]
+        return self._request_json(text)["umls"]
+
+
+    def _get_params(self, text):
+
+        return {"question": text}
 
 
 class CtakesEntityTagger(ApiEntityTagger):
 
 
-    def __init__(self, types_file, ctakes_url):
+    def __init__(self, types_file, ctakes_url, max_in_flight=8):
 
-        ApiEntityTagger.__init__(self, types_file, ctakes_url)
+        ApiEntityTagger.__init__(self, types_file, ctakes_url, max_in_flight)
 
 
-    def _query_api(self, text, token_offsets):
+    def _query_api(self, text, token_index):
 
         ctakes_response = self._query_ctakes(text)
 
@@ -255,7 +589,7 @@ class CtakesEntityTagger(ApiEntityTagger):
             if concepts is None:
                 continue
 
-            token_range = self._find_token_range(token_offsets,
+            token_range = self._find_token_range(token_index,
                                                  annotation["begin"],
                                                  annotation["end"])
 
@@ -271,11 +605,357 @@ class CtakesEntityTagger(ApiEntityTagger):
 
     def _query_ctakes(self, text):
 
-        params = {"text": text}
-        return self._request_json_with_retry(params)
+        return self._request_json(text)
+
+
+    def _get_params(self, text):
+
+        return {"text": text}
 
 
-def get_entity_tagger():
+class CachingEntityTagger(EntityTagger):
+    """Caches the results of another tagger, see biomedical_qa.data.tagger_cache.TagStore.
+
+    Results are keyed by a hash of the text, the tagger's config and the tokenizer.
+    The config equals the wrapped tagger's one, so the cache is transparent to
+    e.g. the preprocessing cache.
+    """
+
+
+    def __init__(self, tagger, cache_dir=None, memory_cache_size=DEFAULT_MEMORY_CACHE_SIZE):
+        """
+        :param tagger: EntityTagger to cache.
+        :param cache_dir: Directory of the SQLite cache file, or None to only cache in memory.
+        :param memory_cache_size: Number of results cached in memory.
+        """
+
+        self.tagger = tagger
+        self.types_set = tagger.types_set
+        self.num_types = tagger.num_types
+        self.type2id = tagger.type2id
+        self.id2type = tagger.id2type
+        self._mask_type_ids = {}
+        path = os.path.join(cache_dir, "tags.sqlite") if cache_dir is not None else None
+        self.store = TagStore(path, memory_cache_size)
+        self._namespaces = {}
+
+
+    def get_config(self):
+
+        return self.tagger.get_config()
+
+
+    def after_fork(self):
+
+        self.tagger.after_fork()
+
+
+    def close(self):
+
+        self.tagger.close()
+        self.store.close()
+
+
+    def load(self):
+
+        self.tagger.load()
+
+
+    def prefetch(self, texts, tokenizer):
+
+        # Duplicates are tagged once, then found in the cache
+        self.tagger.prefetch([text for text in dict.fromkeys(texts)
+                              if not self.store.contains(self._get_key(text, tokenizer))],
+                             tokenizer)
+
+
+    def _get_key(self, text, tokenizer):
+
+        namespace = self._namespaces.get(id(tokenizer))
+        if namespace is None:
+            namespace = get_namespace(self.get_config(), tokenizer)
+            self._namespaces[id(tokenizer)] = namespace
+        return hashlib.sha1(namespace + text.encode("utf-8")).digest()
+
+
+    def _to_value(self, tag_result):
+
+        masks, found_entities = tag_result
+        return tuple(masks), tuple(sorted(found_entities))
+
+
+    def _from_value(self, value):
+
+        masks, found_entities = value
+        return list(masks), set(found_entities)
+
+
+    def tag_masks(self, text, tokenizer):
+
+        key = self._get_key(text, tokenizer)
+        value = self.store.get(key)
+        if value is None:
+            value = self._to_value(self.tagger.tag_masks(text, tokenizer))
+            self.store.put(key, value)
+
+        return self._from_value(value)
+
+
+    def tag_many_masks(self, texts, tokenizer):
+        """Looks up all texts at once, then tags the distinct missing ones with one tag_many_masks() call."""
+
+        texts = list(texts)
+        keys = [self._get_key(text, tokenizer) for text in texts]
+        values = self.store.get_many(keys)
+
+        missing = {}
+        for key, text, value in zip(keys, texts, values):
+            if value is None:
+                missing.setdefault(key, text)
+
+        if missing:
+            missing_keys = list(missing)
+            tag_results = self.tagger.tag_many_masks([missing[key] for key in missing_keys], tokenizer)
+            new_values = {key: self._to_value(tag_result)
+                          for key, tag_result in zip(missing_keys, tag_results)}
+            self.store.put_many(new_values.items())
+            values = [new_values[key] if value is None else value
+                      for key, value in zip(keys, values)]
+
+        return [self._from_value(value) for value in values]
+
+
+# Tagger of a tagger pool worker, inherited from the parent when forked
+_pool_tagger = None
+
+
+def _init_pool_worker(tagger):
+
+    global _pool_tagger
+    _pool_tagger = tagger
+    _pool_tagger.after_fork()
+
+
+def _tag_chunk(args):
+
+    texts, tokenizer = args
+    return _pool_tagger.tag_many_masks(texts, tokenizer)
+
+
+class PooledEntityTagger(EntityTagger):
+    """Tags batches of texts in forked worker processes that share another tagger.
+
+    The wrapped tagger (e.g. a DictionaryEntityTagger with its term dictionary) is
+    loaded once in this process. The workers are forked from it, so they share its
+    memory copy-on-write instead of loading it again. Single texts, and all texts
+    in processes forked later (e.g. preprocessing workers), are tagged in process.
+    """
+
+
+    def __init__(self, tagger, num_workers):
+        """
+        :param tagger: EntityTagger to share. It should not hold threads or connections.
+        :param num_workers: Number of worker processes.
+        """
+
+        self.tagger = tagger
+        self.num_workers = num_workers
+        self.types_set = tagger.types_set
+        self.num_types = tagger.num_types
+        self.type2id = tagger.type2id
+        self.id2type = tagger.id2type
+        self._mask_type_ids = {}
+
+        try:
+            context = multiprocessing.get_context("fork")
+        except ValueError:
+            print("Forking is not supported on this platform, tagging in process.")
+            self._pool = None
+            return
+
+        if hasattr(gc, "freeze"):
+            # Objects in the permanent generation are never touched by the workers' garbage
+            # collector, so the pages of the tagger stay shared
+            gc.collect()
+            gc.freeze()
+        # Forked workers inherit the initializer's arguments, they are not pickled
+        self._pool = context.Pool(num_workers, initializer=_init_pool_worker, initargs=(tagger,))
+        self._pool_pid = os.getpid()
+        if hasattr(gc, "unfreeze"):
+            gc.unfreeze()
+
+
+    def get_config(self):
+
+        return self.tagger.get_config()
+
+
+    def after_fork(self):
+
+        # The pool belongs to the parent process
+        self._pool = None
+        self.tagger.after_fork()
+
+
+    def tag_masks(self, text, tokenizer):
+
+        return self.tagger.tag_masks(text, tokenizer)
+
+
+    def tag_many_masks(self, texts, tokenizer):
+        """Distributes the distinct texts over the workers."""
+
+        texts = list(texts)
+        distinct_texts = list(dict.fromkeys(texts))
+        if self._pool is None or self._pool_pid != os.getpid() or len(distinct_texts) < 2:
+            return self.tagger.tag_many_masks(texts, tokenizer)
+
+        # Tokenizers are equivalent, do not send the vocab
+        if isinstance(tokenizer, Tokenizer):
+            tokenizer = Tokenizer()
+
+        chunk_size = min(POOL_CHUNK_SIZE, -(-len(distinct_texts) // self.num_workers))
+        chunks = [distinct_texts[start:start + chunk_size]
+                  for start in range(0, len(distinct_texts), chunk_size)]
+        results = {}
+        for chunk, chunk_results in zip(chunks, self._pool.map(_tag_chunk, [(chunk, tokenizer) for chunk in chunks])):
+            results.update(zip(chunk, chunk_results))
+
+        # Copy the results of repeated texts, so that callers may modify them
+        seen = set()
+        tag_results = []
+        for text in texts:
+            masks, found_entities = results[text]
+            if text in seen:
+                masks = list(masks)
+                found_entities = set(found_entities)
+            seen.add(text)
+            tag_results.append((masks, found_entities))
+        return tag_results
+
+
+    def close(self):
+
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+        self.tagger.close()
+
+
+    def load(self):
+
+        self.tagger.load()
+
+
+class LazyEntityTagger(EntityTagger):
+    """Creates another tagger when it is first used.
+
+    Its config is known without creating it, so that e.g. a warm preprocessing
+    cache is found without loading a term dictionary.
+    """
+
+
+    def __init__(self, create_tagger, config):
+        """
+        :param create_tagger: Function that returns the tagger.
+        :param config: get_config() of the tagger that create_tagger returns.
+        """
+
+        self._create_tagger = create_tagger
+        self._config = config
+        self._tagger = None
+
+
+    @property
+    def tagger(self):
+
+        if self._tagger is None:
+            self._tagger = self._create_tagger()
+        return self._tagger
+
+
+    @property
+    def store(self):
+
+        # Statistics of a created CachingEntityTagger
+        return getattr(self._tagger, "store", None)
+
+
+    def get_config(self):
+
+        return self._config
+
+
+    def load(self):
+
+        self.tagger.load()
+
+
+    def after_fork(self):
+
+        if self._tagger is not None:
+            self._tagger.after_fork()
+
+
+    def close(self):
+
+        # Also releases the tagger's memory, it is created again if needed
+        if self._tagger is not None:
+            self._tagger.close()
+        self._tagger = None
+
+
+    def prefetch(self, texts, tokenizer):
+
+        self.tagger.prefetch(texts, tokenizer)
+
+
+    def tag_masks(self, text, tokenizer):
+
+        return self.tagger.tag_masks(text, tokenizer)
+
+
+    def tag(self, text, tokenizer):
+
+        return self.tagger.tag(text, tokenizer)
+
+
+    def tag_many_masks(self, texts, tokenizer):
+
+        return self.tagger.tag_many_masks(texts, tokenizer)
+
+
+    def tag_many(self, texts, tokenizer):
+
+        return self.tagger.tag_many(texts, tokenizer)
+
+
+def get_entity_tagger_config():
+    """Returns the get_config() of the tagger that get_entity_tagger() creates, or None."""
+
+    if FLAGS.entity_tagger == "dictionary":
+        return DictionaryEntityTagger.make_config(FLAGS.terms_file, FLAGS.types_file,
+                                                  FLAGS.entity_blacklist_file, True)
+    elif FLAGS.entity_tagger == "olelo":
+        return OleloEntityTagger.make_config(FLAGS.types_file, FLAGS.olelo_url)
+    elif FLAGS.entity_tagger == "ctakes":
+        return CtakesEntityTagger.make_config(FLAGS.types_file, FLAGS.ctakes_url)
+    elif FLAGS.entity_tagger is not None:
+        raise ValueError("Unrecognized entity tagger: %s" % FLAGS.entity_tagger)
+    return None
+
+
+def get_entity_tagger(lazy=False):
+    """
+    Creates the tagger selected by the flags.
+    :param lazy: If true, the tagger is only created when it is first used, see LazyEntityTagger.
+    :return: EntityTagger or None.
+    """
+
+    if lazy:
+        config = get_entity_tagger_config()
+        return LazyEntityTagger(get_entity_tagger, config) if config is not None else None
 
     tagger = None
     if FLAGS.entity_tagger == "dictionary":
@@ -285,11 +965,20 @@ def get_entity_tagger():
                                         blacklist_file=FLAGS.entity_blacklist_file)
     elif FLAGS.entity_tagger == "olelo":
         print("Adding Olelo Tagger")
-        tagger = OleloEntityTagger(FLAGS.types_file, FLAGS.olelo_url)
+        tagger = OleloEntityTagger(FLAGS.types_file, FLAGS.olelo_url, FLAGS.tagger_max_requests)
     elif FLAGS.entity_tagger == "ctakes":
         print("Adding CTakes Tagger")
-        tagger = CtakesEntityTagger(FLAGS.types_file, FLAGS.ctakes_url)
+        tagger = CtakesEntityTagger(FLAGS.types_file, FLAGS.ctakes_url, FLAGS.tagger_max_requests)
     elif FLAGS.entity_tagger is not None:
         raise ValueError("Unrecognized entity tagger: %s" % FLAGS.entity_tagger)
 
+    if isinstance(tagger, DictionaryEntityTagger) and FLAGS.tagger_num_workers > 0:
+        print("Tagging in %d shared worker processes" % FLAGS.tagger_num_workers)
+        tagger = PooledEntityTagger(tagger, FLAGS.tagger_num_workers)
+
+    if tagger is not None and FLAGS.tagger_cache_dir is not None:
+        print("Caching tagger results in %s" % FLAGS.tagger_cache_dir)
+        tagger = CachingEntityTagger(tagger, FLAGS.tagger_cache_dir,
+                                     FLAGS.tagger_memory_cache_size)
+
     return tagger
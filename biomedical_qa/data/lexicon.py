@@ -0,0 +1,308 @@
+import bisect
+import json
+import logging
+import mmap
+import os
+
+import numpy as np
+
+from biomedical_qa.data.umls import build_term2types, build_term2preferred
+
+# Written into the lexicon directory, lists the compiled case variants
+LEXICON_FILE = "lexicon.json"
+LEXICON_VERSION = 1
+
+# Every INDEX_STRIDE-th term is kept in memory to narrow down binary searches
+INDEX_STRIDE = 128
+
+
+def _variant_name(case_sensitive):
+
+    return "cased" if case_sensitive else "uncased"
+
+
+def is_lexicon(path):
+    """Returns whether path is a lexicon directory written by compile_lexicon()."""
+
+    return path is not None and os.path.isfile(os.path.join(path, LEXICON_FILE))
+
+
+def compile_lexicon(terms_file, types_file, output_dir, case_variants=(True, False), num_workers=1):
+    """
+    Compiles the UMLS terms & types files into a lexicon that can be opened with Lexicon.
+    For each case variant, the lexicon consists of
+        - strings.bin: All terms, UTF-8 encoded and sorted bytewise.
+        - offsets.npy: int64 [num_terms + 1] start offset of each term in strings.bin.
+        - type_set_ids.npy: int32 [num_terms] index into type_sets.npy, -1 if the term has no types.
+        - type_sets.npy: uint8 [num_type_sets, ceil(num_types / 8)] type bitmasks (little bit order).
+        - preferred_ids.npy: int32 [num_terms] index of the preferred term, -1 if there is none.
+        - meta.json: Sorted type strings & number of terms.
+    :param terms_file: UMLS terms file (MRCONSO.RRF).
+    :param types_file: UMLS types file (MRSTY.RRF).
+    :param output_dir: Lexicon directory, is created if it does not exist.
+    :param case_variants: Compile a case sensitive (True) and/or a lower cased (False) variant.
+    :param num_workers: Number of processes parsing the UMLS files.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    for case_sensitive in case_variants:
+        variant_dir = os.path.join(output_dir, _variant_name(case_sensitive))
+        os.makedirs(variant_dir, exist_ok=True)
+
+        term2types, types_set = build_term2types(terms_file, types_file, case_sensitive, num_workers)
+        term2preferred = build_term2preferred(terms_file, case_sensitive, num_workers)
+
+        logging.info("Compiling %s lexicon..." % _variant_name(case_sensitive))
+        types = sorted(types_set)
+        type2id = {type: i for i, type in enumerate(types)}
+
+        terms = set(term2types)
+        terms.update(term2preferred)
+        terms.update(term2preferred.values())
+        encoded_terms = sorted(term.encode("utf-8") for term in terms)
+        del terms
+        term2id = {term.decode("utf-8"): i for i, term in enumerate(encoded_terms)}
+
+        with open(os.path.join(variant_dir, "strings.bin"), "wb") as f:
+            for term in encoded_terms:
+                f.write(term)
+        offsets = np.zeros([len(encoded_terms) + 1], dtype=np.int64)
+        np.cumsum([len(term) for term in encoded_terms], out=offsets[1:])
+        np.save(os.path.join(variant_dir, "offsets.npy"), offsets)
+        del encoded_terms
+
+        type_set2id = {}
+        type_set_ids = np.full([len(term2id)], -1, dtype=np.int32)
+        for term, term_types in term2types.items():
+            type_set_ids[term2id[term]] = type_set2id.setdefault(frozenset(term_types), len(type_set2id))
+        type_sets = np.zeros([len(type_set2id), len(types)], dtype=np.bool_)
+        for term_types, type_set_id in type_set2id.items():
+            type_sets[type_set_id, [type2id[type] for type in term_types]] = True
+        np.save(os.path.join(variant_dir, "type_set_ids.npy"), type_set_ids)
+        np.save(os.path.join(variant_dir, "type_sets.npy"),
+                np.packbits(type_sets, axis=1, bitorder="little"))
+
+        preferred_ids = np.full([len(term2id)], -1, dtype=np.int32)
+        for term, preferred_term in term2preferred.items():
+            preferred_ids[term2id[term]] = term2id[preferred_term]
+        np.save(os.path.join(variant_dir, "preferred_ids.npy"), preferred_ids)
+
+        with open(os.path.join(variant_dir, "meta.json"), "w") as f:
+            json.dump({"types": types, "num_terms": len(term2id)}, f)
+
+        logging.info("Compiled %d terms, %d types and %d type sets." % (
+            len(term2id), len(types), len(type_set2id)))
+
+    with open(os.path.join(output_dir, LEXICON_FILE), "w") as f:
+        json.dump({
+            "version": LEXICON_VERSION,
+            "terms_file": terms_file,
+            "types_file": types_file,
+            "variants": [_variant_name(case_sensitive) for case_sensitive in case_variants],
+        }, f)
+
+
+class _LexiconMapping(object):
+    """Read only dict-like view of a lexicon, e.g. term -> types."""
+
+
+    def __init__(self, get):
+
+        self._get = get
+
+
+    def get(self, term, default=None):
+
+        value = self._get(term)
+        return default if value is None else value
+
+
+    def __contains__(self, term):
+
+        return self._get(term) is not None
+
+
+    def __getitem__(self, term):
+
+        value = self._get(term)
+        if value is None:
+            raise KeyError(term)
+        return value
+
+
+class Lexicon(object):
+    """Compiled UMLS lexicon (see compile_lexicon()), memory mapped from disk.
+
+    Opening a lexicon only maps its files and reads every INDEX_STRIDE-th term,
+    so it takes milliseconds and processes that open the same lexicon share the
+    pages. Terms are found by binary search in the sorted string table.
+    """
+
+
+    def __init__(self, path, case_sensitive=True):
+        """
+        :param path: Lexicon directory written by compile_lexicon().
+        :param case_sensitive: Whether to open the case sensitive or the lower cased
+                variant. Terms passed to the lower cased variant must be lower cased.
+        """
+
+        self.path = path
+        self.case_sensitive = case_sensitive
+
+        with open(os.path.join(path, LEXICON_FILE)) as f:
+            lexicon_meta = json.load(f)
+        assert lexicon_meta["version"] == LEXICON_VERSION, \
+            "Lexicon %s has version %s, expected %s." % (path, lexicon_meta["version"], LEXICON_VERSION)
+        variant = _variant_name(case_sensitive)
+        assert variant in lexicon_meta["variants"], \
+            "Lexicon %s has no %s variant, compile it with that variant." % (path, variant)
+
+        variant_dir = os.path.join(path, variant)
+        with open(os.path.join(variant_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.types = meta["types"]
+        self.num_terms = meta["num_terms"]
+
+        with open(os.path.join(variant_dir, "strings.bin"), "rb") as f:
+            self._strings = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                                if os.fstat(f.fileno()).st_size > 0 else b""
+
+        def load(name):
+            return np.load(os.path.join(variant_dir, name), mmap_mode="r")
+
+        # memoryviews make element access return python ints
+        self._offsets = memoryview(load("offsets.npy"))
+        self._type_set_ids = memoryview(load("type_set_ids.npy"))
+        self._preferred_ids = memoryview(load("preferred_ids.npy"))
+        self._type_sets = load("type_sets.npy")
+        self._decoded_type_sets = {}
+        self._type_masks = {}
+
+        self._index_keys = [self._string(i) for i in range(0, self.num_terms, INDEX_STRIDE)]
+
+        self.term2types = _LexiconMapping(self.get_types)
+        self.term2preferred = _LexiconMapping(self.get_preferred)
+
+
+    def __getstate__(self):
+
+        return {"path": self.path, "case_sensitive": self.case_sensitive}
+
+
+    def __setstate__(self, state):
+
+        self.__init__(state["path"], state["case_sensitive"])
+
+
+    def __len__(self):
+
+        return self.num_terms
+
+
+    def _string(self, index):
+
+        return self._strings[self._offsets[index]:self._offsets[index + 1]]
+
+
+    def _lower_bound(self, key):
+        # Index of the first term >= key (as UTF-8 bytes)
+
+        block = bisect.bisect_right(self._index_keys, key) - 1
+        if block < 0:
+            return 0
+
+        lo = block * INDEX_STRIDE
+        hi = min(lo + INDEX_STRIDE, self.num_terms)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._string(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+    def find(self, term):
+        """Returns the index of term, or -1 if it is not in the lexicon."""
+
+        key = term.encode("utf-8")
+        index = self._lower_bound(key)
+        if index < self.num_terms and self._string(index) == key:
+            return index
+        return -1
+
+
+    def prefix_search(self, term):
+        """
+        Looks up a term & whether longer terms start with it.
+        :return: (index, has_prefix): index of term or -1 if it is not in the lexicon,
+                has_prefix is True iff any term in the lexicon starts with term.
+        """
+
+        key = term.encode("utf-8")
+        index = self._lower_bound(key)
+        if index == self.num_terms:
+            return -1, False
+        string = self._string(index)
+        if string == key:
+            return index, True
+        return -1, string.startswith(key)
+
+
+    def get_term(self, index):
+
+        return self._string(index).decode("utf-8")
+
+
+    def get_type_set(self, index):
+        """
+        :param index: Index of a term.
+        :return: (types, type_ids) frozensets of the term's types and their indices
+                in self.types, or None if the term has no types.
+        """
+
+        type_set_id = self._type_set_ids[index]
+        if type_set_id < 0:
+            return None
+
+        type_set = self._decoded_type_sets.get(type_set_id)
+        if type_set is None:
+            bits = np.unpackbits(self._type_sets[type_set_id], bitorder="little")
+            type_ids = frozenset(np.flatnonzero(bits[:len(self.types)]).tolist())
+            type_set = (frozenset(self.types[i] for i in type_ids), type_ids)
+            self._decoded_type_sets[type_set_id] = type_set
+        return type_set
+
+
+    def get_type_mask(self, index):
+        """Returns the bitmask of the term's type ids (bit i is self.types[i]), 0 if it has no types."""
+
+        type_set_id = self._type_set_ids[index]
+        if type_set_id < 0:
+            return 0
+
+        mask = self._type_masks.get(type_set_id)
+        if mask is None:
+            mask = int.from_bytes(self._type_sets[type_set_id].tobytes(), "little")
+            self._type_masks[type_set_id] = mask
+        return mask
+
+
+    def get_types(self, term):
+        """Returns the frozenset of types of term, or None if term is unknown."""
+
+        index = self.find(term)
+        if index < 0:
+            return None
+        type_set = self.get_type_set(index)
+        return type_set[0] if type_set is not None else None
+
+
+    def get_preferred(self, term):
+        """Returns the preferred term of term, or None if there is none."""
+
+        index = self.find(term)
+        if index < 0 or self._preferred_ids[index] < 0:
+            return None
+        return self.get_term(self._preferred_ids[index])
@@ -0,0 +1,150 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from biomedical_qa.data.tokenizer import Tokenizer
+from biomedical_qa.data.umls import UMLS_TERMS_FILE_COLUMNS, group_by_key, umls_read_columns
+
+# Maximum entity length in tokens
+MAX_ENTITY_LENGTH = 10
+
+
+def load_term2cuis(terms_file):
+    """Reads a {term -> set<CUI>} map from the UMLS terms file (MRCONSO.RRF)."""
+
+    columns = [UMLS_TERMS_FILE_COLUMNS["term"], UMLS_TERMS_FILE_COLUMNS["cui"]]
+    return group_by_key(umls_read_columns(terms_file, columns))
+
+
+class StubTaggerServer(object):
+    """Local stand-in for the Olelo and cTAKES services, for tests & benchmarks.
+
+    Finds terms of a dictionary (longest match first) and answers in the format of
+        - GET /olelo?question=<text>: {"umls": {"entities": [{"offset", "text", "normalizedForm"}]}}
+        - GET /ctakes?text=<text>: [{"annotation": {"begin", "end",
+                                                    "ontologyConceptArr": [{"annotation": {"cui"}}]}}]
+    Responses can be delayed and fail randomly (status 503) to simulate a remote service.
+    """
+
+
+    def __init__(self, term2cuis, host="localhost", port=0, latency=0.0, failure_rate=0.0, seed=1234):
+        """
+        :param term2cuis: {term -> set<CUI>} dictionary of the entities to find.
+        :param port: Port to listen on, 0 picks a free port.
+        :param latency: Seconds each response is delayed.
+        :param failure_rate: Fraction of requests that fail with status 503.
+        """
+
+        self.term2cuis = term2cuis
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.num_requests = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokenizer = Tokenizer()
+        self._thread = None
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            # Keep-alive
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+
+
+    def get_url(self, service):
+        """Returns the URL of "olelo" or "ctakes"."""
+
+        return "http://%s:%d/%s" % (self.host, self.port, service)
+
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-tagger-server", daemon=True)
+        self._thread.start()
+        return self
+
+
+    def serve_forever(self):
+
+        self._server.serve_forever()
+
+
+    def stop(self):
+
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+    def annotate(self, text):
+        """Returns a list of (start, end, cuis) of all found terms."""
+
+        token_offsets = self._tokenizer.span_tokenize(text)
+        annotations = []
+        i = 0
+        while i < len(token_offsets):
+            start, _ = token_offsets[i]
+            for j in reversed(range(i, min(i + MAX_ENTITY_LENGTH, len(token_offsets)))):
+                _, end = token_offsets[j]
+                cuis = self.term2cuis.get(text[start:end])
+                if cuis:
+                    annotations.append((start, end, sorted(cuis)))
+                    i = j
+                    break
+            i += 1
+        return annotations
+
+
+    def _handle(self, request):
+
+        with self._lock:
+            self.num_requests += 1
+            fail = self._rng.random() < self.failure_rate
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        url = urlparse(request.path)
+        params = parse_qs(url.query, keep_blank_values=True)
+        service = url.path.strip("/")
+
+        if fail:
+            self._respond(request, 503, {"error": "Simulated failure"})
+        elif service == "olelo" and "question" in params:
+            text = params["question"][0]
+            self._respond(request, 200, {"umls": {"entities": [
+                {"offset": start, "text": text[start:end], "normalizedForm": cui}
+                for start, end, cuis in self.annotate(text) for cui in cuis]}})
+        elif service == "ctakes" and "text" in params:
+            text = params["text"][0]
+            self._respond(request, 200, [
+                {"annotation": {"begin": start, "end": end,
+                                "ontologyConceptArr": [{"annotation": {"cui": cui}} for cui in cuis]}}
+                for start, end, cuis in self.annotate(text)])
+        else:
+            self._respond(request, 404, {"error": "Unknown request %s" % request.path})
+
+
+    def _respond(self, request, status, body):
+
+        data = json.dumps(body).encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
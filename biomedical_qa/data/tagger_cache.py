@@ -0,0 +1,224 @@
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+# Increase whenever the tagging or the stored format changes
+TAGGER_CACHE_VERSION = 2
+
+DEFAULT_MEMORY_CACHE_SIZE = 100000
+
+# Maximum number of keys per SQLite query
+QUERY_BATCH_SIZE = 500
+
+
+def get_namespace(tagger_config, tokenizer):
+    """
+    Computes the part of the cache key that is shared by all texts.
+    :param tagger_config: EntityTagger.get_config() of the cached tagger.
+    :param tokenizer: Tokenizer passed to tag(). Its get_config() is used if it has
+            one, otherwise its type.
+    :return: Bytes.
+    """
+
+    tokenizer_config = tokenizer.get_config() if hasattr(tokenizer, "get_config") \
+                        else {"type": type(tokenizer).__name__}
+    return hashlib.sha1(json.dumps({
+        "version": TAGGER_CACHE_VERSION,
+        "tagger": tagger_config,
+        "tokenizer": tokenizer_config,
+    }, sort_keys=True).encode("utf-8")).digest()
+
+
+class TagStore(object):
+    """Maps keys to tagging results, with an in-process LRU in front of an SQLite file.
+
+    Values are (masks, entities) where masks is a tuple of type bitmasks (one int
+    per token, see EntityTagger.types_to_mask()) and entities is a sorted tuple of strings. The SQLite database
+    is opened lazily per process, so a store can be used by forked workers; they
+    share the file, not the connection. Within a process, threads share the
+    connection and the LRU under a lock, e.g. server requests or prefetching.
+    """
+
+
+    def __init__(self, path=None, memory_cache_size=DEFAULT_MEMORY_CACHE_SIZE):
+        """
+        :param path: SQLite file, or None to only cache in memory.
+        :param memory_cache_size: Maximum number of entries in the in-process LRU.
+        """
+
+        self.path = path
+        self.memory_cache_size = memory_cache_size
+        self._memory_cache = collections.OrderedDict()
+        self._connection = None
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self.reset_stats()
+
+
+    def reset_stats(self):
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+
+    @property
+    def hit_rate(self):
+
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0.0
+
+
+    def get_stats_string(self):
+
+        return "Tagger cache: %d lookups, %d memory hits, %d disk hits, %d misses (hit rate %.1f%%)" % (
+            self.memory_hits + self.disk_hits + self.misses, self.memory_hits,
+            self.disk_hits, self.misses, 100 * self.hit_rate)
+
+
+    def _check_process(self):
+
+        if self._pid != os.getpid():
+            # Never use a connection or lock inherited from the parent process
+            self._connection = None
+            self._lock = threading.RLock()
+            self._pid = os.getpid()
+
+
+    def _get_connection(self):
+        """Returns the connection of this process. The caller must hold the lock."""
+
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Used by one thread at a time, under the lock
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                                               check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS tags (key BLOB PRIMARY KEY, value TEXT)")
+        return self._connection
+
+
+    def _remember(self, key, value):
+
+        self._memory_cache[key] = value
+        if len(self._memory_cache) > self.memory_cache_size:
+            self._memory_cache.popitem(last=False)
+
+
+    def get(self, key):
+        """Returns the value of key, or None if it is not cached."""
+
+        self._check_process()
+        with self._lock:
+            value = self._memory_cache.get(key)
+            if value is not None:
+                self._memory_cache.move_to_end(key)
+                self.memory_hits += 1
+                return value
+
+            if self.path is not None:
+                row = self._get_connection().execute(
+                    "SELECT value FROM tags WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    masks, entities = json.loads(row[0])
+                    value = (tuple(masks), tuple(entities))
+                    self._remember(key, value)
+                    self.disk_hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+
+    def get_many(self, keys):
+        """Returns the list of values of keys (None if not cached), using one query per QUERY_BATCH_SIZE keys."""
+
+        self._check_process()
+        with self._lock:
+            memory_values = {}
+            for key in keys:
+                value = self._memory_cache.get(key)
+                if value is not None:
+                    self._memory_cache.move_to_end(key)
+                    memory_values[key] = value
+
+            disk_values = {}
+            if self.path is not None:
+                disk_keys = [key for key in dict.fromkeys(keys) if key not in memory_values]
+                connection = self._get_connection()
+                for start in range(0, len(disk_keys), QUERY_BATCH_SIZE):
+                    batch = disk_keys[start:start + QUERY_BATCH_SIZE]
+                    rows = connection.execute("SELECT key, value FROM tags WHERE key IN (%s)" %
+                                              ",".join("?" * len(batch)), batch).fetchall()
+                    for key, value in rows:
+                        masks, entities = json.loads(value)
+                        disk_values[key] = (tuple(masks), tuple(entities))
+                        self._remember(key, disk_values[key])
+
+            values = []
+            for key in keys:
+                if key in memory_values:
+                    self.memory_hits += 1
+                    values.append(memory_values[key])
+                elif key in disk_values:
+                    self.disk_hits += 1
+                    values.append(disk_values[key])
+                else:
+                    self.misses += 1
+                    values.append(None)
+            return values
+
+
+    def contains(self, key):
+        """Returns whether key is cached, without counting a lookup."""
+
+        self._check_process()
+        with self._lock:
+            if key in self._memory_cache:
+                return True
+            if self.path is not None:
+                return self._get_connection().execute(
+                    "SELECT 1 FROM tags WHERE key = ?", (key,)).fetchone() is not None
+            return False
+
+
+    def put(self, key, value):
+
+        self._check_process()
+        with self._lock:
+            self._remember(key, value)
+            if self.path is not None:
+                self._get_connection().execute(
+                    "INSERT OR REPLACE INTO tags (key, value) VALUES (?, ?)",
+                    (key, json.dumps(value)))
+
+
+    def put_many(self, items):
+        """Stores (key, value) pairs in one transaction."""
+
+        items = list(items)
+        self._check_process()
+        with self._lock:
+            for key, value in items:
+                self._remember(key, value)
+            if self.path is not None:
+                connection = self._get_connection()
+                connection.execute("BEGIN")
+                connection.executemany("INSERT OR REPLACE INTO tags (key, value) VALUES (?, ?)",
+                                       [(key, json.dumps(value)) for key, value in items])
+                connection.execute("COMMIT")
+
+
+    def close(self):
+
+        self._check_process()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = None
@@ -0,0 +1,95 @@
+import functools
+import re
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# Maximum number of entries in the token -> id cache of a Tokenizer
+MAX_ID_CACHE_SIZE = 1000000
+
+
+@functools.lru_cache(maxsize=4096)
+def _span_tokenize(text):
+    # Shared across tokenizers, so that a text that is first tokenized by the
+    # sampler and then by the entity tagger is only scanned once.
+    return tuple(m.span() for m in TOKEN_PATTERN.finditer(text))
+
+
+class Tokenizer(object):
+    """Single pass regex tokenizer that yields tokens with their character offsets and vocab ids.
+
+    Produces the same tokens as nltk's RegexpTokenizer(r'\\w+|[^\\w\\s]') and can be
+    used wherever that is expected (tokenize, span_tokenize).
+    """
+
+
+    def __init__(self, vocab=None, unk_id=None):
+        """
+        :param vocab: word -> id map used by tokenize_with_ids(), or None.
+        :param unk_id: id of words that are not in vocab.
+        """
+
+        self.vocab = vocab
+        self.unk_id = unk_id
+        self._id_cache = {}
+
+
+    def get_config(self):
+        """Returns a JSON serializable dict of all settings that influence the tokens."""
+
+        return {"type": type(self).__name__, "pattern": TOKEN_PATTERN.pattern}
+
+
+    def span_tokenize(self, text):
+        """Returns a tuple of (start, end) character offsets of all tokens."""
+
+        return _span_tokenize(text)
+
+
+    def tokenize(self, text):
+
+        return [text[start:end] for start, end in _span_tokenize(text)]
+
+
+    def token_id(self, token):
+        """Returns the vocab id of the lower cased token."""
+
+        return self._lookup(token)[1]
+
+
+    def _lookup(self, token):
+        # Memoizes (lower cased token, vocab id) per token
+
+        entry = self._id_cache.get(token)
+        if entry is None:
+            if len(self._id_cache) >= MAX_ID_CACHE_SIZE:
+                self._id_cache.clear()
+            token_lower = token.lower()
+            entry = (token_lower, self.vocab.get(token_lower, self.unk_id))
+            self._id_cache[token] = entry
+        return entry
+
+
+    def tokenize_with_ids(self, text):
+        """
+        Tokenizes the text.
+        :param text: String.
+        :return: Generator of (lower cased token, start, end, vocab id) tuples,
+                offsets refer to text.lower().
+        """
+
+        spans = _span_tokenize(text)
+        text_lower = text.lower()
+
+        if len(text_lower) == len(text):
+            for start, end in spans:
+                token_lower, token_id = self._lookup(text[start:end])
+                yield token_lower, start, end, token_id
+        else:
+            # Lower casing changed the length of some characters (e.g. "İ"), so offsets
+            # of text and text.lower() differ. Search the tokens in the lower cased text.
+            offset = 0
+            for start, end in spans:
+                token_lower, token_id = self._lookup(text[start:end])
+                offset = text_lower.index(token_lower, offset)
+                yield token_lower, offset, offset + len(token_lower), token_id
+                offset += len(token_lower)
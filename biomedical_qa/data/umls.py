@@ -1,4 +1,6 @@
 import logging
+import multiprocessing
+import os
 
 logging.getLogger().setLevel(logging.INFO)
 
@@ -16,22 +18,94 @@ UMLS_TYPES_FILE_COLUMNS = {
     "type": 3,
 }
 
+# Bytes of an RRF file that are read (and parsed by one worker) at a time
+CHUNK_SIZE = 16 << 20
 
-def umls_read_columns(filepath, columns_list, case_sensitive=True):
 
-    with open(filepath) as f:
-        file_lines = f.readlines()
+def _chunk_offsets(filepath, chunk_size):
+    # (start, end) byte offsets of consecutive chunks that start at line boundaries
+
+    size = os.path.getsize(filepath)
+    chunks = []
+    with open(filepath, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = f.tell()
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def _read_chunk(args):
+    # Parses one chunk, returns the list of projected rows
+
+    filepath, start, end, columns_list, case_sensitive, filters = args
+
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).decode("utf-8").split("\n")
+
+    # Only split off the cells that are needed
+    max_column = max(list(columns_list) + [column for column, _ in filters])
 
     rows = []
-    for line in file_lines:
-        if not case_sensitive:
-            line = line.lower()
-        cells = line.split("|")
-        rows.append(tuple([cells[i] for i in columns_list]))
+    for line in lines:
+        if not line:
+            continue
+        cells = line.split("|", max_column + 1)
+        for column, values in filters:
+            if cells[column].lower() not in values:
+                break
+        else:
+            if case_sensitive:
+                rows.append(tuple([cells[i] for i in columns_list]))
+            else:
+                rows.append(tuple([cells[i].lower() for i in columns_list]))
 
     return rows
 
 
+def umls_read_columns(filepath, columns_list, case_sensitive=True, filters=None, num_workers=1):
+    """
+    Streams the rows of a UMLS RRF file chunk by chunk.
+    :param filepath: Path to the RRF file.
+    :param columns_list: Indices of the columns to return.
+    :param case_sensitive: If False, the returned cells are lower cased.
+    :param filters: Optional {column index -> set<value>}. Only rows whose lower
+            cased cells are in the given sets are returned.
+    :param num_workers: Number of processes parsing chunks in parallel.
+    :return: Generator of tuples with the requested cells, in file order.
+    """
+
+    filters = [(column, set(value.lower() for value in values))
+               for column, values in (filters or {}).items()]
+    tasks = [(filepath, start, end, columns_list, case_sensitive, filters)
+             for start, end in _chunk_offsets(filepath, CHUNK_SIZE)]
+
+    if num_workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield from _read_chunk(task)
+        return
+
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        print("Forking is not supported on this platform, reading in process.")
+        for task in tasks:
+            yield from _read_chunk(task)
+        return
+
+    with context.Pool(num_workers) as pool:
+        # Submit a few chunks at a time, so that parsed chunks do not pile up in memory
+        # when the consumer is slower than the workers.
+        wave_size = 2 * num_workers
+        for wave_start in range(0, len(tasks), wave_size):
+            for rows in pool.imap(_read_chunk, tasks[wave_start:wave_start + wave_size]):
+                yield from rows
+
+
 def group_by_key(key_value_pairs):
     """
     Group key-value pairs by key.
@@ -58,31 +132,40 @@ def group_by_key(key_value_pairs):
     return result
 
 
-def build_term2types(terms_file, types_file, case_sensitive=True):
-
-    # Build string -> set<CUI> map
-    logging.info("Reading terms file...")
-    columns = [UMLS_TERMS_FILE_COLUMNS["term"], UMLS_TERMS_FILE_COLUMNS["cui"]]
-    term_rows = umls_read_columns(terms_file, columns, case_sensitive)
-    term2concepts = group_by_key(term_rows)
-    del term_rows
+def build_term2types(terms_file, types_file, case_sensitive=True, num_workers=1):
+    """
+    Builds a <term> -> <types> dictionary by joining the terms & types files on CUI.
+    Terms are joined while streaming the terms file, and type sets are pooled, so the
+    memory is dominated by the result itself.
+    :return: (term2types, types_set), where term2types values are frozensets that
+            are shared between terms.
+    """
 
-    # Build CUI -> set<Type> map
+    # Build CUI -> frozenset<Type> map
     logging.info("Reading types file...")
     columns = [UMLS_TYPES_FILE_COLUMNS["cui"], UMLS_TYPES_FILE_COLUMNS["type"]]
-    types_rows = umls_read_columns(types_file, columns, case_sensitive)
-    concept2types = group_by_key(types_rows)
-    del types_rows
-
-    logging.info("Joining terms & types...")
+    types_rows = umls_read_columns(types_file, columns, case_sensitive, num_workers=num_workers)
+    type_set_pool = {}
+    concept2types = {}
+    for cui, types in group_by_key(types_rows).items():
+        types = frozenset(types)
+        concept2types[cui] = type_set_pool.setdefault(types, types)
+
+    logging.info("Reading terms file & joining types...")
+    columns = [UMLS_TERMS_FILE_COLUMNS["term"], UMLS_TERMS_FILE_COLUMNS["cui"]]
     term2types = {}
+    for term, cui in umls_read_columns(terms_file, columns, case_sensitive, num_workers=num_workers):
+        types = concept2types[cui]
+        term_types = term2types.get(term)
+        if term_types is None:
+            term2types[term] = types
+        elif not types <= term_types:
+            types = term_types | types
+            term2types[term] = type_set_pool.setdefault(types, types)
+
     types_set = set()
-    for term, cuis in term2concepts.items():
-        term2types[term] = set()
-        for cui in cuis:
-            for type in concept2types[cui]:
-                term2types[term].add(type)
-                types_set.add(type)
+    for types in set(term2types.values()):
+        types_set.update(types)
 
     logging.info("Done mapping %d terms to %d types" % (
         len(term2types), len(types_set)))
@@ -90,11 +173,11 @@ def build_term2types(terms_file, types_file, case_sensitive=True):
     return term2types, types_set
 
 
-def build_concept2types(types_file):
+def build_concept2types(types_file, num_workers=1):
 
     logging.info("Reading types file...")
     columns = [UMLS_TYPES_FILE_COLUMNS["cui"], UMLS_TYPES_FILE_COLUMNS["type"]]
-    types_rows = umls_read_columns(types_file, columns)
+    types_rows = umls_read_columns(types_file, columns, num_workers=num_workers)
     concept2types = group_by_key(types_rows)
 
     types_set = set()
@@ -106,46 +189,44 @@ def build_concept2types(types_file):
     return concept2types, types_set
 
 
-def build_term2preferred(terms_file, case_sensitive=True):
+def build_term2preferred(terms_file, case_sensitive=True, num_workers=1):
     """Build a <term> -> <preferred term> dictionary.
 
     Finding the preferred term is implemented as in SQL Query #7 on this site:
     https://www.nlm.nih.gov/research/umls/implementation_resources/query_diagrams/er1.html
-    """
 
-    term2preferred = {}
+    The terms file is streamed twice: first to find the preferred term of each English
+    concept, then to map each English term to the preferred term of its concepts.
+    """
 
-    columns = [UMLS_TERMS_FILE_COLUMNS["cui"],
-               UMLS_TERMS_FILE_COLUMNS["lat"],
-               UMLS_TERMS_FILE_COLUMNS["ts"],
-               UMLS_TERMS_FILE_COLUMNS["stt"],
-               UMLS_TERMS_FILE_COLUMNS["ispref"],
-               UMLS_TERMS_FILE_COLUMNS["term"],]
-    logging.info("Reading terms file...")
-    term_rows = umls_read_columns(terms_file, columns, case_sensitive)
-    logging.info("Filter for English terms...")
-    term_rows = [row for row in term_rows if row[1].lower() == "eng"]
-    logging.info("Grouping by concept...")
-    term_rows_per_concept = group_by_key([(row[0], row) for row in term_rows])
-
-    def is_preferred(row):
-        _, _, ts, stt, ispref, _ = row
-        return ts.lower() == "p" and stt.lower() == "pf" and ispref.lower() == "y"
+    english_only = {UMLS_TERMS_FILE_COLUMNS["lat"]: {"eng"}}
+    preferred_only = {
+        UMLS_TERMS_FILE_COLUMNS["lat"]: {"eng"},
+        UMLS_TERMS_FILE_COLUMNS["ts"]: {"p"},
+        UMLS_TERMS_FILE_COLUMNS["stt"]: {"pf"},
+        UMLS_TERMS_FILE_COLUMNS["ispref"]: {"y"},
+    }
+
+    logging.info("Reading preferred terms...")
+    columns = [UMLS_TERMS_FILE_COLUMNS["cui"], UMLS_TERMS_FILE_COLUMNS["term"]]
+    concept2preferred = {}
+    for cui, preferred_term in umls_read_columns(terms_file, columns, case_sensitive,
+                                                 preferred_only, num_workers):
+        assert concept2preferred.get(cui, preferred_term) == preferred_term, \
+            "Found multiple preferred terms for CUI %s" % cui
+        concept2preferred[cui] = preferred_term
 
     logging.info("Filling term2preferred...")
-    for cui, concept_term_rows in term_rows_per_concept.items():
-        preferred_rows = [row for row in concept_term_rows if is_preferred(row)]
-        assert len(preferred_rows) != 0, "No preferred term found for CUI %s" % cui
-        assert len(preferred_rows) <= 1, "Found multiple preferred terms for CUI %s" % cui
-        preferred_term = preferred_rows[0][5]
-
-        for row in concept_term_rows:
-            _, _, _, _, _, term = row
-            if term in term2preferred and term2preferred[term] != preferred_term:
-                # Multiple preferred terms for this term. In that case, use the term itself as its preferred term.
-                del term2preferred[term]
-                term2preferred[term] = term
-            else:
-                term2preferred[term] = preferred_term
+    term2preferred = {}
+    for cui, term in umls_read_columns(terms_file, columns, case_sensitive,
+                                       english_only, num_workers):
+        assert cui in concept2preferred, "No preferred term found for CUI %s" % cui
+        preferred_term = concept2preferred[cui]
+
+        if term in term2preferred and term2preferred[term] != preferred_term:
+            # Multiple preferred terms for this term. In that case, use the term itself as its preferred term.
+            term2preferred[term] = term
+        else:
+            term2preferred[term] = preferred_term
 
     return term2preferred
@@ -5,6 +5,7 @@ import logging
 import tensorflow as tf
 
 from biomedical_qa.models import model_from_config
+from biomedical_qa.models.embedder import share_embeddings, use_in_graph_lookup, initialize_embeddings
 from biomedical_qa.models.beam_search import BeamSearchDecoder
 
 
@@ -24,14 +25,26 @@ class InferenceResult(object):
 
 
 def get_model(sess, model_config_file, devices, model_weights_file=None,
-              scope="model"):
+              scope="model", embeddings_cache_dir=None, in_graph_embeddings=False):
+    """
+    Loads a model & its weights. Models that are loaded in the same process
+    share equal constant word embedding matrices, see share_embeddings().
+    :param embeddings_cache_dir: Optional. Directory to store the embedding
+            matrices in, so that they are memory-mapped read-only.
+    :param in_graph_embeddings: If true, constant word embeddings are looked up
+            in the graph instead of being fed, see use_in_graph_lookup().
+    """
 
     with tf.variable_scope(scope):
         print("Loading Model:", model_config_file)
         with open(model_config_file, 'rb') as f:
             model_config = pickle.load(f)
+        share_embeddings(model_config, embeddings_cache_dir)
+        if in_graph_embeddings:
+            use_in_graph_lookup(model_config)
 
         model = model_from_config(model_config, devices)
+        initialize_embeddings(sess)
 
         if model_weights_file is None:
             train_dir = os.path.dirname(model_config_file)
@@ -48,6 +61,36 @@ def get_model(sess, model_config_file, devices, model_weights_file=None,
     return model
 
 
+def get_vocab(model_config_file):
+    """
+    Returns the vocab of a model's embedder without building the model, e.g. to
+    preprocess data before the session exists.
+    """
+
+    with open(model_config_file, 'rb') as f:
+        model_config = pickle.load(f)
+    return _find_vocab(model_config)
+
+
+def _find_vocab(config):
+
+    if isinstance(config, list):
+        for c in config:
+            vocab = _find_vocab(c)
+            if vocab is not None:
+                return vocab
+    elif isinstance(config, dict):
+        if "vocab" in config:
+            return config["vocab"]
+        # The first embedder's vocab, as in the model, see ConcatEmbedder
+        for c in config.values():
+            if isinstance(c, (dict, list)):
+                vocab = _find_vocab(c)
+                if vocab is not None:
+                    return vocab
+    return None
+
+
 def get_session():
     config = tf.ConfigProto(allow_soft_placement=True)
     config.gpu_options.allow_growth = True
@@ -57,7 +100,7 @@ def get_session():
 class Inferrer(object):
 
 
-    def __init__(self, model_or_models, sess, beam_size):
+    def __init__(self, model_or_models, sess, beam_size, in_graph_decoding=False):
 
         if isinstance(model_or_models, list):
             self.models = model_or_models
@@ -73,7 +116,7 @@ class Inferrer(object):
             model.set_eval(self.sess)
 
         self.beam_search_decoder = BeamSearchDecoder(self.sess, self.models,
-                                                     beam_size)
+                                                     beam_size, in_graph_decoding)
 
 
     def get_predictions(self, sampler):
@@ -106,10 +149,7 @@ class Inferrer(object):
         probs = []
 
         for context_index, start, end, prob in prediction:
-            char_offsets = {token_index: char_offset
-                            for (c_index, token_index), char_offset in all_char_offsets.items()
-                            if c_index == context_index}
-            answers.append(self.extract_answer(context, (start, end), char_offsets))
+            answers.append(self.extract_answer(context, (start, end), all_char_offsets[context_index]))
             probs.append(prob)
 
         # Sort by new probability
@@ -120,6 +160,12 @@ class Inferrer(object):
 
 
     def extract_answer(self, context, answer_span, char_offsets):
+        """
+        Extracts the answer string of a token span.
+        :param context: The paragraph's context string.
+        :param answer_span: (start, end) token indices, end is inclusive.
+        :param char_offsets: Array of the char offsets of the context's tokens in context.
+        """
 
         token_start, token_end = answer_span
 
@@ -127,7 +173,7 @@ class Inferrer(object):
             logging.warning("Null word selected! Using first token instead.")
             token_start = 0
 
-        char_start = char_offsets[token_start]
+        char_start = int(char_offsets[token_start])
 
         if token_end >= len(char_offsets):
             logging.warning("Null word selected! Using last token instead.")
@@ -138,5 +184,5 @@ class Inferrer(object):
             return context[char_start:]
         else:
             # token_end is inclusive
-            char_end = char_offsets[token_end + 1]
+            char_end = int(char_offsets[token_end + 1])
             return context[char_start:char_end].strip()
@@ -1,5 +1,6 @@
 import abc
 import itertools
+from biomedical_qa.data.lexicon import Lexicon, is_lexicon
 from biomedical_qa.data.umls import build_term2preferred
 
 
@@ -134,10 +135,17 @@ class PreferredTermPostprocessor(AbstractPostprocessor):
 
 
     def __init__(self, terms_file, case_sensitive=True):
+        """
+        :param terms_file: UMLS terms file (MRCONSO.RRF), or a lexicon directory written
+                by biomedical_qa.data.lexicon.compile_lexicon().
+        """
 
         self.terms_file = terms_file
         self.case_sensitive = case_sensitive
-        self.term2preferred = build_term2preferred(terms_file, case_sensitive)
+        if is_lexicon(terms_file):
+            self.term2preferred = Lexicon(terms_file, case_sensitive).term2preferred
+        else:
+            self.term2preferred = build_term2preferred(terms_file, case_sensitive)
 
 
     def process(self, answers_probs):
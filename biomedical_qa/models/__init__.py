@@ -1,3 +1,6 @@
+import sys
+from array import array
+
 import tensorflow as tf
 
 from biomedical_qa.models.embedder import Embedder,WordEmbedder,CharWordEmbedder, ConcatEmbedder, \
@@ -5,7 +8,80 @@ from biomedical_qa.models.embedder import Embedder,WordEmbedder,CharWordEmbedder
 from biomedical_qa.models.context_embedder import ContextEmbedder,RNNContextEmbedder,AttentionMemoryContextEmbedder
 
 
+# Entity tags are packed into bitmasks of TAG_WORDS 64 bit words per token (up to 128 tags)
+TAG_WORDS = 2
+
+
+def pack_tags(tags):
+    """
+    Packs per token tag sets into bitmasks.
+    :param tags: list<set<tag_id>>, one entry per token. Packed tags are returned as is.
+    :return: array('Q') with TAG_WORDS words per token.
+    """
+    if tags is None or isinstance(tags, array):
+        return tags
+
+    words = array('Q', bytes(8 * TAG_WORDS * len(tags)))
+    for token, token_tags in enumerate(tags):
+        for tag in token_tags:
+            assert 0 <= tag < 64 * TAG_WORDS
+            words[token * TAG_WORDS + (tag >> 6)] |= 1 << (tag & 63)
+    return words
+
+
+def pack_tag_masks(masks):
+    """
+    Packs per token tag bitmasks (bit i set iff the token has tag i) without going
+    through tag sets, see biomedical_qa.data.entity_tagger.EntityTagger.tag_masks().
+    :param masks: list<int>, one entry per token.
+    :return: array('Q') with TAG_WORDS words per token, like pack_tags().
+    """
+    num_bytes = 8 * TAG_WORDS
+    words = array('Q', b"".join(mask.to_bytes(num_bytes, "little") for mask in masks))
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+
+def unpack_tags(words):
+    """Inverse of pack_tags(), returns list<set<tag_id>>."""
+    if words is None:
+        return None
+
+    tags = []
+    for token in range(len(words) // TAG_WORDS):
+        token_tags = set()
+        for word_index in range(TAG_WORDS):
+            word = words[token * TAG_WORDS + word_index]
+            while word:
+                low_bit = word & -word
+                token_tags.add(64 * word_index + low_bit.bit_length() - 1)
+                word ^= low_bit
+        tags.append(token_tags)
+    return tags
+
+
+def _to_ids(sequence):
+    if sequence is None or (isinstance(sequence, array) and sequence.typecode == 'i'):
+        return sequence
+    return array('i', sequence)
+
+
 class QASetting:
+    """A question with its contexts and answers.
+
+    Token ids are stored as array('i') and entity tags as packed bitmasks (see
+    pack_tags), arrays that are passed in are used without copying, so that
+    questions of a paragraph can share their contexts. The JSON objects can either
+    be referenced directly, or lazily by index into a json_source (a list of
+    paragraph JSON objects), which is not pickled.
+    """
+
+    __slots__ = ["_question", "answers", "_contexts", "answers_spans",
+                 "answer_candidates", "answer_candidate_spans", "id", "q_type",
+                 "is_yes", "_paragraph_json", "_question_json", "json_source",
+                 "paragraph_index", "qa_index", "_question_tags", "_contexts_tags"]
+
     def __init__(self, question, answers, contexts,
                  answers_spans=None,
                  answer_candidates=None,
@@ -16,15 +92,21 @@ class QASetting:
                  paragraph_json=None,
                  question_json=None,
                  question_tags=None,
-                 contexts_tags=None):
+                 contexts_tags=None,
+                 json_source=None,
+                 paragraph_index=None,
+                 qa_index=None):
         """
         :param question: list of indices
         :param answers:  list of list of list of indices:
                          (answers -> alternatives -> token ids)
         :param contexts: list of list indices
         :param answer_spans: list of list of (context_index, start, end) tuples
-        :param question_tags: list of set<int>, one entry per token
-        :param contexts_tags: list of list of set<int>
+        :param question_tags: list of set<int>, one entry per token, or packed tags
+        :param contexts_tags: list of list of set<int>, or list of packed tags
+        :param json_source: list of paragraph JSON objects, used if paragraph_json
+                is not given: paragraph_json = json_source[paragraph_index] and
+                question_json = paragraph_json["qas"][qa_index]
         :return:
         """
         self.question = question
@@ -36,11 +118,88 @@ class QASetting:
         self.id = id
         self.q_type = q_type
         self.is_yes = is_yes
-        self.paragraph_json = paragraph_json
-        self.question_json = question_json
+        self._paragraph_json = paragraph_json
+        self._question_json = question_json
+        self.json_source = json_source
+        self.paragraph_index = paragraph_index
+        self.qa_index = qa_index
         self.question_tags = question_tags
         self.contexts_tags = contexts_tags
 
+    @property
+    def question(self):
+        return self._question
+
+    @question.setter
+    def question(self, question):
+        self._question = _to_ids(question)
+
+    @property
+    def contexts(self):
+        return self._contexts
+
+    @contexts.setter
+    def contexts(self, contexts):
+        self._contexts = [_to_ids(c) for c in contexts] if contexts is not None else None
+
+    @property
+    def question_tags(self):
+        return unpack_tags(self._question_tags)
+
+    @question_tags.setter
+    def question_tags(self, question_tags):
+        self._question_tags = pack_tags(question_tags)
+
+    @property
+    def contexts_tags(self):
+        if self._contexts_tags is None:
+            return None
+        return [unpack_tags(t) for t in self._contexts_tags]
+
+    @contexts_tags.setter
+    def contexts_tags(self, contexts_tags):
+        self._contexts_tags = [pack_tags(t) for t in contexts_tags] \
+                                if contexts_tags is not None else None
+
+    @property
+    def question_tag_bits(self):
+        """Packed question tags, see pack_tags()."""
+        return self._question_tags
+
+    @property
+    def contexts_tag_bits(self):
+        """Packed tags of each context, see pack_tags()."""
+        return self._contexts_tags
+
+    @property
+    def paragraph_json(self):
+        if self._paragraph_json is None and self.json_source is not None:
+            return self.json_source[self.paragraph_index]
+        return self._paragraph_json
+
+    @paragraph_json.setter
+    def paragraph_json(self, paragraph_json):
+        self._paragraph_json = paragraph_json
+
+    @property
+    def question_json(self):
+        if self._question_json is None and self.json_source is not None:
+            return self.json_source[self.paragraph_index]["qas"][self.qa_index]
+        return self._question_json
+
+    @question_json.setter
+    def question_json(self, question_json):
+        self._question_json = question_json
+
+    def __getstate__(self):
+        # The JSON source usually is the whole dataset, only pickle the indices into it
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != "json_source"}
+
+    def __setstate__(self, state):
+        self.json_source = None
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
     def translate(self, vocab, unk_id):
         self.question = [vocab.get(w, unk_id) for w in self.question]
         self.contexts = [[vocab.get(w, unk_id) for w in c] for c in self.contexts]
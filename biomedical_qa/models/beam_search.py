@@ -1,6 +1,117 @@
 import tensorflow as tf
 import numpy as np
 
+from biomedical_qa import tfutil
+from biomedical_qa.models.qa_model import build_inputs
+
+
+def top_k_2d(values, k, partition=None):
+    """
+    Computes the top k values of each partition of rows, see BeamSearchDecoder._top_k_2d.
+    Values are ordered descending, equal values by row, then column, i.e. like a
+    stable sort of the partition's values in row-major order. Partitions with
+    fewer than k values are padded with zeros.
+    :param values: 2D Array of values.
+    :param k: Number of values per partition.
+    :param partition: Optional. Shape [len(values)] int array of partition indices.
+    :return: rows (within the partition), cols, values, all shape [num_partitions, k] arrays.
+    """
+
+    n_cols = values.shape[1]
+
+    if partition is None:
+        flat_values = values
+        num_valid = np.full([len(values)], n_cols, dtype=np.int64)
+    else:
+        # Lay the rows of each partition out in a [num_partitions, max_rows * n_cols] matrix,
+        # padded with -inf after the partition's rows
+        num_partitions = partition[-1] + 1
+        order = np.argsort(partition, kind="stable")
+        sorted_partition = partition[order]
+        num_rows = np.bincount(partition, minlength=num_partitions)
+        rows_in_partition = np.arange(len(partition)) - (np.cumsum(num_rows) - num_rows)[sorted_partition]
+        padded_values = np.full([num_partitions, num_rows.max(), n_cols], -np.inf, dtype=values.dtype)
+        padded_values[sorted_partition, rows_in_partition] = values[order]
+        flat_values = padded_values.reshape([num_partitions, -1])
+        num_valid = num_rows * n_cols
+
+    num_partitions, num_values = flat_values.shape
+    num_top = min(k, num_values)
+
+    if num_top < num_values and not np.isnan(flat_values).any():
+        # The kth largest value of each partition, all larger values are in the top k
+        kth_values = -np.partition(-flat_values, num_top - 1, axis=1)[:, num_top - 1:num_top]
+        is_larger = flat_values > kth_values
+        # Of the values equal to the kth value, take the first ones
+        is_kth = flat_values == kth_values
+        num_kth = num_top - is_larger.sum(axis=1, keepdims=True)
+        is_top = is_larger | (is_kth & (np.cumsum(is_kth, axis=1) <= num_kth))
+        indices = np.nonzero(is_top)[1].reshape([num_partitions, num_top])
+    else:
+        indices = np.tile(np.arange(num_values), [num_partitions, 1])
+
+    # Sort the top values descending, the stable sort keeps equal values in index order
+    top_values = np.take_along_axis(flat_values, indices, axis=1)
+    order = np.argsort(-top_values, axis=1, kind="stable")[:, :num_top]
+    indices = np.take_along_axis(indices, order, axis=1)
+    top_values = np.take_along_axis(top_values, order, axis=1)
+
+    rows = np.zeros([num_partitions, k], dtype=np.int64)
+    cols = np.zeros([num_partitions, k], dtype=np.int64)
+    result_values = np.zeros([num_partitions, k], dtype=np.float32)
+    is_valid = np.arange(num_top) < num_valid.reshape([-1, 1])
+    rows[:, :num_top] = np.where(is_valid, indices // n_cols, 0)
+    cols[:, :num_top] = np.where(is_valid, indices % n_cols, 0)
+    result_values[:, :num_top] = np.where(is_valid, top_values, 0)
+
+    return rows, cols, result_values
+
+
+def beam_search_head(start_probs, context_partition, end_scores_fn, beam_size):
+    """
+    Builds the graph of a beam search decoding step, the in-graph counterpart of
+    BeamSearchDecoder._compute_top_starts() & _compute_top_spans().
+    :param start_probs: [num_contexts, num_tokens] tensor of start probabilities.
+    :param context_partition: [num_contexts] int64 tensor mapping each context to its question.
+    :param end_scores_fn: Function mapping (starts, batch context indices), both
+            [num_starts] int64 tensors, to [num_starts, num_tokens] end scores.
+    :param beam_size: Beam size.
+    :return: (contexts, starts, ends, probs), each a [num_questions, beam_size]
+            tensor. contexts are indices within the question's contexts.
+    """
+
+    with tf.name_scope("beam_search"):
+
+        # Top starts of each question: [num_questions, beam_size]
+        contexts, starts, start_probs = tfutil.segment_top_k(start_probs, context_partition, beam_size)
+
+        # End probs for each start: [num_questions * beam_size, num_tokens]
+        context_offsets = tf.cumsum(tf.segment_sum(tf.ones_like(context_partition), context_partition),
+                                    exclusive=True)
+        batch_contexts = contexts + tf.expand_dims(context_offsets, 1)
+        end_scores = end_scores_fn(tf.reshape(starts, [-1]), tf.reshape(batch_contexts, [-1]))
+        end_probs = tf.nn.softmax(end_scores)
+
+        # Top ends for each start, as [num_questions, beam_size * beam_size] tensors
+        beam_size_squared = beam_size * beam_size
+        ends, end_probs = tfutil.top_k_rows(end_probs, beam_size)
+        ends = tf.reshape(ends, [-1, beam_size_squared])
+        end_probs = tf.reshape(end_probs, [-1, beam_size_squared])
+
+        def repeat(values):
+            return tf.reshape(tf.tile(tf.expand_dims(values, 2), [1, 1, beam_size]),
+                              [-1, beam_size_squared])
+
+        # Top spans
+        total_probs = repeat(start_probs) * end_probs
+        top_indices, probs = tfutil.top_k_rows(total_probs, beam_size)
+        top_indices = tf.cast(top_indices, tf.int32)
+
+        return (tfutil.gather_rowwise_2d(repeat(contexts), top_indices),
+                tfutil.gather_rowwise_2d(repeat(starts), top_indices),
+                tfutil.gather_rowwise_2d(ends, top_indices),
+                probs)
+
 
 class BeamSearchDecoderResult(object):
 
@@ -22,6 +133,11 @@ class BeamSearchDecoderResult(object):
 
 
 class ModelEnsemble(object):
+    """Runs the models of an ensemble on shared inputs, with in-graph averaging of their scores.
+
+    The inputs of a batch are built once, all models are fed from them and
+    evaluated in the same session run.
+    """
 
 
     def __init__(self, sess, models):
@@ -29,9 +145,22 @@ class ModelEnsemble(object):
         self._sess = sess
         self._models = models
         self._intermediate_results = {}
+        self._feed_dict = None
+        self._beam_search_outputs = {}
 
         assert self._models[0].start_output_unit == "sigmoid"
 
+        if len(self._models) == 1:
+            # Same as below, without adding ops to the graph for every new decoder
+            self._start_probs = self._models[0].start_probs
+            self._end_probs = self._models[0].end_probs
+        else:
+            with tf.device(self._models[0]._device0), tf.name_scope("ensemble"):
+                start_scores = tf.add_n([model.start_scores for model in self._models]) / len(self._models)
+                self._start_probs = tf.sigmoid(start_scores)
+                end_scores = tf.add_n([model.end_scores for model in self._models]) / len(self._models)
+                self._end_probs = tf.nn.softmax(end_scores)
+
 
     def set_eval(self):
 
@@ -39,47 +168,40 @@ class ModelEnsemble(object):
             model.set_eval(self._sess)
 
 
-    def get_start_probs(self, qa_settings):
+    def get_feed_dict(self, qa_settings):
+        """Feed dict of all models, their inputs are built once."""
 
-        # Should be the same across models
-        context_partition = None
+        inputs = build_inputs(qa_settings)
+        feed_dict = {}
+        for model in self._models:
+            feed_dict.update(model.get_feed_dict(qa_settings, inputs))
+        return feed_dict
 
-        # Added across models
-        start_scores = None
 
-        for model in self._models:
+    def get_start_probs(self, qa_settings):
 
-            context_partition, matched_output, question_representation, model_start_scores = \
-                self._sess.run([model.context_partition,
-                                model.matched_output,
-                                model.question_representation,
-                                model.start_scores], model.get_feed_dict(qa_settings))
+        intermediate_tensors = [tensor for model in self._models
+                                for tensor in [model.matched_output, model.question_representation]]
 
-            self._intermediate_results[model] = {
-                model.matched_output: matched_output,
-                model.question_representation: question_representation,
-            }
+        # Reused when computing the end probs
+        self._feed_dict = self.get_feed_dict(qa_settings)
 
-            if start_scores is None:
-                start_scores = model_start_scores
-            else:
-                start_scores += model_start_scores
+        results = self._sess.run([self._models[0].context_partition, self._start_probs] + intermediate_tensors,
+                                 self._feed_dict)
+        context_partition, start_probs = results[:2]
 
-        # Average start scores
-        start_scores /= len(self._models)
-        start_probs = 1 / (1 + np.exp(-start_scores))
+        # Fed when computing the end probs, so that the encoders do not run again
+        self._intermediate_results = dict(zip(intermediate_tensors, results[2:]))
 
         return context_partition, start_probs
 
 
     def get_end_probs(self, qa_settings, predicted_starts, predicted_contexts):
 
-        end_scores = None
-
+        # The feed dict of the batch from get_start_probs()
+        feed_dict = dict(self._feed_dict)
+        feed_dict.update(self._intermediate_results)
         for model in self._models:
-
-            feed_dict = model.get_feed_dict(qa_settings)
-            feed_dict.update(self._intermediate_results[model])
             feed_dict.update({
                 # TODO: Find out why I need to feed this:
                 model.correct_start_pointer: [],
@@ -87,22 +209,37 @@ class ModelEnsemble(object):
                 model.predicted_answer_starts: predicted_starts,
                 model.answer_context_indices: predicted_contexts,
             })
-            [model_end_scores] = self._sess.run([model.end_scores], feed_dict)
 
-            if end_scores is None:
-                end_scores = model_end_scores
-            else:
-                end_scores += model_end_scores
+        [end_probs] = self._sess.run([self._end_probs], feed_dict)
 
-        # Average end scores
-        end_scores /= len(self._models)
+        return end_probs
 
-        # Compute softmax
-        end_scores -= end_scores.max(axis=1).reshape([-1, 1])
-        end_scores_exp = np.exp(end_scores)
-        end_probs = end_scores_exp / end_scores_exp.sum(axis=1).reshape([-1, 1])
 
-        return end_probs
+    def add_beam_search(self, beam_size):
+        """
+        Adds a beam search decoding head for the ensemble to the graph, see
+        ExtractionQAModel.add_beam_search(). The end scores of the models are
+        averaged in the graph.
+        :return: (contexts, starts, ends, probs), each a [num_questions, beam_size] tensor.
+        """
+
+        if len(self._models) == 1:
+            return self._models[0].add_beam_search(beam_size)
+
+        if beam_size not in self._beam_search_outputs:
+
+            def end_scores_fn(starts, contexts):
+                end_scores = []
+                for model in self._models:
+                    with tf.variable_scope(model._pointer_scope, reuse=True):
+                        end_scores.append(model._eval_end_scores(starts, contexts))
+                return tf.add_n(end_scores) / len(self._models)
+
+            with tf.device(self._models[0]._device0), tf.name_scope("ensemble"):
+                self._beam_search_outputs[beam_size] = beam_search_head(
+                    self._start_probs, self._models[0].context_partition, end_scores_fn, beam_size)
+
+        return self._beam_search_outputs[beam_size]
 
 
 
@@ -110,15 +247,25 @@ class BeamSearchDecoder(object):
     """From a QASetting batch, computes most likely (start, end) pairs via beam search."""
 
 
-    def __init__(self, sess, model_or_models, beam_size):
+    def __init__(self, sess, model_or_models, beam_size, in_graph=False):
+        """
+        :param sess: Session.
+        :param model_or_models: ExtractionQAModel or list of models.
+        :param beam_size: Beam size.
+        :param in_graph: If true, decodes with a beam search head in the graph
+                (see ModelEnsemble.add_beam_search()), i.e. a batch is decoded in
+                a single session run. The results then have no start_probs & end_probs.
+        """
 
         self._sess = sess
-        if isinstance(model_or_models, list):
-            self._model_ensemble = ModelEnsemble(sess, model_or_models)
-        else:
-            self._model_ensemble = ModelEnsemble(sess, [model_or_models])
+        models = model_or_models if isinstance(model_or_models, list) else [model_or_models]
+        self._model_ensemble = ModelEnsemble(sess, models)
         self._beam_size = beam_size
 
+        self._in_graph_outputs = None
+        if in_graph:
+            self._in_graph_outputs = self._model_ensemble.add_beam_search(beam_size)
+
 
     def decode(self, qa_settings):
         """For each QASetting, finds most likely (start, end) pairs via beam search.
@@ -129,6 +276,9 @@ class BeamSearchDecoder(object):
 
         self._model_ensemble.set_eval()
 
+        if self._in_graph_outputs is not None:
+            return self._decode_in_graph(qa_settings)
+
         context_partition, start_probs = self._model_ensemble.get_start_probs(qa_settings)
 
         num_questions = context_partition[-1] + 1
@@ -158,6 +308,22 @@ class BeamSearchDecoder(object):
                                         end_probs=end_probs[i])
                 for i in range(num_questions)]
 
+    def _decode_in_graph(self, qa_settings):
+
+        contexts, starts, ends, probs = self._sess.run(
+            self._in_graph_outputs, self._model_ensemble.get_feed_dict(qa_settings))
+
+        assert len(contexts) == len(qa_settings)
+
+        return [BeamSearchDecoderResult(context_indices=contexts[i],
+                                        starts=starts[i],
+                                        ends=ends[i],
+                                        probs=probs[i],
+                                        start_probs=None,
+                                        end_probs=None)
+                for i in range(len(qa_settings))]
+
+
     def _compute_top_starts(self, start_probs, context_partition):
         """
         Computes the top starts from a start_probs matrix.
@@ -225,33 +391,7 @@ class BeamSearchDecoder(object):
         :return: rows, cols, values, all shape [num_partitions, beam_size] arrays.
         """
 
-        if partition is None:
-            partition = np.arange(len(values))
-
-        num_partitions = partition[-1] + 1
-        num_values = min(self._beam_size, values.shape[1])
-
-        rows = np.zeros([num_partitions, self._beam_size], dtype=np.int64)
-        cols = np.zeros([num_partitions, self._beam_size], dtype=np.int64)
-        top_values = np.zeros([num_partitions, self._beam_size], dtype=np.float32)
-
-        for p in range(num_partitions):
-
-            # Collect values
-            current_values = values[partition == p]
-            n_rows, n_cols = current_values.shape
-            values_indices = [(current_values[row, col], row, col)
-                              for row in range(n_rows)
-                              for col in range(n_cols)]
-
-            # Sort by values descending
-            values_indices = sorted(values_indices,
-                                    key=lambda v: -v[0])[:self._beam_size]
-
-            # Unpack
-            top_values[p][:num_values], rows[p][:num_values], cols[p][:num_values] = zip(*values_indices)
-
-        return rows, cols, top_values
+        return top_k_2d(values, self._beam_size, partition)
 
 
     def _gather_rowwise(self, values, indices):
@@ -264,12 +404,7 @@ class BeamSearchDecoder(object):
                 result[r, c] = values[r, indices[r, c]].
         """
 
-        result = np.zeros(indices.shape, dtype=values.dtype)
-
-        for row in range(len(indices)):
-            result[row,:] = values[row, indices[row]]
-
-        return result
+        return np.take_along_axis(values, indices, axis=1)
 
 
     def _context_index_to_batch_index(self, contexts, qa_settings):
@@ -8,13 +8,168 @@ Learning to read, unsupervised
 """
 import tensorflow as tf
 import numpy as np
+import hashlib
 import math
+import os
 import pickle
 
 from biomedical_qa import tfutil
 from biomedical_qa.models.model import ConfigurableModel
 
 
+# Embedding matrices by embeddings_config path, loaded once per process
+_loaded_embeddings = {}
+
+# (vocab, embeddings) pairs of the embedders created by share_embeddings()
+_shared_embeddings = []
+
+# In-graph embedding matrices by (graph, embeddings) ids, see _get_graph_embeddings()
+_graph_embeddings = {}
+
+
+def load_embeddings(path):
+    """
+    Loads an embedding matrix, the result is shared by all calls with the same path.
+    :param path: Pickled matrix, or .npy file which is memory-mapped read-only.
+    :return: [vocab_size, size] array.
+    """
+
+    path = os.path.abspath(path)
+    if path not in _loaded_embeddings:
+        if path.endswith(".npy"):
+            _loaded_embeddings[path] = np.load(path, mmap_mode="r")
+        else:
+            with open(path, "rb") as f:
+                _loaded_embeddings[path] = pickle.load(f)
+    return _loaded_embeddings[path]
+
+
+def share_embeddings(config, cache_dir=None):
+    """
+    Replaces the embedding matrices in the ConstantWordEmbedder configs within a
+    model config by equal matrices (same vocab & values) that earlier calls have
+    seen, so that the models of an ensemble share one matrix instead of each
+    holding its own unpickled copy. Configs with an embeddings_config share the
+    matrix via load_embeddings().
+    :param config: Model config, changed in place.
+    :param cache_dir: Optional. Directory to write new matrices to as .npy files,
+            the matrices are then used memory-mapped read-only.
+    :return: config
+    """
+
+    for c in _constant_word_configs(config):
+        if "embeddings_config" not in c:
+            c["embeddings"] = _get_shared_embeddings(c["vocab"], c["embeddings"], cache_dir)
+    return config
+
+
+def use_in_graph_lookup(config):
+    """
+    Makes the ConstantWordEmbedders of a model config look up their embeddings in
+    the graph, see ConstantWordEmbedder. Their matrices need to be loaded into the
+    session via initialize_embeddings().
+    :param config: Model config, changed in place.
+    :return: config
+    """
+
+    for c in _constant_word_configs(config):
+        c["in_graph_lookup"] = True
+    return config
+
+
+def initialize_embeddings(sess):
+    """Loads the embedding matrices of in-graph lookups that are not initialized yet into the session."""
+
+    for embeddings, variable, placeholder, is_initialized in _graph_embeddings.values():
+        if variable.graph is sess.graph and not sess.run(is_initialized):
+            sess.run(variable.initializer, feed_dict={placeholder: embeddings})
+
+
+def _get_graph_embeddings(embeddings):
+    """Returns the (non-trainable) variable of an embedding matrix, one per matrix & graph."""
+
+    graph = tf.get_default_graph()
+    key = (id(graph), id(embeddings))
+    if key not in _graph_embeddings:
+        # Initialized from a placeholder, as constants > 2GB do not fit in a GraphDef
+        with tf.device("/cpu:0"), tf.name_scope("shared_embeddings"):
+            placeholder = tf.placeholder(tf.float32, embeddings.shape, "embedding_matrix_init")
+            variable = tf.Variable(placeholder, trainable=False, collections=[], name="embedding_matrix")
+            is_initialized = tf.is_variable_initialized(variable)
+        _graph_embeddings[key] = (embeddings, variable, placeholder, is_initialized)
+    return _graph_embeddings[key][1]
+
+
+def lookup_embeddings(embeddings, inputs, seq_lengths):
+    """
+    Looks up the embeddings of a batch, see ConstantWordEmbedder.get_feed_dict().
+    :param embeddings: [vocab_size, size] matrix.
+    :param inputs: [batch_size, >= max_length] array or list of sequences of ids.
+    :param seq_lengths: [batch_size] lengths.
+    :return: [batch_size, max_length, size] float32 array, zero after each sequence's length.
+    """
+
+    seq_lengths = np.asarray(seq_lengths)
+    max_length = np.max(seq_lengths)
+    is_padding = np.arange(max_length) >= seq_lengths.reshape([-1, 1])
+
+    if isinstance(inputs, np.ndarray):
+        ids = np.where(is_padding, 0, inputs[:, :max_length])
+    else:
+        ids = np.zeros(is_padding.shape, dtype=np.int64)
+        for i, sequence in enumerate(inputs):
+            ids[i, :seq_lengths[i]] = sequence[:seq_lengths[i]]
+
+    embedded = np.asarray(embeddings)[ids].astype(np.float32, copy=False)
+    embedded[is_padding] = 0.0
+    return embedded
+
+
+def _constant_word_configs(config):
+
+    if isinstance(config, list):
+        for c in config:
+            yield from _constant_word_configs(c)
+    elif isinstance(config, dict):
+        if config.get("type") == "constant_word":
+            yield config
+        else:
+            for c in config.values():
+                if isinstance(c, (dict, list)):
+                    yield from _constant_word_configs(c)
+
+
+def clear_shared_embeddings():
+    """Forgets the matrices of load_embeddings() & share_embeddings(), later calls load them again."""
+
+    _loaded_embeddings.clear()
+    del _shared_embeddings[:]
+
+
+def _get_shared_embeddings(vocab, embeddings, cache_dir):
+
+    embeddings = np.asarray(embeddings)
+    for shared_vocab, shared_embeddings in _shared_embeddings:
+        if shared_embeddings.shape == embeddings.shape and shared_embeddings.dtype == embeddings.dtype \
+                and shared_vocab == vocab and np.array_equal(shared_embeddings, embeddings):
+            return shared_embeddings
+
+    if cache_dir is not None:
+        key = hashlib.sha1(embeddings.tobytes())
+        key.update(pickle.dumps(sorted(vocab.items())))
+        path = os.path.join(cache_dir, "embeddings_%s.npy" % key.hexdigest())
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                np.save(f, embeddings)
+            os.replace(tmp_path, path)
+        embeddings = load_embeddings(path)
+
+    _shared_embeddings.append((vocab, embeddings))
+    return embeddings
+
+
 class Embedder(ConfigurableModel):
     def __init__(self, size, vocab_size, vocab, name="Embedder", reuse=False):
         self.vocab = vocab
@@ -39,7 +194,13 @@ class Embedder(ConfigurableModel):
         """
         raise NotImplementedError()
 
-    def get_feed_dict(self, inputs, seq_lengths):
+    def get_feed_dict(self, inputs, seq_lengths, lookups=None):
+        """
+        :param inputs: [batch_size, max_length] ids.
+        :param seq_lengths: [batch_size] lengths.
+        :param lookups: Optional. dict shared by the embedders that are fed the
+                same batch, to reuse embedding lookups between them.
+        """
         return None
 
     @property
@@ -140,7 +301,7 @@ class WordEmbedder(Embedder):
     def word_embeddings(self):
         return self._embedding_matrix
 
-    def get_feed_dict(self, inputs, seq_lengths):
+    def get_feed_dict(self, inputs, seq_lengths, lookups=None):
         feed_dict = dict()
         feed_dict[self._inputs] = inputs
         feed_dict[self._seq_lengths] = seq_lengths
@@ -207,11 +368,17 @@ class WordEmbedder(Embedder):
 
 
 class ConstantWordEmbedder(WordEmbedder):
+    """Embeds words with a fixed matrix. By default the embedded words are looked up
+    on the host and fed, with in_graph_lookup the matrix is a (non-trainable) graph
+    variable, shared by all embedders with the same matrix, and only the ids are fed.
+    """
 
     def __init__(self, size, vocab, unk_id, embeddings, name="Embedder",
-                 reuse=False, inputs=None, seq_lengths=None, embeddings_config=None):
+                 reuse=False, inputs=None, seq_lengths=None, embeddings_config=None,
+                 in_graph_lookup=False):
         self._embeddings = embeddings
         self.embeddings_config = embeddings_config
+        self._in_graph_lookup = in_graph_lookup
         super().__init__(size, len(vocab), vocab, unk_id, name, reuse, inputs, seq_lengths)
 
     def _init(self):
@@ -225,30 +392,39 @@ class ConstantWordEmbedder(WordEmbedder):
                 self._max_length = tf.cast(tf.reduce_max(self.seq_lengths), tf.int32)
                 self._batch_size = tf.shape(self.seq_lengths)[0]
                 self._sliced_inputs = tf.slice(inputs, (0, 0), tf.stack((-1, self.max_length)))
-                self._embedded_words = tf.placeholder(tf.float32, [None, None, self.size], "embedded_words")
+                if self._in_graph_lookup:
+                    embedded_words = tf.nn.embedding_lookup(_get_graph_embeddings(self._embeddings),
+                                                            self._sliced_inputs)
+                    # Padding is zero, as when fed
+                    mask = tfutil.mask_for_lengths(self.seq_lengths, self._batch_size, self.max_length,
+                                                   mask_right=False, value=1.0)
+                    self._embedded_words = embedded_words * tf.expand_dims(mask, 2)
+                else:
+                    self._embedded_words = tf.placeholder(tf.float32, [None, None, self.size], "embedded_words")
                 dummy_variable = tf.get_variable("dummy", dtype=tf.float32, initializer=0.0)
         self._train_variables = [dummy_variable]
 
-    def get_feed_dict(self, inputs, seq_lengths):
-        feed_dict = super().get_feed_dict(inputs, seq_lengths)
+    def get_feed_dict(self, inputs, seq_lengths, lookups=None):
+        feed_dict = super().get_feed_dict(inputs, seq_lengths, lookups)
+        if self._in_graph_lookup:
+            return feed_dict
 
-        if isinstance(inputs, list):
-            batch_size = len(inputs)
-            max_l = max(seq_lengths)
+        # Embedders that share their embeddings (see share_embeddings()) look up a batch once
+        key = (id(self._embeddings), id(inputs))
+        if lookups is not None and key in lookups:
+            embedded_inputs = lookups[key]
         else:
-            batch_size = inputs.shape[0]
-            max_l = np.max(seq_lengths)
+            embedded_inputs = lookup_embeddings(self._embeddings, inputs, seq_lengths)
+            if lookups is not None:
+                lookups[key] = embedded_inputs
 
-        embedded_inputs = np.zeros([batch_size, max_l, self.size])
-        for i in range(len(inputs)):
-            for j in range(seq_lengths[i]):
-                embedded_inputs[i, j] = self._embeddings[inputs[i][j]]
         feed_dict[self._embedded_words] = embedded_inputs
         return feed_dict
 
     def clone(self, inputs=None, seq_lengths=None, **kwargs):
         return ConstantWordEmbedder(self.size, self.vocab, self._unk_id, self._embeddings,
-                                    self.name, inputs=inputs, seq_lengths=seq_lengths, reuse=True)
+                                    self.name, inputs=inputs, seq_lengths=seq_lengths, reuse=True,
+                                    in_graph_lookup=self._in_graph_lookup)
 
     def get_config(self):
         config = dict()
@@ -277,8 +453,7 @@ class ConstantWordEmbedder(WordEmbedder):
         # todo: dump config dictionary as json
 
         if "embeddings_config" in config:
-            with open(config["embeddings_config"], "rb") as f:
-                embeddings = pickle.load(f)
+            embeddings = load_embeddings(config["embeddings_config"])
         else:
             embeddings = config["embeddings"]
 
@@ -291,7 +466,8 @@ class ConstantWordEmbedder(WordEmbedder):
             reuse=reuse,
             inputs=inputs,
             seq_lengths=seq_lengths,
-            embeddings_config=config.get("embeddings_config", None)
+            embeddings_config=config.get("embeddings_config", None),
+            in_graph_lookup=config.get("in_graph_lookup", False)
         )
 
         return autoreader
@@ -374,7 +550,7 @@ class CharWordEmbedder(WordEmbedder):
         """
         return self._embedded_words
 
-    def get_feed_dict(self, inputs, seq_lengths):
+    def get_feed_dict(self, inputs, seq_lengths, lookups=None):
         unique_ids = dict()
         new_inputs = list()
         unique_word_idxs = []
@@ -387,7 +563,7 @@ class CharWordEmbedder(WordEmbedder):
                     unique_word_idxs.append(k)
                 new_inputs.append(unique_ids[k])
 
-        feed_dict = super().get_feed_dict(inputs, seq_lengths)
+        feed_dict = super().get_feed_dict(inputs, seq_lengths, lookups)
 
         feed_dict[self._word_to_chars] = self._word_to_chars_arr[unique_word_idxs]
         feed_dict[self._word_lengths] = self._word_lengths_arr[unique_word_idxs]
@@ -484,8 +660,8 @@ class StackedEmbedder(Embedder):
         if hasattr(self, "keep_prob"):
             sess.run(self._keep_prob_assign, feed_dict={self._keep_prob_placeholder: 1.0})
 
-    def get_feed_dict(self, inputs, seq_lengths):
-        return self.underlying.get_feed_dict(inputs, seq_lengths)
+    def get_feed_dict(self, inputs, seq_lengths, lookups=None):
+        return self.underlying.get_feed_dict(inputs, seq_lengths, lookups)
 
     @property
     def max_length(self):
@@ -565,10 +741,10 @@ class ConcatEmbedder(Embedder):
         """
         return self._embedded_words
 
-    def get_feed_dict(self, inputs, seq_lengths):
+    def get_feed_dict(self, inputs, seq_lengths, lookups=None):
         feed_dict = dict()
         for e in self.embedders:
-            feed_dict.update(e.get_feed_dict(inputs, seq_lengths))
+            feed_dict.update(e.get_feed_dict(inputs, seq_lengths, lookups))
         return feed_dict
 
     @property
@@ -1,5 +1,7 @@
+import numpy as np
 import tensorflow as tf
 
+from biomedical_qa.models import TAG_WORDS
 from biomedical_qa.models.embedder import Embedder
 from biomedical_qa.models.model import ConfigurableModel
 
@@ -7,6 +9,83 @@ from biomedical_qa.models.model import ConfigurableModel
 NUM_ENTITY_TAGS = 128
 
 
+def pad_sequences(sequences, dtype=np.int64):
+    """
+    Copies ragged sequences into a zero-padded matrix.
+    :param sequences: list of sequences (lists or 1D arrays) of ids.
+    :return: ([len(sequences), max_length] padded array, [len(sequences)] int64 lengths)
+    """
+    lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+    max_length = lengths.max() if len(lengths) else 0
+    padded = np.zeros([len(sequences), max_length], dtype=dtype)
+    if lengths.sum() > 0:
+        mask = np.arange(max_length) < lengths[:, None]
+        padded[mask] = np.concatenate([np.asarray(s, dtype=dtype) for s in sequences])
+    return padded, lengths
+
+
+def build_tag_bytes(tag_bits_list, max_length):
+    """
+    Builds the tag features of a batch by copying the packed tags, which are unpacked in the graph.
+    :param tag_bits_list: list of packed tags (see biomedical_qa.models.pack_tags), one per sequence.
+    :param max_length: Number of tokens to pad the sequences to.
+    :return: [len(tag_bits_list), max_length, 8 * TAG_WORDS] uint8 array, bit j of byte k
+            of a token is set iff the token has tag 8 * k + j.
+    """
+    assert 64 * TAG_WORDS == NUM_ENTITY_TAGS
+    # Little endian words, so that the bytes of a token's bitmask are in tag order
+    words = np.zeros([len(tag_bits_list), max_length * TAG_WORDS], dtype="<u8")
+    for i, bits in enumerate(tag_bits_list):
+        num_words = min(len(bits), max_length * TAG_WORDS)
+        if num_words > 0:
+            words[i, :num_words] = np.frombuffer(bits, dtype=np.uint64, count=num_words)
+    return words.view(np.uint8).reshape([len(tag_bits_list), max_length, 8 * TAG_WORDS])
+
+
+def build_inputs(qa_settings):
+    """
+    Computes the model independent inputs of a batch, see ExtractionQAModel.get_feed_dict().
+    :param qa_settings: List of QASetting objects.
+    :return: dict of input name to np array, and "embedding_lookups", a dict for
+            the embedders to share lookups in (see Embedder.get_feed_dict()).
+    """
+    num_contexts = [len(s.contexts) for s in qa_settings]
+    assert all(n > 0 for n in num_contexts)
+
+    question, question_length = pad_sequences([s.question for s in qa_settings])
+    context, context_length = pad_sequences([c for s in qa_settings for c in s.contexts])
+    context_partition = np.repeat(np.arange(len(qa_settings), dtype=np.int64), num_contexts)
+
+    question_tag_bytes = build_tag_bytes([s.question_tag_bits for s in qa_settings], question.shape[1])
+    context_tag_bytes = build_tag_bytes([bits for s in qa_settings for bits in s.contexts_tag_bits],
+                                        context.shape[1])
+
+    # Padding positions are included, i.e. a padded 0 counts as question word if the question contains id 0
+    is_q_word = np.zeros(context.shape, dtype=np.float32)
+    context_start = 0
+    for qa_setting, n in zip(qa_settings, num_contexts):
+        is_q_word[context_start:context_start + n] = np.isin(
+            context[context_start:context_start + n], qa_setting.question)
+        context_start += n
+
+    q_types = np.array([s.q_type for s in qa_settings], dtype=object)
+
+    return {
+        "question": question,
+        "question_length": question_length,
+        "context": context,
+        "context_length": context_length,
+        "context_partition": context_partition,
+        "is_list": q_types == "list",
+        "is_factoid": q_types == "factoid",
+        "is_yesno": q_types == "yesno",
+        "question_tag_bytes": question_tag_bytes,
+        "context_tag_bytes": context_tag_bytes,
+        "word_in_question": is_q_word,
+        "embedding_lookups": {},
+    }
+
+
 class QAModel(ConfigurableModel):
 
     def __init__(self, size, transfer_model, keep_prob, name="QAModel", reuse=False):
@@ -99,9 +178,11 @@ class ExtractionQAModel(QAModel):
             self._is_list = tf.placeholder(tf.bool, [None], "is_list")
             self._is_yesno = tf.placeholder(tf.bool, [None], "is_yesno")
 
-            # Tag features
-            self._question_tags = tf.placeholder(tf.bool, [None, None, NUM_ENTITY_TAGS], "question_tags")
-            self._context_tags = tf.placeholder(tf.bool, [None, None, NUM_ENTITY_TAGS], "context_tags")
+            # Tag features, fed as the bytes of the packed tag bitmasks
+            self._question_tag_bytes = tf.placeholder(tf.uint8, [None, None, 8 * TAG_WORDS], "question_tag_bytes")
+            self._context_tag_bytes = tf.placeholder(tf.uint8, [None, None, 8 * TAG_WORDS], "context_tag_bytes")
+            self._question_tags = self._unpack_tags(self._question_tag_bytes)
+            self._context_tags = self._unpack_tags(self._context_tag_bytes)
 
             # Maps context index to question index
             self.context_partition = tf.placeholder(tf.int64, [None], "context_partition")
@@ -110,6 +191,9 @@ class ExtractionQAModel(QAModel):
             self.correct_start_pointer = tf.placeholder(tf.int64, [None], "correct_start_pointer")
             self.answer_context_indices = tf.placeholder(tf.int64, [None], "answer_context_indices")
 
+            # Beam search heads by beam size, see add_beam_search()
+            self._beam_search_outputs = {}
+
             with tf.variable_scope("embeddings"):
                 # embeddings
                 self._batch_size = self.embedder.batch_size
@@ -122,6 +206,15 @@ class ExtractionQAModel(QAModel):
                 self._embedded_question_not_dropped = embedded_question
                 self._embedded_context_not_dropped = embedded_context
 
+    def _unpack_tags(self, tag_bytes):
+        """Unpacks [B, T, 8 * TAG_WORDS] tag bytes (see build_tag_bytes) into a [B, T, NUM_ENTITY_TAGS] bool tensor."""
+        # Bit j of a byte is (byte // 2^j) mod 2, there are no bitwise ops in this TF version
+        bit_values = tf.constant([1 << j for j in range(8)], dtype=tf.int32)
+        bits = tf.mod(tf.floordiv(tf.expand_dims(tf.cast(tag_bytes, tf.int32), -1), bit_values), 2)
+        shape = tf.shape(tag_bytes)
+        bits = tf.reshape(bits, [shape[0], shape[1], NUM_ENTITY_TAGS])
+        return tf.not_equal(bits, 0)
+
     def set_top_k(self, sess, k):
         return sess.run(self._set_top_k, feed_dict={self._top_k_placeholder:k})
 
@@ -150,68 +243,54 @@ class ExtractionQAModel(QAModel):
     def predicted_lengths(self):
         return self.predicted_answer_ends - self.predicted_answer_starts + 1
 
-    def get_feed_dict(self, qa_settings):
-        question = []
-        question_length = []
-
-        context = []
-        context_length = []
-
-        is_q_word = []
-
-        is_factoid = []
-        is_list = []
-        is_yesno = []
-
-        question_tags = []
-        context_tags = []
-
-        context_partition = []
-
-        max_q_length = max([len(s.question) for s in qa_settings])
-        max_c_length = max([len(c) for s in qa_settings for c in s.contexts])
-        for i, qa_setting in enumerate(qa_settings):
-            question.append(qa_setting.question + [0] * (max_q_length - len(qa_setting.question)))
-            question_tags.append(self._build_tags_array(qa_setting.question_tags)
-                                 + [[0] * NUM_ENTITY_TAGS] * (max_q_length - len(qa_setting.question)))
-            question_length.append(len(qa_setting.question))
-
-            is_factoid.append(qa_setting.q_type == "factoid")
-            is_list.append(qa_setting.q_type == "list")
-            is_yesno.append(qa_setting.q_type == "yesno")
-
-            assert len(qa_setting.contexts) > 0
-            for c, tags in zip(qa_setting.contexts, qa_setting.contexts_tags):
-                context.append(c + [0] * (max_c_length - len(c)))
-                context_tags.append(self._build_tags_array(tags)
-                                    + [[0] * NUM_ENTITY_TAGS] * (max_c_length - len(c)))
-                is_q_word.append([1.0 if w in qa_setting.question else 0.0 for w in context[-1]])
-                context_length.append(len(c))
-                context_partition.append(i)
+    def add_beam_search(self, beam_size):
+        """
+        Adds a beam search decoding head to the graph, which computes the top
+        (start, end) spans of a batch like BeamSearchDecoder, within a single
+        session run. Requires the pointer layer to set self._pointer_scope and
+        self._eval_end_scores(start_pointer, answer_context_indices), which
+        computes the (evaluation) end scores for each start.
+        :param beam_size: Beam size.
+        :return: (contexts, starts, ends, probs), each a [num_questions, beam_size]
+                tensor, see BeamSearchDecoder.decode(). contexts are indices within
+                the question's contexts.
+        """
+
+        from biomedical_qa.models.beam_search import beam_search_head
+
+        if beam_size in self._beam_search_outputs:
+            return self._beam_search_outputs[beam_size]
+
+        with tf.device(self._device0), tf.variable_scope(self._pointer_scope, reuse=True):
+            outputs = beam_search_head(self.start_probs, self.context_partition,
+                                       self._eval_end_scores, beam_size)
+
+        self._beam_search_outputs[beam_size] = outputs
+        return outputs
+
+    def get_feed_dict(self, qa_settings, inputs=None):
+        """
+        :param qa_settings: List of QASetting objects.
+        :param inputs: Optional. build_inputs(qa_settings), pass it to share the
+                inputs between models that are fed the same batch.
+        """
+        if inputs is None:
+            inputs = build_inputs(qa_settings)
 
         feed_dict = dict()
-        feed_dict[self.context_partition] = context_partition
-        feed_dict[self._is_list] = is_list
-        feed_dict[self._is_factoid] = is_factoid
-        feed_dict[self._is_yesno] = is_yesno
-        feed_dict[self._question_tags] = question_tags
-        feed_dict[self._context_tags] = context_tags
-        feed_dict.update(self.embedder.get_feed_dict(context, context_length))
-        feed_dict.update(self.question_embedder.get_feed_dict(question, question_length))
-        feed_dict[self._word_in_question] = is_q_word
+        feed_dict[self.context_partition] = inputs["context_partition"]
+        feed_dict[self._is_list] = inputs["is_list"]
+        feed_dict[self._is_factoid] = inputs["is_factoid"]
+        feed_dict[self._is_yesno] = inputs["is_yesno"]
+        feed_dict[self._question_tag_bytes] = inputs["question_tag_bytes"]
+        feed_dict[self._context_tag_bytes] = inputs["context_tag_bytes"]
+        feed_dict.update(self.embedder.get_feed_dict(inputs["context"], inputs["context_length"],
+                                                     inputs["embedding_lookups"]))
+        feed_dict.update(self.question_embedder.get_feed_dict(inputs["question"], inputs["question_length"],
+                                                              inputs["embedding_lookups"]))
+        feed_dict[self._word_in_question] = inputs["word_in_question"]
 
         return feed_dict
 
-    def _build_tags_array(self, tags):
-        result = [[False for _ in range(NUM_ENTITY_TAGS)]
-                  for _ in tags]
-
-        for token, token_tags in enumerate(tags):
-            for tag in token_tags:
-                assert tag < NUM_ENTITY_TAGS
-                result[token][tag] = True
-
-        return result
-
     def run(self, sess, goal, qa_settings):
         return sess.run(goal, feed_dict=self.get_feed_dict(qa_settings))
@@ -88,7 +88,8 @@ class QAPointerModel(ExtractionQAModel):
                         self.encoded_question, self.encoded_ctxt,
                         cell_constructor)
 
-                with tf.variable_scope("pointer_layer"):
+                with tf.variable_scope("pointer_layer") as pointer_scope:
+                    self._pointer_scope = pointer_scope
                     if self._answer_layer_type == "spn":
                         self.predicted_context_indices, \
                         self._start_scores, self._start_pointer, self.start_probs, \
@@ -178,26 +179,37 @@ class QAPointerModel(ExtractionQAModel):
         # There will be an end pointer prediction for each start pointer.
         starts = tf.gather(starts, self.context_partition)
         starts = tf.gather(starts, self.answer_context_indices)
-        question_state = tf.gather(question_state, self.answer_context_indices)
-        context_states = tf.gather(context_states, self.answer_context_indices)
-        offsets = tf.gather(offsets, self.answer_context_indices)
-        context_lengths = tf.gather(self.context_length, self.answer_context_indices)
 
         start_pointer = tf.cond(self._eval,
                                 lambda: starts,
                                 lambda: self.correct_start_pointer)
-        u_s = tf.gather(context_states_flat, start_pointer + offsets)
-
-        with tf.variable_scope("end"):
-            end_input = tf.concat(axis=1, values=[u_s, question_state])
-            end_scores = hmn(end_input, context_states, context_lengths)
-
-        # Mask end scores for evaluation
-        masked_end_scores = end_scores + tfutil.mask_for_lengths(
-            start_pointer, mask_right=False, max_length=self.embedder.max_length + 1)
-        masked_end_scores = masked_end_scores + tfutil.mask_for_lengths(
-            start_pointer + MAX_ANSWER_LENGTH_HEURISTIC + 1,
-            max_length=self.embedder.max_length + 1)
+
+        def end_layer(start_pointer, answer_context_indices):
+            # End scores for each (start pointer, context) pair
+            answer_question_state = tf.gather(question_state, answer_context_indices)
+            answer_context_states = tf.gather(context_states, answer_context_indices)
+            answer_offsets = tf.gather(offsets, answer_context_indices)
+            answer_context_lengths = tf.gather(self.context_length, answer_context_indices)
+
+            u_s = tf.gather(context_states_flat, start_pointer + answer_offsets)
+
+            with tf.variable_scope("end"):
+                end_input = tf.concat(axis=1, values=[u_s, answer_question_state])
+                return hmn(end_input, answer_context_states, answer_context_lengths)
+
+        def mask_end_scores(end_scores, start_pointer):
+            # Mask end scores for evaluation
+            masked_end_scores = end_scores + tfutil.mask_for_lengths(
+                start_pointer, mask_right=False, max_length=self.embedder.max_length + 1)
+            return masked_end_scores + tfutil.mask_for_lengths(
+                start_pointer + MAX_ANSWER_LENGTH_HEURISTIC + 1,
+                max_length=self.embedder.max_length + 1)
+
+        end_scores = end_layer(start_pointer, self.answer_context_indices)
+        masked_end_scores = mask_end_scores(end_scores, start_pointer)
+        # Used by the beam search head
+        self._eval_end_scores = lambda start_pointer, answer_context_indices: \
+            mask_end_scores(end_layer(start_pointer, answer_context_indices), start_pointer)
         end_scores = tf.cond(self._eval,
                              lambda: masked_end_scores,
                              lambda: end_scores)
@@ -181,7 +181,8 @@ class QASimplePointerModel(ExtractionQAModel):
             # No matching layer, so set matched_output to encoded_ctxt (for compatibility)
             self.matched_output = self.encoded_ctxt
 
-            with tf.variable_scope("pointer_layer"):
+            with tf.variable_scope("pointer_layer") as pointer_scope:
+                self._pointer_scope = pointer_scope
                 self.predicted_context_indices, \
                 self._start_scores, self._start_pointer, self.start_probs, \
                 self._end_scores, self._end_pointer, self.end_probs = \
@@ -277,38 +278,46 @@ class QASimplePointerModel(ExtractionQAModel):
         # There will be an end pointer prediction for each start pointer.
         starts = tf.gather(starts, self.context_partition)
         starts = tf.gather(starts, self.answer_context_indices)
-        question_state = tf.gather(question_state, self.answer_context_indices)
-        context_states = tf.gather(context_states, self.answer_context_indices)
-        start_input = tf.gather(start_input, self.answer_context_indices)
-        offsets = tf.gather(offsets, self.answer_context_indices)
-        context_mask = tf.gather(self.context_mask, self.answer_context_indices)
 
         start_pointer = tf.cond(self._eval,
                                 lambda: starts,
                                 lambda: self.correct_start_pointer)
 
-        u_s = tf.gather(context_states_flat, start_pointer + offsets)
-
-        #END
-        end_input = tf.concat(axis=2, values=[tf.expand_dims(u_s, 1) * context_states, start_input])
-
-        q_end_inter = tf.contrib.layers.fully_connected(tf.concat(axis=1, values=[question_state, u_s]), self.size,
-                                                        activation_fn=None,
-                                                        weights_initializer=None,
-                                                        scope="q_end_inter")
-
-        q_end_state = tf.contrib.layers.fully_connected(end_input, self.size,
-                                                        activation_fn=None,
-                                                        weights_initializer=None,
-                                                        scope="q_end") + tf.expand_dims(q_end_inter, 1)
-
-        end_scores = tf.contrib.layers.fully_connected(tf.nn.relu(q_end_state), 1,
-                                                       activation_fn=None,
-                                                       weights_initializer=None,
-                                                       biases_initializer=None,
-                                                       scope="end_scores")
-        end_scores = tf.squeeze(end_scores, [2])
-        end_scores = end_scores + context_mask
+        def end_layer(start_pointer, answer_context_indices):
+            # End scores for each (start pointer, context) pair
+            answer_question_state = tf.gather(question_state, answer_context_indices)
+            answer_context_states = tf.gather(context_states, answer_context_indices)
+            answer_start_input = tf.gather(start_input, answer_context_indices)
+            answer_offsets = tf.gather(offsets, answer_context_indices)
+            answer_context_mask = tf.gather(self.context_mask, answer_context_indices)
+
+            u_s = tf.gather(context_states_flat, start_pointer + answer_offsets)
+
+            #END
+            end_input = tf.concat(axis=2, values=[tf.expand_dims(u_s, 1) * answer_context_states, answer_start_input])
+
+            q_end_inter = tf.contrib.layers.fully_connected(tf.concat(axis=1, values=[answer_question_state, u_s]),
+                                                            self.size,
+                                                            activation_fn=None,
+                                                            weights_initializer=None,
+                                                            scope="q_end_inter")
+
+            q_end_state = tf.contrib.layers.fully_connected(end_input, self.size,
+                                                            activation_fn=None,
+                                                            weights_initializer=None,
+                                                            scope="q_end") + tf.expand_dims(q_end_inter, 1)
+
+            end_scores = tf.contrib.layers.fully_connected(tf.nn.relu(q_end_state), 1,
+                                                           activation_fn=None,
+                                                           weights_initializer=None,
+                                                           biases_initializer=None,
+                                                           scope="end_scores")
+            end_scores = tf.squeeze(end_scores, [2])
+            return end_scores + answer_context_mask
+
+        end_scores = end_layer(start_pointer, self.answer_context_indices)
+        # Used by the beam search head
+        self._eval_end_scores = end_layer
         ends = tf.argmax(end_scores, axis=1)
         end_probs = tf.nn.softmax(end_scores)
 
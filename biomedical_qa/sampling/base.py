@@ -1,22 +1,27 @@
 import random
 import abc
 
-from nltk.tokenize import RegexpTokenizer
+from biomedical_qa.data.tokenizer import Tokenizer
 
 
 class BaseSampler:
 
-    def __init__(self, batch_size, vocab, instances_per_epoch=None, shuffle=True):
-        self.__batch_size = batch_size
-        self.unk_id = vocab["<UNK>"]
-        self.start_id = vocab["<S>"]
-        self.end_id = vocab["</S>"]
-        self.vocab = vocab
-        self.instances_per_epoch = instances_per_epoch
-        self.num_batches = 0
-        self.epoch = 0
-        self._rng = random.Random(28739)
-        self.tokenizer = RegexpTokenizer(r'\w+|[^\w\s]')
+    def __init__(self, batch_size, vocab, instances_per_epoch=None, shuffle=True,
+                 bucket_window=None, max_batch_tokens=None, max_batch_contexts=None):
+        """
+        :param batch_size: Maximum number of questions per batch.
+        :param bucket_window: If set, questions are sorted by their (longest, then
+                total) context length within windows of bucket_window batches.
+                The resulting batches are shuffled, so epochs stay randomized while
+                less padding is needed.
+        :param max_batch_tokens: If set, batches are cut before their padded
+                context tokens (#contexts * longest context) exceed this budget.
+        :param max_batch_contexts: If set, batches are cut before their number of
+                contexts exceeds this limit.
+        A batch always contains at least one question, even if it exceeds the limits.
+        """
+        self._init_state(batch_size, vocab, instances_per_epoch, bucket_window,
+                         max_batch_tokens, max_batch_contexts)
         self._qas, self.char_offsets = self.build_questions()
 
         assert len(self._qas) > 0
@@ -25,44 +30,137 @@ class BaseSampler:
             self._rng.shuffle(self._qas)
         if instances_per_epoch is not None:
             self._qas = self._qas[:instances_per_epoch]
+        if bucket_window:
+            self._qas = self._bucket(self._qas)
         self._idx = 0
 
 
+    def _init_state(self, batch_size, vocab, instances_per_epoch, bucket_window,
+                    max_batch_tokens, max_batch_contexts):
+        """Initializes the state of all samplers, before any questions are built."""
+
+        self.batch_size = batch_size
+        self.unk_id = vocab["<UNK>"]
+        self.start_id = vocab["<S>"]
+        self.end_id = vocab["</S>"]
+        self.vocab = vocab
+        self.instances_per_epoch = instances_per_epoch
+        self.num_batches = 0
+        self.epoch = 0
+        self.bucket_window = bucket_window
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_contexts = max_batch_contexts
+        self._real_context_tokens = 0
+        self._padded_context_tokens = 0
+        self._rng = random.Random(28739)
+        self.tokenizer = Tokenizer(vocab, self.unk_id)
+
+
     @abc.abstractmethod
     def build_questions(self):
-        """Should return an Array of Questions and a char_offsets map."""
+        """Should return an Array of Questions and a {qa_id -> [int32 array of token char offsets per context]} map."""
         pass
 
 
     def get_ids_and_offsets(self, s):
         idxs = []
         offsets = []
-        offset = 0
-        s_lower = s.lower()
-
-        # Unfortunately it's not always true that len(tokenize(s)) == len(tokenize(s.lower))
-        for t in self.tokenizer.tokenize(s):
-            t = t.lower()
-            offset = s_lower.index(t, offset)
-            offsets.append(offset)
-            i = self.vocab.get(t, self.unk_id)
+
+        # Unfortunately it's not always true that len(tokenize(s)) == len(tokenize(s.lower)),
+        # so s is tokenized and tokens are lower cased. Offsets refer to s.lower().
+        for _, start, _, i in self.tokenizer.tokenize_with_ids(s):
+            offsets.append(start)
             idxs.append(i)
-            offset += len(t)
         return idxs, offsets
 
 
     def get_batch(self):
-        qa_settings = [self._qas[i+self._idx] for i in range(min(self.__batch_size, len(self._qas) - self._idx))]
+        qa_settings = self._qas[self._idx:self._idx + self._next_batch_size()]
         self._idx += len(qa_settings)
 
         if self._idx == len(self._qas):
             self.epoch += 1
             self._rng.shuffle(self._qas)
+            if self.bucket_window:
+                self._qas = self._bucket(self._qas)
             self._idx = 0
 
+        context_lengths = [len(c) for qa_setting in qa_settings for c in qa_setting.contexts]
+        self._real_context_tokens += sum(context_lengths)
+        self._padded_context_tokens += len(context_lengths) * max(context_lengths, default=0)
+
         return qa_settings
 
 
+    def _next_batch_size(self):
+        """Number of questions of the next batch, respecting batch size and token / context budgets."""
+
+        batch_size = min(self.batch_size, len(self._qas) - self._idx)
+        if self.max_batch_tokens is None and self.max_batch_contexts is None:
+            return batch_size
+
+        num_contexts = 0
+        max_context_length = 0
+        for i in range(batch_size):
+            context_lengths = [len(c) for c in self._qas[self._idx + i].contexts]
+            num_contexts += len(context_lengths)
+            max_context_length = max([max_context_length] + context_lengths)
+
+            if i > 0 and self._exceeds_budget(num_contexts, max_context_length):
+                return i
+
+        return batch_size
+
+
+    def _exceeds_budget(self, num_contexts, max_context_length):
+
+        exceeds_tokens = self.max_batch_tokens is not None and \
+                         num_contexts * max_context_length > self.max_batch_tokens
+        exceeds_contexts = self.max_batch_contexts is not None and \
+                           num_contexts > self.max_batch_contexts
+        return exceeds_tokens or exceeds_contexts
+
+
+    def _bucket(self, qas):
+        """Reorders qas such that each batch contains questions of similar total context length."""
+
+        window_size = self.batch_size * self.bucket_window
+        batches = []
+        for window_start in range(0, len(qas), window_size):
+            window = sorted(qas[window_start:window_start + window_size], key=self._context_length_key)
+            batches.extend(window[i:i + self.batch_size]
+                           for i in range(0, len(window), self.batch_size))
+
+        # Only the very last batch can be incomplete, keep it last so that batch boundaries are preserved
+        last_batch = batches.pop() if len(batches[-1]) < self.batch_size else []
+        self._rng.shuffle(batches)
+        batches.append(last_batch)
+
+        return [qa_setting for batch in batches for qa_setting in batch]
+
+
+    @staticmethod
+    def _context_length_key(qa_setting):
+        # Contexts are padded to the longest context of the batch, so group by that first
+        context_lengths = [len(c) for c in qa_setting.contexts]
+        return max(context_lengths, default=0), sum(context_lengths)
+
+
+    @property
+    def padding_efficiency(self):
+        """Fraction of the padded context tokens of all returned batches that are actual tokens."""
+
+        if self._padded_context_tokens == 0:
+            return 1.0
+        return self._real_context_tokens / self._padded_context_tokens
+
+
+    def reset_padding_stats(self):
+
+        self._real_context_tokens = 0
+        self._padded_context_tokens = 0
+
+
     def get_all_batches(self):
 
         self.reset()
@@ -12,7 +12,9 @@ class BioAsqSampler(SQuADSampler):
                  instances_per_epoch=None, shuffle=True, dataset_json=None,
                  types=None, split_contexts_on_newline=False,
                  context_token_limit=-1, include_synonyms=False,
-                 tagger=None, include_answer_spans=True):
+                 tagger=None, include_answer_spans=True, cache_dir=None,
+                 bucket_window=None, max_batch_tokens=None,
+                 max_batch_contexts=None, num_workers=1):
 
         if dataset_json is None:
             # load json
@@ -30,4 +32,8 @@ class BioAsqSampler(SQuADSampler):
                               instances_per_epoch=instances_per_epoch,
                               shuffle=shuffle, types=types,
                               split_contexts_on_newline=split_contexts_on_newline,
-                              dataset_json=squad_json, tagger=tagger)
+                              dataset_json=squad_json, tagger=tagger,
+                              cache_dir=cache_dir, bucket_window=bucket_window,
+                              max_batch_tokens=max_batch_tokens,
+                              max_batch_contexts=max_batch_contexts,
+                              num_workers=num_workers)
@@ -0,0 +1,223 @@
+import hashlib
+import itertools
+import json
+import os
+import shutil
+from array import array
+
+import numpy as np
+
+from biomedical_qa.models import QASetting
+
+# Increase whenever the preprocessing or the cache format changes
+CACHE_VERSION = 2
+
+
+def fingerprint(obj):
+    """SHA1 hex digest of the canonical JSON representation of obj."""
+
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_cache_key(dataset, vocab, tagger, options):
+    """
+    Computes the key under which preprocessed questions are cached.
+    :param dataset: The SQuAD "data" JSON object.
+    :param vocab: The word -> id vocabulary.
+    :param tagger: EntityTagger or None.
+    :param options: JSON serializable dict of sampler options that affect preprocessing.
+    :return: Key string.
+    """
+
+    return fingerprint({
+        "version": CACHE_VERSION,
+        "dataset": fingerprint(dataset),
+        "vocab": fingerprint(sorted(vocab.items(), key=lambda item: item[1])),
+        "tagger": tagger.get_config() if tagger is not None else None,
+        "options": options,
+    })
+
+
+def to_offsets(lengths):
+    """Converts [N] lengths to [N + 1] offsets."""
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def to_ragged(sequences, dtype):
+    """Concatenates sequences to (values, offsets) arrays, sequence i is values[offsets[i]:offsets[i + 1]]."""
+
+    offsets = to_offsets([len(s) for s in sequences])
+    values = np.fromiter(itertools.chain.from_iterable(sequences), dtype=dtype,
+                         count=int(offsets[-1]))
+    return values, offsets
+
+
+class PreprocessingCache(object):
+    """Persists preprocessed QASettings & char offsets as memory-mappable numpy arrays.
+
+    Contexts are stored once per paragraph, all other data once per question.
+    Ragged data (tokens, tags, answers) is stored as (values, offsets) arrays,
+    tags as their packed uint64 words (see biomedical_qa.models.pack_tags).
+    JSON objects are not stored, but referenced by their paragraph / qa index
+    in the dataset.
+    """
+
+
+    def __init__(self, cache_dir, key):
+
+        self.path = os.path.join(cache_dir, key)
+
+
+    def exists(self):
+
+        return os.path.exists(os.path.join(self.path, "meta.json"))
+
+
+    def save(self, paragraphs, qas, char_offsets):
+        """
+        Writes the preprocessed questions to the cache.
+        :param paragraphs: list of all paragraph JSON objects of the dataset.
+        :param qas: list of QASetting objects.
+        :param char_offsets: {qa_id -> [int32 array of token char offsets per context]} map.
+        """
+
+        paragraph_indices = {id(p): i for i, p in enumerate(paragraphs)}
+        cached_paragraphs = {}
+        paragraph_index, paragraph_num_contexts = [], []
+        contexts, contexts_tags, contexts_char_offsets = [], [], []
+        question_paragraph, question_qa_index = [], []
+        answer_groups, answer_items, answer_spans = [], [], []
+
+        for qa in qas:
+            p_index = paragraph_indices[id(qa.paragraph_json)]
+
+            if p_index not in cached_paragraphs:
+                cached_paragraphs[p_index] = len(paragraph_index)
+                paragraph_index.append(p_index)
+                paragraph_num_contexts.append(len(qa.contexts))
+                offsets = char_offsets[qa.id]
+                for context, tag_bits, context_offsets in zip(qa.contexts, qa.contexts_tag_bits, offsets):
+                    contexts.append(context)
+                    contexts_tags.append(tag_bits)
+                    contexts_char_offsets.append(context_offsets)
+
+            question_paragraph.append(cached_paragraphs[p_index])
+            question_qa_index.append(next(i for i, q in enumerate(qa.paragraph_json["qas"])
+                                          if q is qa.question_json))
+            answer_groups.append(len(qa.answers_spans))
+            for group_spans in qa.answers_spans:
+                answer_items.append(len(group_spans))
+                answer_spans.extend(group_spans)
+
+        arrays = {
+            "paragraph_index": np.array(paragraph_index, dtype=np.int64),
+            "paragraph_contexts": to_offsets(paragraph_num_contexts),
+            "question_paragraph": np.array(question_paragraph, dtype=np.int64),
+            "question_qa_index": np.array(question_qa_index, dtype=np.int64),
+            "answer_groups": to_offsets(answer_groups),
+            "answer_items": to_offsets(answer_items),
+            "answer_spans": np.array(answer_spans, dtype=np.int32).reshape([-1, 3]),
+        }
+        arrays["context_tokens"], arrays["context_tokens_offsets"] = to_ragged(contexts, np.int32)
+        arrays["context_char_offsets"], _ = to_ragged(contexts_char_offsets, np.int32)
+        arrays["context_tag_words"], arrays["context_tag_words_offsets"] = to_ragged(contexts_tags, np.uint64)
+        arrays["question_tokens"], arrays["question_tokens_offsets"] = to_ragged(
+            [qa.question for qa in qas], np.int32)
+        arrays["question_tag_words"], arrays["question_tag_words_offsets"] = to_ragged(
+            [qa.question_tag_bits for qa in qas], np.uint64)
+        arrays["answer_tokens"], arrays["answer_tokens_offsets"] = to_ragged(
+            [answer for qa in qas for group in qa.answers for answer in group], np.int32)
+
+        meta = {
+            "ids": [qa.id for qa in qas],
+            "q_types": [qa.q_type for qa in qas],
+            "is_yes": [qa.is_yes for qa in qas],
+        }
+
+        # Write to a temporary directory first, so that readers never see partial caches
+        tmp_path = "%s.tmp-%d" % (self.path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), array)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError:
+            # Another process has written the same cache in the meantime
+            shutil.rmtree(tmp_path)
+
+
+    def load(self, paragraphs):
+        """
+        Reads the preprocessed questions from the cache.
+        :param paragraphs: list of all paragraph JSON objects of the dataset.
+        :return: (qas, char_offsets) as returned by SQuADSampler.build_questions().
+        """
+
+        with open(os.path.join(self.path, "meta.json")) as f:
+            meta = json.load(f)
+
+        # Char offsets stay one array, contexts reference slices of it
+        all_char_offsets = np.load(os.path.join(self.path, "context_char_offsets.npy"))
+        # Tag words are memory mapped, slices are copied into packed tags as raw bytes
+        words_arrays = ["context_tag_words.npy", "question_tag_words.npy"]
+        tag_words = {name[:-len(".npy")]: np.load(os.path.join(self.path, name), mmap_mode="r")
+                     for name in words_arrays}
+        # Other arrays are read whole & converted into lists, indexing lists is faster
+        a = {name[:-len(".npy")]: np.load(os.path.join(self.path, name)).tolist()
+             for name in os.listdir(self.path)
+             if name.endswith(".npy") and name != "context_char_offsets.npy" and name not in words_arrays}
+
+        def tag_bits(prefix, index):
+            words, words_offsets = tag_words[prefix + "_tag_words"], a[prefix + "_tag_words_offsets"]
+            return array('Q', words[words_offsets[index]:words_offsets[index + 1]].tobytes())
+
+        # Per paragraph: (contexts, contexts_tags, char_offsets)
+        paragraph_data = []
+        tokens_offsets = a["context_tokens_offsets"]
+        for p in range(len(a["paragraph_index"])):
+            contexts, contexts_tags, offsets = [], [], []
+            for c in range(a["paragraph_contexts"][p], a["paragraph_contexts"][p + 1]):
+                start, end = tokens_offsets[c], tokens_offsets[c + 1]
+                contexts.append(array('i', a["context_tokens"][start:end]))
+                contexts_tags.append(tag_bits("context", c))
+                offsets.append(all_char_offsets[start:end])
+            paragraph_data.append((contexts, contexts_tags, offsets))
+
+        qas = []
+        char_offsets = {}
+        tokens_offsets = a["question_tokens_offsets"]
+        for q, qa_id in enumerate(meta["ids"]):
+
+            p = a["question_paragraph"][q]
+            contexts, contexts_tags, offsets = paragraph_data[p]
+
+            start, end = tokens_offsets[q], tokens_offsets[q + 1]
+            question = a["question_tokens"][start:end]
+            question_tags = tag_bits("question", q)
+
+            answers = []
+            answers_spans = []
+            for g in range(a["answer_groups"][q], a["answer_groups"][q + 1]):
+                items = range(a["answer_items"][g], a["answer_items"][g + 1])
+                answers.append([a["answer_tokens"][a["answer_tokens_offsets"][i]:a["answer_tokens_offsets"][i + 1]]
+                                for i in items])
+                answers_spans.append([tuple(a["answer_spans"][i]) for i in items])
+
+            qas.append(QASetting(question, answers, contexts, answers_spans,
+                                 id=qa_id,
+                                 q_type=meta["q_types"][q],
+                                 is_yes=meta["is_yes"][q],
+                                 contexts_tags=contexts_tags,
+                                 question_tags=question_tags,
+                                 json_source=paragraphs,
+                                 paragraph_index=a["paragraph_index"][p],
+                                 qa_index=a["question_qa_index"][q]))
+            char_offsets[qa_id] = offsets
+
+        return qas, char_offsets
@@ -1,123 +1,317 @@
+import itertools
 import json
+import multiprocessing
 import os
+from array import array
 
-from biomedical_qa.models import QASetting
+import numpy as np
+
+from biomedical_qa.models import QASetting, pack_tags, pack_tag_masks
 from biomedical_qa.sampling.base import BaseSampler
+from biomedical_qa.sampling.cache import PreprocessingCache, get_cache_key
 
 
 class SQuADSampler(BaseSampler):
 
     def __init__(self, dir, filenames, batch_size, vocab,
                  instances_per_epoch=None, shuffle=True, dataset_json=None,
-                 types=None, split_contexts_on_newline=False, tagger=None):
+                 types=None, split_contexts_on_newline=False, tagger=None,
+                 cache_dir=None, bucket_window=None, max_batch_tokens=None,
+                 max_batch_contexts=None, num_workers=1):
 
         if dataset_json is None:
             # load json
             with open(os.path.join(dir, filenames[0])) as dataset_file:
                 dataset_json = json.load(dataset_file)
         self.dataset = dataset_json['data']
+        self.paragraphs = [paragraph for article in self.dataset for paragraph in article["paragraphs"]]
         self.types = types if types is not None else ["factoid", "list"]
         self.split_contexts_on_newline = split_contexts_on_newline
         self.tagger = tagger
+        self.cache_dir = cache_dir
+        self.num_workers = num_workers
 
-        BaseSampler.__init__(self, batch_size, vocab, instances_per_epoch, shuffle)
+        BaseSampler.__init__(self, batch_size, vocab, instances_per_epoch, shuffle,
+                             bucket_window=bucket_window,
+                             max_batch_tokens=max_batch_tokens,
+                             max_batch_contexts=max_batch_contexts)
 
 
     def build_questions(self):
 
+        if self.cache_dir is None:
+            return self._preprocess_questions()
+
+        options = {
+            "types": self.types,
+            "split_contexts_on_newline": self.split_contexts_on_newline,
+        }
+        cache = PreprocessingCache(self.cache_dir,
+                                   get_cache_key(self.dataset, self.vocab, self.tagger, options))
+
+        if cache.exists():
+            print("Loading preprocessed questions from %s" % cache.path)
+            self.tagger = None
+            return cache.load(self.paragraphs)
+
+        qas, char_offsets = self._preprocess_questions()
+        print("Caching preprocessed questions in %s" % cache.path)
+        cache.save(self.paragraphs, qas, char_offsets)
+
+        return qas, char_offsets
+
+
+    def _preprocess_questions(self):
+
+        if self.num_workers > 1:
+            results = self._preprocess_paragraphs_parallel()
+        else:
+            num_paragraphs = len(self.paragraphs)
+            results = itertools.chain.from_iterable(
+                self._preprocess_paragraphs(range(start, min(start + TAG_BATCH_SIZE, num_paragraphs)))
+                for start in range(0, num_paragraphs, TAG_BATCH_SIZE))
+
         char_offsets = dict()
         qas = []
+        for paragraph_qas, paragraph_char_offsets in results:
+            if self.tagger and len(qas) // 10 < (len(qas) + len(paragraph_qas)) // 10:
+                print("%d questions..." % (len(qas) + len(paragraph_qas)))
+            qas.extend(paragraph_qas)
+            char_offsets.update(paragraph_char_offsets)
 
-        for article in self.dataset:
-            for paragraph in article["paragraphs"]:
-
-                context_str_all = paragraph["context_original_capitalization"] \
-                                    if "context_original_capitalization" in paragraph \
-                                    else paragraph["context"]
-                assert "\n\n" not in context_str_all
-                context_strs = context_str_all.split("\n") \
-                    if self.split_contexts_on_newline else [context_str_all]
-
-                # Compute <char offset> -> (<context index>, <token index>) map
-                char_offset_to_token_index = {}
-                contexts_tags = []
-                contexts = []
-                previous_contexts_length = 0
-                for context_index, context_str in enumerate(context_strs):
-
-                    context, offsets = self.get_ids_and_offsets(context_str)
-                    # Add previous contexts length to offset -> offset in context_str_all
-                    offsets = [o + previous_contexts_length for o in offsets]
-                    # Add current context length + 1 (for "\n" token)
-                    previous_contexts_length += len(context_str) + 1
-
-                    contexts.append(context)
-                    if self.tagger:
-                        tags, tag_ids, entities = self.tagger.tag(context_str, self.tokenizer)
-                        contexts_tags.append(tag_ids)
-                    else:
-                        contexts_tags.append([set() for _ in context])
-
-                    for token_index, offset in enumerate(offsets):
-                        char_offset_to_token_index[offset] = (context_index, token_index)
-
-                for qa in paragraph["qas"]:
-
-                    answers = []
-                    answers_spans = []
-                    answers_json = qa["answers"] if "answers" in qa else []
-                    answers_json_list = answers_json if len(answers_json) == 0  \
-                                                     or isinstance(answers_json[0], list) \
-                                                     else [answers_json]
-                    for answer_list in answers_json_list:
-                        current_answer_spans = []
-                        current_answers = []
-
-                        for a in answer_list:
-                            answer, _ = self.get_ids_and_offsets(a["text"])
-                            if answer and a["answer_start"] in char_offset_to_token_index:
-                                context_index, start = char_offset_to_token_index[a["answer_start"]]
-                                end = start + len(answer)
-                                if (context_index, context_index, end) in answers_spans:
-                                    continue
-                                current_answer_spans.append((context_index, start, end))
-                                current_answers.append(answer)
-
-                        answers_spans.append(current_answer_spans)
-                        answers.append(current_answers)
-
-                    q_type = qa["question_type"] if "question_type" in qa else None
-                    is_yes = qa["answer_is_yes"] if "answer_is_yes" in qa else None
-                    if q_type is None or q_type in self.types:
-                        question_str = qa["question_original_capitalization"] \
-                                        if "question_original_capitalization" in qa \
-                                        else qa["question"]
-                        question_tokens = self.get_ids_and_offsets(question_str)[0]
-
-                        if self.tagger:
-                            tags, tag_ids, entities = self.tagger.tag(question_str, self.tokenizer)
-                            question_tags = tag_ids
-                        else:
-                            question_tags = [set() for _ in question_tokens]
-
-                        qas.append(QASetting(question_tokens, answers,
-                                             contexts, answers_spans,
-                                             id=qa["id"],
-                                             q_type=q_type,
-                                             is_yes=is_yes,
-                                             paragraph_json=paragraph,
-                                             question_json=qa,
-                                             contexts_tags=contexts_tags,
-                                             question_tags=question_tags))
-
-                        if self.tagger and len(qas) % 10 == 0:
-                            print("%d questions..." % len(qas))
-
-                    char_offsets[qa["id"]] = {(context_index, token_index) : char_offset
-                                              for char_offset, (context_index, token_index)
-                                              in char_offset_to_token_index.items()}
+        store = getattr(self.tagger, "store", None)
+        if store is not None and store.memory_hits + store.disk_hits + store.misses > 0:
+            print(store.get_stats_string())
 
         # delete tagger to save some memory
         self.tagger = None
 
         return qas, char_offsets
+
+
+    def _preprocess_paragraphs_parallel(self):
+        """
+        Preprocesses the paragraphs in a pool of forked worker processes. Workers
+        inherit the sampler (and its tagger) copy-on-write instead of loading it again.
+        Shards are merged in order, so the result equals sequential preprocessing.
+        Samplers with num_workers > 1 must be built before a TensorFlow session is
+        created, forking a process that runs TensorFlow's threads may hang the workers.
+        :return: Generator of (qas, char_offsets) per paragraph.
+        """
+
+        global _worker_state
+
+        try:
+            context = multiprocessing.get_context("fork")
+        except ValueError:
+            print("Forking is not supported on this platform, preprocessing sequentially.")
+            yield from self._preprocess_paragraphs(range(len(self.paragraphs)))
+            return
+
+        num_paragraphs = len(self.paragraphs)
+        shards = [range(start, min(start + PARALLEL_SHARD_SIZE, num_paragraphs))
+                  for start in range(0, num_paragraphs, PARALLEL_SHARD_SIZE)]
+
+        # Workers share the parent's tagger instead of each loading it
+        if self.tagger is not None:
+            self.tagger.load()
+
+        _worker_state = self
+        try:
+            with context.Pool(self.num_workers, initializer=_init_worker) as pool:
+                for shard_results in pool.imap(_preprocess_shard, shards):
+                    for paragraph_qas, paragraph_char_offsets in shard_results:
+                        # The JSON source is not pickled, link the parent's one
+                        for qa_setting in paragraph_qas:
+                            qa_setting.json_source = self.paragraphs
+                        yield paragraph_qas, paragraph_char_offsets
+        finally:
+            _worker_state = None
+
+
+    def _get_context_strs(self, paragraph):
+
+        context_str_all = paragraph["context_original_capitalization"] \
+                            if "context_original_capitalization" in paragraph \
+                            else paragraph["context"]
+        assert "\n\n" not in context_str_all
+        return context_str_all.split("\n") \
+            if self.split_contexts_on_newline else [context_str_all]
+
+
+    def _get_question_str(self, qa):
+
+        return qa["question_original_capitalization"] \
+                if "question_original_capitalization" in qa \
+                else qa["question"]
+
+
+    def _is_included(self, qa):
+
+        q_type = qa["question_type"] if "question_type" in qa else None
+        return q_type is None or q_type in self.types
+
+
+    def _get_texts_to_tag(self, paragraphs):
+        """Yields all strings that _preprocess_paragraph() tags, in the same order."""
+
+        for paragraph in paragraphs:
+            yield from self._get_context_strs(paragraph)
+            for qa in paragraph["qas"]:
+                if self._is_included(qa):
+                    yield self._get_question_str(qa)
+
+
+    def _tag_paragraphs(self, paragraphs):
+        """
+        Tags all texts of the paragraphs with one tag_many_masks() call.
+        :return: Iterator over the tagging results in the order _preprocess_paragraph()
+                consumes them, or None if there is no tagger.
+        """
+
+        if not self.tagger:
+            return None
+        return iter(self.tagger.tag_many_masks(self._get_texts_to_tag(paragraphs), self.tokenizer))
+
+
+    def _tag(self, text, tag_results):
+        # Takes the next bulk tagging result if there are any, otherwise tags text
+
+        if tag_results is not None:
+            return next(tag_results)
+        return self.tagger.tag_masks(text, self.tokenizer)
+
+
+    def _preprocess_paragraphs(self, paragraph_indices):
+        """
+        Preprocesses the paragraphs with the given indices, tagging their texts in bulk.
+        :return: List of (qas, char_offsets) per paragraph.
+        """
+
+        paragraphs = [self.paragraphs[paragraph_index] for paragraph_index in paragraph_indices]
+        tag_results = self._tag_paragraphs(paragraphs)
+        return [self._preprocess_paragraph(paragraph, paragraph_index, tag_results)
+                for paragraph_index, paragraph in zip(paragraph_indices, paragraphs)]
+
+
+    def _preprocess_paragraph(self, paragraph, paragraph_index=None, tag_results=None):
+        """
+        Tokenizes & tags a paragraph and resolves the answer spans of its questions.
+        :param paragraph_index: Index of the paragraph in self.paragraphs. If given, the
+                questions reference their JSON by index, otherwise directly.
+        :param tag_results: Iterator over tagging results, see _tag_paragraphs(). If None,
+                the texts are tagged one by one.
+        :return: (qas, char_offsets) of the paragraph's questions.
+        """
+
+        char_offsets = dict()
+        qas = []
+
+        context_strs = self._get_context_strs(paragraph)
+
+        # Compute <char offset> -> (<context index>, <token index>) map
+        char_offset_to_token_index = {}
+        contexts_char_offsets = []
+        contexts_tags = []
+        contexts = []
+        previous_contexts_length = 0
+        for context_index, context_str in enumerate(context_strs):
+
+            context, offsets = self.get_ids_and_offsets(context_str)
+            # Add previous contexts length to offset -> offset in context_str_all
+            offsets = [o + previous_contexts_length for o in offsets]
+            # Add current context length + 1 (for "\n" token)
+            previous_contexts_length += len(context_str) + 1
+
+            # Contexts, their tags & char offsets are shared by all questions of the paragraph
+            contexts.append(array('i', context))
+            contexts_char_offsets.append(np.array(offsets, dtype=np.int32))
+            if self.tagger:
+                masks, entities = self._tag(context_str, tag_results)
+                contexts_tags.append(pack_tag_masks(masks))
+            else:
+                contexts_tags.append(pack_tags([set() for _ in context]))
+
+            for token_index, offset in enumerate(offsets):
+                char_offset_to_token_index[offset] = (context_index, token_index)
+
+        for qa_index, qa in enumerate(paragraph["qas"]):
+
+            answers = []
+            answers_spans = []
+            answers_json = qa["answers"] if "answers" in qa else []
+            answers_json_list = answers_json if len(answers_json) == 0  \
+                                             or isinstance(answers_json[0], list) \
+                                             else [answers_json]
+            for answer_list in answers_json_list:
+                current_answer_spans = []
+                current_answers = []
+
+                for a in answer_list:
+                    answer, _ = self.get_ids_and_offsets(a["text"])
+                    if answer and a["answer_start"] in char_offset_to_token_index:
+                        context_index, start = char_offset_to_token_index[a["answer_start"]]
+                        end = start + len(answer)
+                        if (context_index, context_index, end) in answers_spans:
+                            continue
+                        current_answer_spans.append((context_index, start, end))
+                        current_answers.append(answer)
+
+                answers_spans.append(current_answer_spans)
+                answers.append(current_answers)
+
+            q_type = qa["question_type"] if "question_type" in qa else None
+            is_yes = qa["answer_is_yes"] if "answer_is_yes" in qa else None
+            if self._is_included(qa):
+                if paragraph_index is not None:
+                    json_reference = {"json_source": self.paragraphs,
+                                      "paragraph_index": paragraph_index,
+                                      "qa_index": qa_index}
+                else:
+                    json_reference = {"paragraph_json": paragraph, "question_json": qa}
+
+                question_str = self._get_question_str(qa)
+                question_tokens = self.get_ids_and_offsets(question_str)[0]
+
+                if self.tagger:
+                    masks, entities = self._tag(question_str, tag_results)
+                    question_tags = pack_tag_masks(masks)
+                else:
+                    question_tags = [set() for _ in question_tokens]
+
+                qas.append(QASetting(question_tokens, answers,
+                                     contexts, answers_spans,
+                                     id=qa["id"],
+                                     q_type=q_type,
+                                     is_yes=is_yes,
+                                     contexts_tags=contexts_tags,
+                                     question_tags=question_tags,
+                                     **json_reference))
+
+                char_offsets[qa["id"]] = contexts_char_offsets
+
+        return qas, char_offsets
+
+
+# Number of paragraphs per task of a parallel preprocessing worker
+PARALLEL_SHARD_SIZE = 32
+
+# Number of paragraphs whose texts are tagged with one tag_many_masks() call
+TAG_BATCH_SIZE = 256
+
+# Sampler inherited by forked preprocessing workers
+_worker_state = None
+
+
+def _init_worker():
+
+    sampler = _worker_state
+    if sampler.tagger is not None:
+        sampler.tagger.after_fork()
+
+
+def _preprocess_shard(paragraph_indices):
+
+    sampler = _worker_state
+    # QASettings reference their JSON by index, the JSON itself is not sent back to the parent
+    return sampler._preprocess_paragraphs(paragraph_indices)
@@ -0,0 +1,269 @@
+import itertools
+import json
+import os
+import re
+
+from biomedical_qa.sampling.squad import SQuADSampler, TAG_BATCH_SIZE
+
+_WHITESPACE = re.compile(r"\s*")
+_NUMBER = re.compile(r"[-+0-9.eE]*")
+
+
+class _JsonStreamReader(object):
+    """Minimal pull parser that decodes a JSON file value by value while reading it in chunks."""
+
+
+    def __init__(self, f, chunk_size=1 << 20):
+
+        self._f = f
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+
+    def _fill(self):
+
+        chunk = self._f.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it, None at EOF."""
+
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return None
+
+
+    def expect(self, char):
+
+        if self.peek() != char:
+            raise ValueError("Expected '%s' in JSON stream, got %r." % (char, self.peek()))
+        self._pos += 1
+
+
+    def value(self):
+        """Decodes the next complete JSON value."""
+
+        self.peek()
+        # A number at the end of the buffer might continue in the next chunk
+        while _NUMBER.match(self._buffer, self._pos).end() == len(self._buffer) and self._fill():
+            pass
+
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                self._pos = end
+                return value
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+
+
+    def object_keys(self):
+        """Yields the keys of an object. The caller must consume each key's value."""
+
+        self.expect("{")
+        if self.peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == "}":
+                self._pos += 1
+                return
+            self.expect(",")
+
+
+    def array_items(self):
+        """Yields once per array item. The caller must consume each item."""
+
+        self.expect("[")
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == "]":
+                self._pos += 1
+                return
+            self.expect(",")
+
+
+def iter_squad_paragraphs(path):
+    """
+    Incrementally parses a SQuAD JSON file.
+    :param path: Path to the SQuAD file.
+    :return: Generator of paragraph JSON objects. Only one paragraph is decoded at a time.
+    """
+
+    with open(path) as f:
+        reader = _JsonStreamReader(f)
+        for key in reader.object_keys():
+            if key != "data":
+                reader.value()
+                continue
+            for _ in reader.array_items():
+                for article_key in reader.object_keys():
+                    if article_key != "paragraphs":
+                        reader.value()
+                        continue
+                    for _ in reader.array_items():
+                        yield reader.value()
+
+
+class StreamingSQuADSampler(SQuADSampler):
+    """SQuAD sampler for datasets that do not fit into memory.
+
+    Paragraphs are parsed & preprocessed on the fly while streaming through all
+    files. Questions are randomized with a bounded shuffle buffer instead of a
+    full shuffle, so only the buffered questions (and their JSON) are kept in memory.
+    An epoch ends after all files have been streamed through once.
+    """
+
+
+    def __init__(self, dir, filenames, batch_size, vocab,
+                 instances_per_epoch=None, shuffle=True, types=None,
+                 split_contexts_on_newline=False, tagger=None,
+                 shuffle_buffer_size=10000, max_batch_tokens=None,
+                 max_batch_contexts=None):
+        """
+        :param filenames: SQuAD files in dir, all of them are streamed.
+        :param shuffle_buffer_size: Number of preprocessed questions to draw random
+                questions from. Larger buffers randomize better, but need more memory.
+        For the other parameters see SQuADSampler and BaseSampler.
+        """
+
+        self.paths = [os.path.join(dir, filename) for filename in filenames]
+        self.types = types if types is not None else ["factoid", "list"]
+        self.split_contexts_on_newline = split_contexts_on_newline
+        # The tagger is needed for the whole run, as paragraphs are tagged in every epoch
+        self.tagger = tagger
+        self.cache_dir = None
+        self.num_workers = 1
+
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size if shuffle else 1
+        self._init_state(batch_size, vocab, instances_per_epoch, None,
+                         max_batch_tokens, max_batch_contexts)
+
+        # Char offsets of the buffered questions and the questions of the last batch
+        self.char_offsets = {}
+        self._last_batch = []
+        self._start_epoch()
+
+        assert self._peek_question() is not None, "No questions found in %s." % self.paths
+
+
+    def build_questions(self):
+
+        raise NotImplementedError("StreamingSQuADSampler does not build all questions in memory.")
+
+
+    def get_questions(self):
+
+        raise NotImplementedError("StreamingSQuADSampler does not keep all questions in memory.")
+
+
+    def _start_epoch(self):
+
+        paths = list(self.paths)
+        if self.shuffle:
+            self._rng.shuffle(paths)
+
+        questions = self._stream_questions(paths)
+        if self.instances_per_epoch is not None:
+            questions = itertools.islice(questions, self.instances_per_epoch)
+
+        self._questions = questions
+        self._buffer = []
+        self._next_question = None
+
+
+    def _stream_questions(self, paths):
+
+        for path in paths:
+            paragraphs = iter_squad_paragraphs(path)
+            while True:
+                # Tag the texts of a few paragraphs at a time in bulk
+                batch = list(itertools.islice(paragraphs, TAG_BATCH_SIZE))
+                if not batch:
+                    break
+                tag_results = self._tag_paragraphs(batch)
+                for paragraph in batch:
+                    qas, char_offsets = self._preprocess_paragraph(paragraph, tag_results=tag_results)
+                    for qa_setting in qas:
+                        yield qa_setting, char_offsets[qa_setting.id]
+
+
+    def _peek_question(self):
+        """Returns the next question of the epoch without consuming it, None at the end of the epoch."""
+
+        if self._next_question is None:
+            for qa_setting, char_offsets in itertools.islice(
+                    self._questions, max(0, self.shuffle_buffer_size - len(self._buffer))):
+                self._buffer.append(qa_setting)
+                self.char_offsets[qa_setting.id] = char_offsets
+
+            if self._buffer:
+                index = self._rng.randrange(len(self._buffer)) if self.shuffle else 0
+                self._next_question = self._buffer.pop(index)
+
+        return self._next_question
+
+
+    def get_batch(self):
+
+        qa_settings = []
+        num_contexts = 0
+        max_context_length = 0
+        while len(qa_settings) < self.batch_size:
+            qa_setting = self._peek_question()
+            if qa_setting is None:
+                break
+
+            context_lengths = [len(c) for c in qa_setting.contexts]
+            num_contexts += len(context_lengths)
+            max_context_length = max([max_context_length] + context_lengths)
+            if qa_settings and self._exceeds_budget(num_contexts, max_context_length):
+                break
+
+            qa_settings.append(qa_setting)
+            self._next_question = None
+
+        # Keep the char offsets of the returned batch only, e.g. for answer extraction
+        returned_ids = set(qa_setting.id for qa_setting in qa_settings)
+        for qa_setting in self._last_batch:
+            if qa_setting.id not in returned_ids:
+                self.char_offsets.pop(qa_setting.id, None)
+        self._last_batch = qa_settings
+
+        if self._peek_question() is None:
+            self.epoch += 1
+            self._start_epoch()
+
+        context_lengths = [len(c) for qa_setting in qa_settings for c in qa_setting.contexts]
+        self._real_context_tokens += sum(context_lengths)
+        self._padded_context_tokens += len(context_lengths) * max(context_lengths, default=0)
+
+        return qa_settings
+
+
+    def reset(self):
+        """Restarts streaming from the beginning of the current epoch."""
+
+        self.char_offsets = {}
+        self._last_batch = []
+        self._start_epoch()
@@ -181,6 +181,63 @@ def segment_argmax(input, partition):
         return row_indices, col_indices
 
 
+def top_k_rows(values, k):
+    """Computes the top k values & column indices of each row in the 2D values.
+    Equal values are ordered by index. If there are fewer than k columns, the
+    results are padded with zeros.
+    :return: (indices, values), both [rows, k] tensors, indices are int64.
+    """
+
+    with tf.name_scope("top_k_rows"):
+        num_top = tf.minimum(k, tf.shape(values)[1])
+        top_values, top_indices = tf.nn.top_k(values, num_top)
+        padding = [[0, 0], [0, k - num_top]]
+        return tf.pad(tf.cast(top_indices, tf.int64), padding), tf.pad(top_values, padding)
+
+
+def segment_top_k(values, partition, k):
+    """Computes the top k values of each partition of rows in the 2D values, where
+    partitions are collections of consecutive rows. Equal values are ordered by
+    row, then column. Partitions with fewer than k values are padded with zeros.
+    :param values: [rows, cols] float tensor.
+    :param partition: [rows] int64 tensor of sorted partition indices.
+    :return: (rows, cols, values), all [num_partitions, k] tensors. rows are
+        indices within the partition.
+    """
+
+    with tf.name_scope("segment_top_k"):
+
+        num_cols = tf.cast(tf.shape(values)[1], tf.int64)
+        rows_per_partition = tf.segment_sum(tf.ones_like(partition), partition)
+        num_partitions = tf.shape(rows_per_partition, out_type=tf.int64)[0]
+        max_rows = tf.reduce_max(rows_per_partition)
+        partition_starts = tf.cumsum(rows_per_partition, exclusive=True)
+        rows_in_partition = tf.range(tf.shape(partition, out_type=tf.int64)[0]) \
+                            - tf.gather(partition_starts, partition)
+
+        # Lay the rows of each partition out in a [num_partitions, max_rows * cols]
+        # matrix, padded with -inf after the partition's rows
+        indices = tf.stack([partition, rows_in_partition], axis=1)
+        shape = tf.stack([num_partitions, max_rows, num_cols])
+        padded_values = tf.scatter_nd(indices, values, shape)
+        is_value = tf.scatter_nd(indices, tf.ones_like(values), shape) > 0.0
+        padded_values = tf.where(is_value, padded_values,
+                                 tf.fill(tf.shape(padded_values), float("-inf")))
+        padded_values = tf.reshape(padded_values, tf.stack([num_partitions, -1]))
+
+        top_indices, top_values = top_k_rows(padded_values, k)
+
+        # Zero the padding
+        is_valid = tf.less(tf.expand_dims(tf.range(k, dtype=tf.int64), 0),
+                           tf.expand_dims(rows_per_partition * num_cols, 1))
+        zeros = tf.zeros_like(top_indices)
+        rows = tf.where(is_valid, top_indices // num_cols, zeros)
+        cols = tf.where(is_valid, top_indices % num_cols, zeros)
+        top_values = tf.where(is_valid, top_values, tf.zeros_like(top_values))
+
+        return rows, cols, top_values
+
+
 def gather_rowwise_indices_1d(indices):
     """Transforms 1D indices tensor to _indices such that:
     tf.gather_nd(some_2d_tensor, _indices) is equivalent to:
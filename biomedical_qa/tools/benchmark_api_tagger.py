@@ -0,0 +1,63 @@
+import json
+import time
+
+import tensorflow as tf
+
+from biomedical_qa.data.entity_tagger import OleloEntityTagger, CtakesEntityTagger
+from biomedical_qa.data.stub_tagger_server import StubTaggerServer, load_term2cuis
+from biomedical_qa.data.tokenizer import Tokenizer
+
+tf.app.flags.DEFINE_string('bioasq_file', None, 'Path to a BioASQ JSON file, its snippets are tagged.')
+tf.app.flags.DEFINE_integer('num_snippets', 500, 'Maximum number of snippets to tag.')
+tf.app.flags.DEFINE_string('service', 'olelo', '[olelo, ctakes]: Response format of the stub server.')
+tf.app.flags.DEFINE_float('latency', 0.02, 'Seconds each response of the stub server is delayed.')
+tf.app.flags.DEFINE_float('failure_rate', 0.0, 'Fraction of requests that fail with status 503.')
+
+# --terms_file, --types_file and --tagger_max_requests are defined by entity_tagger
+FLAGS = tf.app.flags.FLAGS
+
+
+def make_tagger(server, max_in_flight):
+
+    if FLAGS.service == "olelo":
+        return OleloEntityTagger(FLAGS.types_file, server.get_url("olelo"), max_in_flight)
+    return CtakesEntityTagger(FLAGS.types_file, server.get_url("ctakes"), max_in_flight)
+
+
+def run(tagger, snippets, prefetch):
+
+    tokenizer = Tokenizer()
+    start_time = time.time()
+    if prefetch:
+        tagger.prefetch(snippets, tokenizer)
+    results = [tagger.tag(snippet, tokenizer) for snippet in snippets]
+    return results, time.time() - start_time
+
+
+def main():
+
+    with open(FLAGS.bioasq_file) as f:
+        bioasq_json = json.load(f)
+    snippets = [snippet["text"] for question in bioasq_json["questions"]
+                for snippet in question.get("snippets", [])]
+    snippets = snippets[:FLAGS.num_snippets]
+
+    server = StubTaggerServer(load_term2cuis(FLAGS.terms_file), latency=FLAGS.latency,
+                              failure_rate=FLAGS.failure_rate).start()
+    print("Tagging %d snippets, %.0f ms latency per request" % (len(snippets), 1000 * FLAGS.latency))
+
+    sequential_tagger = make_tagger(server, 1)
+    sequential_results, sequential_time = run(sequential_tagger, snippets, prefetch=False)
+    concurrent_tagger = make_tagger(server, FLAGS.tagger_max_requests)
+    concurrent_results, concurrent_time = run(concurrent_tagger, snippets, prefetch=True)
+    server.stop()
+
+    assert concurrent_results == sequential_results, "Tagger results differ."
+    print("Results are identical.")
+    print("Sequential:         %.1f snippets / s" % (len(snippets) / sequential_time))
+    print("%2d requests in flight: %.1f snippets / s" % (FLAGS.tagger_max_requests, len(snippets) / concurrent_time))
+    print("Speedup: %.1fx" % (sequential_time / concurrent_time))
+    print(concurrent_tagger.client.get_stats_string())
+
+
+main()
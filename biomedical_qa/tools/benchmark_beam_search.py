@@ -0,0 +1,120 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from biomedical_qa.models.beam_search import BeamSearchDecoder
+
+tf.app.flags.DEFINE_string('beam_sizes', '5,10,20', 'Comma-separated list of beam sizes.')
+tf.app.flags.DEFINE_string('contexts_per_question', '1,10,50', 'Comma-separated list of numbers of contexts per question.')
+tf.app.flags.DEFINE_integer('num_questions', 32, 'Number of questions per batch.')
+tf.app.flags.DEFINE_integer('context_length', 300, 'Number of tokens per context.')
+tf.app.flags.DEFINE_integer('num_batches', 5, 'Number of batches per setting.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+class LegacyBeamSearchDecoder(BeamSearchDecoder):
+    """BeamSearchDecoder with the top k & gather implementations before vectorization."""
+
+
+    def _top_k_2d(self, values, partition=None):
+
+        if partition is None:
+            partition = np.arange(len(values))
+
+        num_partitions = partition[-1] + 1
+        num_values = min(self._beam_size, values.shape[1])
+
+        rows = np.zeros([num_partitions, self._beam_size], dtype=np.int64)
+        cols = np.zeros([num_partitions, self._beam_size], dtype=np.int64)
+        top_values = np.zeros([num_partitions, self._beam_size], dtype=np.float32)
+
+        for p in range(num_partitions):
+
+            current_values = values[partition == p]
+            n_rows, n_cols = current_values.shape
+            values_indices = [(current_values[row, col], row, col)
+                              for row in range(n_rows)
+                              for col in range(n_cols)]
+
+            values_indices = sorted(values_indices,
+                                    key=lambda v: -v[0])[:self._beam_size]
+
+            top_values[p][:num_values], rows[p][:num_values], cols[p][:num_values] = zip(*values_indices)
+
+        return rows, cols, top_values
+
+
+    def _gather_rowwise(self, values, indices):
+
+        result = np.zeros(indices.shape, dtype=values.dtype)
+
+        for row in range(len(indices)):
+            result[row,:] = values[row, indices[row]]
+
+        return result
+
+
+def make_decoder(decoder_class, beam_size):
+
+    # The top k steps do not need a session or models
+    decoder = decoder_class.__new__(decoder_class)
+    decoder._beam_size = beam_size
+    return decoder
+
+
+def make_batch(rng, num_contexts, beam_size):
+
+    context_partition = np.repeat(np.arange(FLAGS.num_questions), num_contexts)
+    start_probs = 1 / (1 + np.exp(-rng.randn(len(context_partition), FLAGS.context_length).astype(np.float32)))
+    end_scores = rng.randn(FLAGS.num_questions * beam_size, FLAGS.context_length).astype(np.float32)
+    end_probs = np.exp(end_scores) / np.exp(end_scores).sum(axis=1, keepdims=True)
+    # Rounding creates ties, as for saturated probabilities
+    return context_partition, np.round(start_probs, 3), np.round(end_probs, 5)
+
+
+def decode(decoder, context_partition, start_probs, end_probs):
+    # The steps of BeamSearchDecoder.decode() after the start & end probs are computed
+
+    contexts, starts, top_start_probs = decoder._compute_top_starts(start_probs, context_partition)
+    return decoder._compute_top_spans(contexts, starts, top_start_probs, end_probs)
+
+
+def main():
+
+    rng = np.random.RandomState(1234)
+    print("%d questions, %d tokens per context" % (FLAGS.num_questions, FLAGS.context_length))
+    print("beam  contexts  legacy ms  vectorized ms  speedup")
+
+    for beam_size in [int(b) for b in FLAGS.beam_sizes.split(",")]:
+        for num_contexts in [int(c) for c in FLAGS.contexts_per_question.split(",")]:
+
+            legacy_decoder = make_decoder(LegacyBeamSearchDecoder, beam_size)
+            decoder = make_decoder(BeamSearchDecoder, beam_size)
+
+            legacy_time = 0.0
+            vectorized_time = 0.0
+            for _ in range(FLAGS.num_batches):
+                batch = make_batch(rng, num_contexts, beam_size)
+
+                start_time = time.time()
+                legacy_results = decode(legacy_decoder, *batch)
+                legacy_time += time.time() - start_time
+
+                start_time = time.time()
+                results = decode(decoder, *batch)
+                vectorized_time += time.time() - start_time
+
+                for legacy_result, result in zip(legacy_results, results):
+                    assert legacy_result.dtype == result.dtype and \
+                           legacy_result.tobytes() == result.tobytes(), "Beams differ."
+
+            print("%4d  %8d  %9.1f  %13.2f  %6.1fx" % (
+                beam_size, num_contexts, 1000 * legacy_time / FLAGS.num_batches,
+                1000 * vectorized_time / FLAGS.num_batches, legacy_time / vectorized_time))
+
+    print("Beams are identical.")
+
+
+main()
@@ -0,0 +1,69 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from biomedical_qa.models.embedder import lookup_embeddings
+from biomedical_qa.models.qa_model import pad_sequences
+
+tf.app.flags.DEFINE_integer('vocab_size', 200000, 'Number of words of the embedding matrix.')
+tf.app.flags.DEFINE_integer('embedding_size', 400, 'Size of the word embeddings, e.g. 300 GloVe + 100 PubMed.')
+tf.app.flags.DEFINE_integer('num_contexts', 160, 'Number of contexts per batch, e.g. 16 questions with 10 snippets.')
+tf.app.flags.DEFINE_integer('max_context_length', 300, 'Maximum number of tokens per context.')
+tf.app.flags.DEFINE_integer('num_batches', 10, 'Number of batches.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def legacy_lookup_embeddings(embeddings, inputs, seq_lengths):
+    """ConstantWordEmbedder.get_feed_dict() lookup before vectorization: copies one token at a time."""
+
+    embedded_inputs = np.zeros([inputs.shape[0], np.max(seq_lengths), embeddings.shape[1]])
+    for i in range(len(inputs)):
+        for j in range(seq_lengths[i]):
+            embedded_inputs[i, j] = embeddings[inputs[i][j]]
+    return embedded_inputs
+
+
+def main():
+
+    rng = np.random.RandomState(1234)
+    embeddings = rng.randn(FLAGS.vocab_size, FLAGS.embedding_size).astype(np.float32)
+
+    legacy_time = 0.0
+    vectorized_time = 0.0
+    legacy_bytes = 0
+    vectorized_bytes = 0
+    ids_bytes = 0
+    for _ in range(FLAGS.num_batches):
+        lengths = rng.randint(1, FLAGS.max_context_length + 1, size=FLAGS.num_contexts)
+        inputs, seq_lengths = pad_sequences([rng.randint(FLAGS.vocab_size, size=l) for l in lengths])
+
+        start_time = time.time()
+        legacy_embedded = legacy_lookup_embeddings(embeddings, inputs, seq_lengths)
+        legacy_time += time.time() - start_time
+
+        start_time = time.time()
+        embedded = lookup_embeddings(embeddings, inputs, seq_lengths)
+        vectorized_time += time.time() - start_time
+
+        # Values are float32 embeddings either way
+        assert np.array_equal(legacy_embedded, embedded), "Embeddings differ."
+
+        legacy_bytes += legacy_embedded.nbytes
+        vectorized_bytes += embedded.nbytes
+        ids_bytes += inputs.nbytes
+
+    print("%d contexts of up to %d tokens per batch, %d x %d embeddings" % (
+        FLAGS.num_contexts, FLAGS.max_context_length, FLAGS.vocab_size, FLAGS.embedding_size))
+    print("Embeddings are identical.")
+    print("Token loop:   %7.1f ms / batch, feeds %6.1f MB / batch" % (
+        1000 * legacy_time / FLAGS.num_batches, legacy_bytes / 2 ** 20 / FLAGS.num_batches))
+    print("Fancy index:  %7.1f ms / batch, feeds %6.1f MB / batch" % (
+        1000 * vectorized_time / FLAGS.num_batches, vectorized_bytes / 2 ** 20 / FLAGS.num_batches))
+    print("In-graph:                      feeds %6.1f MB / batch (ids only)" % (
+        ids_bytes / 2 ** 20 / FLAGS.num_batches))
+    print("Speedup:      %.1fx" % (legacy_time / vectorized_time))
+
+
+main()
@@ -0,0 +1,89 @@
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from biomedical_qa.models.embedder import share_embeddings, clear_shared_embeddings
+
+tf.app.flags.DEFINE_integer('num_models', 5, 'Number of ensemble members, as folds of a cross-validation.')
+tf.app.flags.DEFINE_integer('vocab_size', 200000, 'Number of words of the embedding matrix.')
+tf.app.flags.DEFINE_integer('embedding_size', 400, 'Size of the word embeddings, e.g. 300 GloVe + 100 PubMed.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def get_matrices(configs):
+
+    return [c["transfer_model"]["embedders"][0]["embeddings"] for c in configs]
+
+
+def load_configs(paths, share, cache_dir=None):
+
+    clear_shared_embeddings()
+    configs = []
+    for path in paths:
+        with open(path, "rb") as f:
+            config = pickle.load(f)
+        if share:
+            share_embeddings(config, cache_dir)
+        configs.append(config)
+    return configs
+
+
+def report(name, configs, seconds):
+
+    matrices = {id(m): m for m in get_matrices(configs)}.values()
+    in_memory = sum(m.nbytes for m in matrices if not isinstance(m, np.memmap))
+    mapped = sum(m.nbytes for m in matrices if isinstance(m, np.memmap))
+    print("%-14s %8d  %12.1f  %10.1f  %6.1f" % (name, len(matrices), in_memory / 2 ** 20,
+                                                 mapped / 2 ** 20, seconds))
+
+
+def main():
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Fold configs with equal inlined matrices, as written by the embedder tools
+        embeddings = np.random.RandomState(1234).randn(FLAGS.vocab_size, FLAGS.embedding_size).astype(np.float32)
+        vocab = {"word_%d" % i: i for i in range(FLAGS.vocab_size)}
+        paths = []
+        for i in range(FLAGS.num_models):
+            config = {"type": "simple_pointer", "transfer_model": {"embedders": [
+                {"type": "constant_word", "size": FLAGS.embedding_size, "vocab": vocab,
+                 "unk_id": 2, "name": "Embedder", "embeddings": embeddings}]}}
+            paths.append(os.path.join(tmp_dir, "fold_%d.pickle" % i))
+            with open(paths[-1], "wb") as f:
+                pickle.dump(config, f, protocol=4)
+        del embeddings, config
+
+        print("%d models, %d x %d embeddings" % (FLAGS.num_models, FLAGS.vocab_size, FLAGS.embedding_size))
+        print("loading        matrices  in memory MB  mapped MB  load s")
+
+        start_time = time.time()
+        configs = load_configs(paths, share=False)
+        report("unshared", configs, time.time() - start_time)
+        unshared = get_matrices(configs)
+        del configs
+
+        start_time = time.time()
+        configs = load_configs(paths, share=True)
+        report("shared", configs, time.time() - start_time)
+        assert all(np.array_equal(m, u) for m, u in zip(get_matrices(configs), unshared))
+        del configs
+
+        start_time = time.time()
+        configs = load_configs(paths, share=True, cache_dir=os.path.join(tmp_dir, "embeddings"))
+        report("memory-mapped", configs, time.time() - start_time)
+        assert all(np.array_equal(m, u) for m, u in zip(get_matrices(configs), unshared))
+        del configs
+
+        print("Embeddings are identical.")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+main()
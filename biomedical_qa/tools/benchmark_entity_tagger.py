@@ -0,0 +1,91 @@
+import json
+import time
+
+import tensorflow as tf
+
+from biomedical_qa.data.entity_tagger import DictionaryEntityTagger, MAX_ENTITY_LENGTH
+from biomedical_qa.data.tokenizer import Tokenizer
+from biomedical_qa.data.umls import build_term2types
+
+tf.app.flags.DEFINE_string('bioasq_file', None, 'Path to a BioASQ JSON file, its snippets are tagged.')
+tf.app.flags.DEFINE_boolean('case_sensitive', True, 'Whether terms are matched case sensitively.')
+tf.app.flags.DEFINE_integer('num_snippets', 2000, 'Maximum number of snippets to tag.')
+
+# --terms_file, --types_file and --entity_blacklist_file are defined by entity_tagger
+FLAGS = tf.app.flags.FLAGS
+
+
+def legacy_tag(tagger, term2types, text, tokenizer):
+    """DictionaryEntityTagger.tag as implemented before the term trie: looks up every n-gram in term2types."""
+
+    if not tagger.case_sensitive:
+        text = text.lower()
+    token_offsets = tagger._get_token_offsets(text, tokenizer)
+    tags = [set() for _ in token_offsets]
+    tag_ids = [set() for _ in token_offsets]
+    found_entities = set()
+
+    for entity_length in range(1, MAX_ENTITY_LENGTH):
+        for i in range(len(token_offsets)):
+
+            if i + entity_length > len(token_offsets):
+                continue
+
+            start_offset, _ = token_offsets[i]
+            _, end_offset = token_offsets[i + entity_length - 1]
+            candidate_string = text[start_offset:end_offset]
+
+            if candidate_string.lower() in tagger.blacklist:
+                continue
+
+            if candidate_string in term2types:
+                found_entities.add(candidate_string)
+                for token_index in range(i, i + entity_length):
+                    types = term2types[candidate_string]
+                    type_ids = set([tagger.type2id[type] for type in types])
+                    tags[token_index].update(types)
+                    tag_ids[token_index].update(type_ids)
+
+    return tags, tag_ids, found_entities
+
+
+def main():
+
+    with open(FLAGS.bioasq_file) as f:
+        bioasq_json = json.load(f)
+    snippets = [snippet["text"] for question in bioasq_json["questions"]
+                for snippet in question.get("snippets", [])]
+    snippets = snippets[:FLAGS.num_snippets]
+    num_tokens = sum(len(Tokenizer().span_tokenize(snippet)) for snippet in snippets)
+    print("Tagging %d snippets (%d tokens)" % (len(snippets), num_tokens))
+
+    start_time = time.time()
+    tagger = DictionaryEntityTagger(FLAGS.terms_file, FLAGS.types_file,
+                                    case_sensitive=FLAGS.case_sensitive,
+                                    blacklist_file=FLAGS.entity_blacklist_file)
+    print("Loaded tagger in %.1f s" % (time.time() - start_time))
+
+    # The tagger does not keep the dictionary, the n-gram lookup gets its own copy
+    if tagger.lexicon is not None:
+        term2types = tagger.lexicon.term2types
+    else:
+        term2types, _ = build_term2types(FLAGS.terms_file, FLAGS.types_file, FLAGS.case_sensitive)
+
+    tokenizer = Tokenizer()
+
+    start_time = time.time()
+    legacy_results = [legacy_tag(tagger, term2types, snippet, tokenizer) for snippet in snippets]
+    legacy_time = time.time() - start_time
+
+    start_time = time.time()
+    results = [tagger.tag(snippet, tokenizer) for snippet in snippets]
+    trie_time = time.time() - start_time
+
+    assert results == legacy_results, "Tagger results differ."
+    print("Results are identical.")
+    print("N-gram lookup: %.2f ms / snippet" % (1000 * legacy_time / len(snippets)))
+    print("Term trie:     %.2f ms / snippet" % (1000 * trie_time / len(snippets)))
+    print("Speedup:       %.1fx" % (legacy_time / trie_time))
+
+
+main()
@@ -0,0 +1,141 @@
+import os
+import pickle
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from biomedical_qa.models import model_from_config
+from biomedical_qa.models.qa_model import NUM_ENTITY_TAGS
+from biomedical_qa.sampling.bioasq import BioAsqSampler
+from biomedical_qa.sampling.squad import SQuADSampler
+
+tf.app.flags.DEFINE_string('eval_data', None, 'Path to the SQuAD (or BioASQ) JSON file.')
+tf.app.flags.DEFINE_string('model_config', None, 'Path to the model config.')
+tf.app.flags.DEFINE_boolean("is_bioasq", False, "Whether the provided dataset is a BioASQ json.")
+tf.app.flags.DEFINE_boolean('split_contexts', False, 'Whether to split contexts on newline.')
+tf.app.flags.DEFINE_integer("batch_size", 32, "Number of examples in each batch.")
+tf.app.flags.DEFINE_integer("num_batches", 50, "Number of batches to benchmark.")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def legacy_get_feed_dict(model, qa_settings):
+    """List based feed dict construction, as done before the vectorized version."""
+
+    def build_tags_array(tags):
+        result = [[False for _ in range(NUM_ENTITY_TAGS)] for _ in tags]
+        for token, token_tags in enumerate(tags):
+            for tag in token_tags:
+                result[token][tag] = True
+        return result
+
+    question, question_length, context, context_length = [], [], [], []
+    is_q_word, is_factoid, is_list, is_yesno = [], [], [], []
+    question_tags, context_tags, context_partition = [], [], []
+
+    max_q_length = max([len(s.question) for s in qa_settings])
+    max_c_length = max([len(c) for s in qa_settings for c in s.contexts])
+    for i, qa_setting in enumerate(qa_settings):
+        question.append(list(qa_setting.question) + [0] * (max_q_length - len(qa_setting.question)))
+        question_tags.append(build_tags_array(qa_setting.question_tags)
+                             + [[0] * NUM_ENTITY_TAGS] * (max_q_length - len(qa_setting.question)))
+        question_length.append(len(qa_setting.question))
+
+        is_factoid.append(qa_setting.q_type == "factoid")
+        is_list.append(qa_setting.q_type == "list")
+        is_yesno.append(qa_setting.q_type == "yesno")
+
+        for c, tags in zip(qa_setting.contexts, qa_setting.contexts_tags):
+            context.append(list(c) + [0] * (max_c_length - len(c)))
+            context_tags.append(build_tags_array(tags)
+                                + [[0] * NUM_ENTITY_TAGS] * (max_c_length - len(c)))
+            is_q_word.append([1.0 if w in qa_setting.question else 0.0 for w in context[-1]])
+            context_length.append(len(c))
+            context_partition.append(i)
+
+    feed_dict = dict()
+    feed_dict[model.context_partition] = context_partition
+    feed_dict[model._is_list] = is_list
+    feed_dict[model._is_factoid] = is_factoid
+    feed_dict[model._is_yesno] = is_yesno
+    feed_dict[model._question_tags] = question_tags
+    feed_dict[model._context_tags] = context_tags
+    feed_dict.update(model.embedder.get_feed_dict(context, context_length))
+    feed_dict.update(model.question_embedder.get_feed_dict(question, question_length))
+    feed_dict[model._word_in_question] = is_q_word
+
+    return feed_dict
+
+
+def densify_tags(tag_bytes):
+
+    return np.unpackbits(tag_bytes, axis=-1, bitorder="little")[:, :, :NUM_ENTITY_TAGS].astype(bool)
+
+
+def assert_same_feed(model, legacy_feed, feed):
+
+    # Tags are fed packed, compare their dense equivalents
+    feed = dict(feed)
+    for dense_tags, tag_bytes in [(model._question_tags, model._question_tag_bytes),
+                                  (model._context_tags, model._context_tag_bytes)]:
+        feed[dense_tags] = densify_tags(feed.pop(tag_bytes))
+
+    assert set(legacy_feed.keys()) == set(feed.keys())
+    for placeholder, legacy_value in legacy_feed.items():
+        legacy_value = np.asarray(legacy_value)
+        value = np.asarray(feed[placeholder])
+        if placeholder.dtype.is_bool:
+            legacy_value = legacy_value.astype(bool)
+        assert legacy_value.shape == value.shape, placeholder.name
+        assert np.array_equal(legacy_value, value), placeholder.name
+
+
+def main():
+
+    with open(FLAGS.model_config, 'rb') as f:
+        model_config = pickle.load(f)
+    model = model_from_config(model_config, ["/cpu:0"])
+
+    data_dir = os.path.dirname(FLAGS.eval_data)
+    data_filename = os.path.basename(FLAGS.eval_data)
+    sampler_class = BioAsqSampler if FLAGS.is_bioasq else SQuADSampler
+    sampler = sampler_class(data_dir, [data_filename], FLAGS.batch_size,
+                            model.embedder.vocab, shuffle=False,
+                            split_contexts_on_newline=FLAGS.split_contexts)
+
+    batches = []
+    for batch in sampler.get_all_batches():
+        batches.append(batch)
+        if len(batches) >= FLAGS.num_batches:
+            break
+
+    legacy_time = 0.0
+    vectorized_time = 0.0
+    legacy_tag_bytes = 0
+    tag_bytes = 0
+    for batch in batches:
+        start_time = time.time()
+        legacy_feed = legacy_get_feed_dict(model, batch)
+        legacy_time += time.time() - start_time
+
+        start_time = time.time()
+        feed = model.get_feed_dict(batch)
+        vectorized_time += time.time() - start_time
+
+        assert_same_feed(model, legacy_feed, feed)
+
+        legacy_tag_bytes += sum(np.asarray(legacy_feed[t]).nbytes
+                                for t in [model._question_tags, model._context_tags])
+        tag_bytes += sum(feed[t].nbytes
+                         for t in [model._question_tag_bytes, model._context_tag_bytes])
+
+    print("Feeds are identical for %d batches." % len(batches))
+    print("Legacy:     %.2f ms / batch" % (1000 * legacy_time / len(batches)))
+    print("Vectorized: %.2f ms / batch" % (1000 * vectorized_time / len(batches)))
+    print("Speedup:    %.1fx" % (legacy_time / vectorized_time))
+    print("Tag features: %.1f KB / batch (dense) vs. %.1f KB / batch (packed)" % (
+        legacy_tag_bytes / 1024 / len(batches), tag_bytes / 1024 / len(batches)))
+
+
+main()
@@ -0,0 +1,130 @@
+import json
+import os
+import tracemalloc
+from array import array
+
+import tensorflow as tf
+
+from biomedical_qa.data.bioasq_squad_builder import BioAsqSquadBuilder
+from biomedical_qa.data.tokenizer import TOKEN_PATTERN
+from biomedical_qa.models import QASetting, pack_tags
+from biomedical_qa.sampling.squad import SQuADSampler
+
+tf.app.flags.DEFINE_string('eval_data', None, 'Path to the SQuAD (or BioASQ) JSON file, e.g. SQuAD train.')
+tf.app.flags.DEFINE_boolean("is_bioasq", False, "Whether the provided dataset is a BioASQ json.")
+tf.app.flags.DEFINE_boolean('split_contexts', False, 'Whether to split contexts on newline.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+class LegacyQASetting:
+    """QASetting as stored before: lists of ids, a set per token and direct JSON references."""
+
+    def __init__(self, question, answers, contexts, answers_spans, id, q_type, is_yes,
+                 paragraph_json, question_json, question_tags, contexts_tags):
+        self.question = question
+        self.answers = answers
+        self.contexts = contexts
+        self.answers_spans = answers_spans
+        self.answer_candidates = None
+        self.answer_candidate_spans = None
+        self.id = id
+        self.q_type = q_type
+        self.is_yes = is_yes
+        self.paragraph_json = paragraph_json
+        self.question_json = question_json
+        self.question_tags = question_tags
+        self.contexts_tags = contexts_tags
+
+
+def build_vocab(paragraphs):
+
+    vocab = {"<UNK>": 0, "<S>": 1, "</S>": 2}
+    for paragraph in paragraphs:
+        texts = [paragraph["context"]] + [qa["question"] for qa in paragraph["qas"]]
+        for text in texts:
+            for token in TOKEN_PATTERN.findall(text.lower()):
+                vocab.setdefault(token, len(vocab))
+    return vocab
+
+
+def copy_settings(qas, vocab, compact):
+    """Copies qas into the legacy or compact representation, sharing contexts per paragraph as the sampler does."""
+
+    # Ids of the legacy representation reference the vocab's int objects
+    ids = {i: i for i in vocab.values()}
+    paragraph_contexts = {}
+    result = []
+
+    for qa in qas:
+        paragraph_key = id(qa.paragraph_json)
+        if paragraph_key not in paragraph_contexts:
+            if compact:
+                paragraph_contexts[paragraph_key] = (
+                    [array('i', c) for c in qa.contexts],
+                    [array('Q', bits) for bits in qa.contexts_tag_bits])
+            else:
+                paragraph_contexts[paragraph_key] = (
+                    [[ids[i] for i in c] for c in qa.contexts],
+                    qa.contexts_tags)
+        contexts, contexts_tags = paragraph_contexts[paragraph_key]
+
+        answers = [[[ids[i] for i in answer] for answer in group] for group in qa.answers]
+        answers_spans = [list(group) for group in qa.answers_spans]
+
+        if compact:
+            result.append(QASetting(array('i', qa.question), answers, contexts, answers_spans,
+                                    id=qa.id, q_type=qa.q_type, is_yes=qa.is_yes,
+                                    json_source=qa.json_source,
+                                    paragraph_index=qa.paragraph_index,
+                                    qa_index=qa.qa_index,
+                                    question_tags=pack_tags(qa.question_tags),
+                                    contexts_tags=contexts_tags))
+        else:
+            result.append(LegacyQASetting([ids[i] for i in qa.question], answers, contexts,
+                                          answers_spans, qa.id, qa.q_type, qa.is_yes,
+                                          qa.paragraph_json, qa.question_json,
+                                          qa.question_tags, contexts_tags))
+
+    return result
+
+
+def measure(qas, vocab, compact):
+
+    tracemalloc.start()
+    settings = copy_settings(qas, vocab, compact)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return size, len(settings)
+
+
+def main():
+
+    data_dir = os.path.dirname(FLAGS.eval_data)
+    data_filename = os.path.basename(FLAGS.eval_data)
+
+    with open(FLAGS.eval_data) as f:
+        dataset_json = json.load(f)
+    if FLAGS.is_bioasq:
+        dataset_json = BioAsqSquadBuilder(dataset_json).build().get_result_object()
+
+    vocab = build_vocab([p for article in dataset_json["data"] for p in article["paragraphs"]])
+    sampler = SQuADSampler(data_dir, [data_filename], 32, vocab, dataset_json=dataset_json,
+                           shuffle=False, split_contexts_on_newline=FLAGS.split_contexts)
+
+    qas = sampler.get_questions()
+    paragraph_contexts = {id(qa.paragraph_json): qa.contexts for qa in qas}
+    num_tokens = sum(len(qa.question) for qa in qas) + \
+                 sum(len(c) for contexts in paragraph_contexts.values() for c in contexts)
+
+    legacy_size, num_questions = measure(qas, vocab, compact=False)
+    compact_size, _ = measure(qas, vocab, compact=True)
+
+    print("%d questions, %d tokens" % (num_questions, num_tokens))
+    print("Legacy:  %.1f MB (%.1f bytes / token)" % (legacy_size / 2**20, legacy_size / num_tokens))
+    print("Compact: %.1f MB (%.1f bytes / token)" % (compact_size / 2**20, compact_size / num_tokens))
+    print("Reduction: %.1fx" % (legacy_size / compact_size))
+
+
+main()
@@ -0,0 +1,96 @@
+import json
+import random
+import time
+
+import tensorflow as tf
+
+from biomedical_qa.data.entity_tagger import ApiEntityTagger, MAX_ENTITY_LENGTH
+from biomedical_qa.data.tokenizer import Tokenizer
+
+tf.app.flags.DEFINE_string('bioasq_file', None, 'Path to a BioASQ JSON file, its snippets are joined to long contexts.')
+tf.app.flags.DEFINE_integer('num_contexts', 50, 'Number of contexts.')
+tf.app.flags.DEFINE_integer('context_tokens', 2000, 'Minimum number of tokens per context.')
+tf.app.flags.DEFINE_float('entities_per_token', 0.5, 'Number of returned entities per token, as for dense cTAKES responses.')
+tf.app.flags.DEFINE_float('misaligned_rate', 0.1, 'Fraction of entities that are not aligned with tokens.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def legacy_find_token_range(offsets, entity_start, entity_end):
+    """ApiEntityTagger._find_token_range as implemented before the offset index: scans the tokens."""
+
+    for start_index in range(len(offsets)):
+
+        start, _ = offsets[start_index]
+
+        if start == entity_start:
+            for end_index in range(start_index, len(offsets)):
+
+                _, end = offsets[end_index]
+                if end == entity_end:
+                    return (start_index, end_index)
+
+    return None
+
+
+def make_entities(offsets, rng):
+    """Random (start, end) char offsets of entities, like an API response."""
+
+    entities = []
+    for _ in range(int(FLAGS.entities_per_token * len(offsets))):
+        start_index = rng.randrange(len(offsets))
+        end_index = min(start_index + rng.randrange(MAX_ENTITY_LENGTH - 1), len(offsets) - 1)
+        start, end = offsets[start_index][0], offsets[end_index][1]
+        if rng.random() < FLAGS.misaligned_rate:
+            start += 1
+        entities.append((start, end))
+    return entities
+
+
+def main():
+
+    with open(FLAGS.bioasq_file) as f:
+        bioasq_json = json.load(f)
+    snippets = [snippet["text"] for question in bioasq_json["questions"]
+                for snippet in question.get("snippets", [])]
+
+    tokenizer = Tokenizer()
+    rng = random.Random(1234)
+    contexts = []
+    snippet_index = 0
+    for _ in range(FLAGS.num_contexts):
+        context_snippets = []
+        num_tokens = 0
+        while num_tokens < FLAGS.context_tokens:
+            snippet = snippets[snippet_index % len(snippets)]
+            snippet_index += 1
+            context_snippets.append(snippet)
+            num_tokens += len(tokenizer.span_tokenize(snippet))
+        context = " ".join(context_snippets)
+        offsets = list(tokenizer.span_tokenize(context))
+        contexts.append((offsets, make_entities(offsets, rng)))
+
+    num_tokens = sum(len(offsets) for offsets, _ in contexts)
+    num_entities = sum(len(entities) for _, entities in contexts)
+    print("Resolving %d entities in %d contexts (%d tokens)" % (num_entities, len(contexts), num_tokens))
+
+    start_time = time.time()
+    legacy_results = [[legacy_find_token_range(offsets, start, end) for start, end in entities]
+                      for offsets, entities in contexts]
+    legacy_time = time.time() - start_time
+
+    start_time = time.time()
+    results = []
+    for offsets, entities in contexts:
+        token_index = ApiEntityTagger._index_token_offsets(offsets)
+        results.append([ApiEntityTagger._find_token_range(token_index, start, end) for start, end in entities])
+    indexed_time = time.time() - start_time
+
+    assert results == legacy_results, "Token ranges differ."
+    print("Results are identical.")
+    print("Token scan:   %.2f ms / context" % (1000 * legacy_time / len(contexts)))
+    print("Offset index: %.2f ms / context" % (1000 * indexed_time / len(contexts)))
+    print("Speedup:      %.1fx" % (legacy_time / indexed_time))
+
+
+main()
@@ -5,7 +5,7 @@ import tensorflow as tf
 
 from biomedical_qa.data.bioasq_squad_builder import BioAsqSquadBuilder
 from biomedical_qa.data.entity_tagger import get_entity_tagger
-from biomedical_qa.inference.inference import Inferrer, get_session, get_model
+from biomedical_qa.inference.inference import Inferrer, get_session, get_model, get_vocab
 from biomedical_qa.sampling.squad import SQuADSampler
 from inference.bioasq import insert_answers
 
@@ -13,10 +13,18 @@ tf.app.flags.DEFINE_string('bioasq_file', None, 'Path to the BioASQ JSON file.')
 tf.app.flags.DEFINE_string('out_file', None, 'Path to the output file.')
 tf.app.flags.DEFINE_string('model_config', None, 'Comma-separated list of paths to the model configs.')
 tf.app.flags.DEFINE_string("devices", "/cpu:0", "Use this device.")
+tf.app.flags.DEFINE_string("embeddings_cache_dir", None, "If set, word embedding matrices are stored in this directory & memory-mapped.")
+tf.app.flags.DEFINE_boolean("in_graph_embeddings", False, "If true, word embeddings are looked up in the graph instead of being fed.")
 
 tf.app.flags.DEFINE_integer("batch_size", 32, "Number of examples in each batch.")
+tf.app.flags.DEFINE_integer("max_batch_tokens", None, "If set, caps the padded context tokens (#contexts * longest context) per batch.")
+tf.app.flags.DEFINE_integer("max_batch_contexts", None, "If set, caps the number of contexts per batch.")
+tf.app.flags.DEFINE_integer("preprocessing_workers", 1, "Number of processes preprocessing the dataset.")
+tf.app.flags.DEFINE_string("preprocessing_cache_dir", None, "Directory to cache preprocessed datasets in, or None.")
+tf.app.flags.DEFINE_integer("bucket_window", 0, "If > 0, batches are built from questions of similar context length within windows of this many batches.")
 
 tf.app.flags.DEFINE_integer("beam_size", 5, "Beam size used for decoding.")
+tf.app.flags.DEFINE_boolean("in_graph_decoding", False, "If true, a single model decodes a batch in one session run.")
 
 tf.app.flags.DEFINE_float("list_answer_prob_threshold", 0.04, "Beam size used for decoding.")
 
@@ -41,18 +49,30 @@ if __name__ == "__main__":
 
     devices = FLAGS.devices.split(",")
 
-    sess = get_session()
-    models = [get_model(sess, config, devices, scope="model_%d" % i)
-              for i, config in enumerate(FLAGS.model_config.split(","))]
-    inferrer = Inferrer(models, sess, FLAGS.beam_size)
+    # Sampler & tagger before the session, so that their workers are forked before TensorFlow starts threads
+    model_configs = FLAGS.model_config.split(",")
+    # Only created on a preprocessing cache miss
+    tagger = get_entity_tagger(lazy=True)
 
     # Build sampler from dataset JSON
     bioasq_json, squad_json = load_dataset(FLAGS.bioasq_file)
-    tagger = get_entity_tagger()
     sampler = SQuADSampler(None, None, FLAGS.batch_size,
-                           inferrer.models[0].embedder.vocab,
+                           get_vocab(model_configs[0]),
                            shuffle=False, dataset_json=squad_json,
-                           tagger=tagger)
+                           tagger=tagger, cache_dir=FLAGS.preprocessing_cache_dir,
+                           bucket_window=FLAGS.bucket_window,
+                           max_batch_tokens=FLAGS.max_batch_tokens,
+                           max_batch_contexts=FLAGS.max_batch_contexts,
+                           num_workers=FLAGS.preprocessing_workers)
+    if tagger is not None:
+        tagger.close()
+
+    sess = get_session()
+    models = [get_model(sess, config, devices, scope="model_%d" % i,
+                        embeddings_cache_dir=FLAGS.embeddings_cache_dir,
+                        in_graph_embeddings=FLAGS.in_graph_embeddings)
+              for i, config in enumerate(model_configs)]
+    inferrer = Inferrer(models, sess, FLAGS.beam_size, FLAGS.in_graph_decoding)
 
     contexts = {p["qas"][0]["id"] : p["context_original_capitalization"]
                 for p in squad_json["data"][0]["paragraphs"]}
@@ -13,8 +13,13 @@ from biomedical_qa.inference.bioasq import insert_answers, clean_bioasq_json
 tf.app.flags.DEFINE_integer('port', 5000, 'Port for the server.')
 tf.app.flags.DEFINE_string('model_config', None, 'Comma-separated list of paths to the model configs.')
 tf.app.flags.DEFINE_string("devices", "/cpu:0", "Use this device.")
+tf.app.flags.DEFINE_string("embeddings_cache_dir", None, "If set, word embedding matrices are stored in this directory & memory-mapped.")
+tf.app.flags.DEFINE_boolean("in_graph_embeddings", False, "If true, word embeddings are looked up in the graph instead of being fed.")
 tf.app.flags.DEFINE_integer("batch_size", 32, "Number of examples in each batch.")
+tf.app.flags.DEFINE_integer("max_batch_tokens", None, "If set, caps the padded context tokens (#contexts * longest context) per batch.")
+tf.app.flags.DEFINE_integer("max_batch_contexts", None, "If set, caps the number of contexts per batch.")
 tf.app.flags.DEFINE_integer("beam_size", 5, "Beam size used for decoding.")
+tf.app.flags.DEFINE_boolean("in_graph_decoding", False, "If true, a single model decodes a batch in one session run.")
 tf.app.flags.DEFINE_float("list_answer_prob_threshold", 0.04, "Beam size used for decoding.")
 tf.app.flags.DEFINE_boolean("preferred_terms", False, "If true, uses preferred terms when available.")
 
@@ -39,7 +44,9 @@ def predict():
     sampler = SQuADSampler(None, None, FLAGS.batch_size,
                            inferrer.models[0].embedder.vocab,
                            shuffle=False, dataset_json=squad_json,
-                           tagger=tagger)
+                           tagger=tagger,
+                           max_batch_tokens=FLAGS.max_batch_tokens,
+                           max_batch_contexts=FLAGS.max_batch_contexts)
     answers = inferrer.get_predictions(sampler)
     bioasq_json = insert_answers(bioasq_json, answers, FLAGS.list_answer_prob_threshold,
                                  FLAGS.preferred_terms, FLAGS.terms_file)
@@ -51,11 +58,14 @@ if __name__ == "__main__":
 
     devices = FLAGS.devices.split(",")
 
+    # Before the session, so that tagger workers are forked before TensorFlow starts threads
+    tagger = get_entity_tagger()
+
     sess = get_session()
-    models = [get_model(sess, config, devices, scope="model_%d" % i)
+    models = [get_model(sess, config, devices, scope="model_%d" % i,
+                        embeddings_cache_dir=FLAGS.embeddings_cache_dir,
+                        in_graph_embeddings=FLAGS.in_graph_embeddings)
               for i, config in enumerate(FLAGS.model_config.split(","))]
-    inferrer = Inferrer(models, sess, FLAGS.beam_size)
-
-    tagger = get_entity_tagger()
+    inferrer = Inferrer(models, sess, FLAGS.beam_size, FLAGS.in_graph_decoding)
 
     app.run(host="0.0.0.0", port=FLAGS.port)
@@ -0,0 +1,29 @@
+import time
+
+import tensorflow as tf
+
+# Defines --terms_file and --types_file
+import biomedical_qa.data.entity_tagger
+from biomedical_qa.data.lexicon import compile_lexicon
+
+tf.app.flags.DEFINE_string('lexicon_dir', None, 'Output directory of the compiled lexicon.')
+tf.app.flags.DEFINE_string('case_variants', 'cased,uncased', 'Comma-separated list of variants to compile: cased (for case sensitive taggers / postprocessors), uncased.')
+tf.app.flags.DEFINE_integer('num_workers', 1, 'Number of processes parsing the UMLS files.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def main():
+
+    variants = FLAGS.case_variants.split(",")
+    assert all(variant in ["cased", "uncased"] for variant in variants), \
+        "Unknown case variant in %s." % FLAGS.case_variants
+
+    start_time = time.time()
+    compile_lexicon(FLAGS.terms_file, FLAGS.types_file, FLAGS.lexicon_dir,
+                    [variant == "cased" for variant in variants], FLAGS.num_workers)
+    print("Compiled lexicon to %s in %.1f s." % (FLAGS.lexicon_dir, time.time() - start_time))
+    print("Pass --terms_file %s to use it." % FLAGS.lexicon_dir)
+
+
+main()
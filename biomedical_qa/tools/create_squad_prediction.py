@@ -56,12 +56,12 @@ with tf.Session(config=config) as sess:
             start = starts[i]
             end = ends[i]
 
-            char_offsets = sampler.char_offsets[qa_setting.id]
+            char_offsets = sampler.char_offsets[qa_setting.id][context_index]
             context = question2real_context[qa_setting.id]
 
-            char_start = char_offsets[(context_index, start)]
-            char_end = char_offsets[(context_index, end + 1)] \
-                       if (context_index, end + 1) in char_offsets \
+            char_start = int(char_offsets[start])
+            char_end = int(char_offsets[end + 1]) \
+                       if end + 1 < len(char_offsets) \
                        else len(context)
 
             answer = context[char_start:char_end]
@@ -2,24 +2,32 @@ import os
 import tensorflow as tf
 from biomedical_qa.data.entity_tagger import get_entity_tagger
 from biomedical_qa.evaluation.bioasq_evaluation import BioAsqEvaluator
-from biomedical_qa.inference.inference import Inferrer, get_model, get_session
+from biomedical_qa.inference.inference import Inferrer, get_model, get_session, get_vocab
 from biomedical_qa.sampling.bioasq import BioAsqSampler
 from biomedical_qa.sampling.squad import SQuADSampler
 from biomedical_qa.training.qa_trainer import ExtractionGoalDefiner
 
 tf.app.flags.DEFINE_string('eval_data', None, 'Path to the SQuAD JSON file.')
 tf.app.flags.DEFINE_boolean('split_contexts', False, 'Whether to split contexts on newline.')
+tf.app.flags.DEFINE_string("preprocessing_cache_dir", None, "Directory to cache preprocessed datasets in, or None.")
+tf.app.flags.DEFINE_integer("bucket_window", 0, "If > 0, batches are built from questions of similar context length within windows of this many batches.")
 tf.app.flags.DEFINE_string('model_config', None, 'Comma-separated list of paths to the model configs.')
 tf.app.flags.DEFINE_string("devices", "/cpu:0", "Use this device.")
+tf.app.flags.DEFINE_string("embeddings_cache_dir", None, "If set, word embedding matrices are stored in this directory & memory-mapped.")
+tf.app.flags.DEFINE_boolean("in_graph_embeddings", False, "If true, word embeddings are looked up in the graph instead of being fed.")
 
 tf.app.flags.DEFINE_boolean("is_bioasq", False, "Whether the provided dataset is a BioASQ json.")
 tf.app.flags.DEFINE_boolean("bioasq_include_synonyms", False, "Whether BioASQ synonyms should be included.")
 tf.app.flags.DEFINE_integer("bioasq_context_token_limit", -1, "Token limit for BioASQ contexts.")
 
 tf.app.flags.DEFINE_integer("batch_size", 32, "Number of examples in each batch.")
+tf.app.flags.DEFINE_integer("max_batch_tokens", None, "If set, caps the padded context tokens (#contexts * longest context) per batch.")
+tf.app.flags.DEFINE_integer("max_batch_contexts", None, "If set, caps the number of contexts per batch.")
+tf.app.flags.DEFINE_integer("preprocessing_workers", 1, "Number of processes preprocessing the dataset.")
 tf.app.flags.DEFINE_integer("subsample", -1, "Number of samples to do the evaluation on.")
 
 tf.app.flags.DEFINE_integer("beam_size", 5, "Beam size used for decoding.")
+tf.app.flags.DEFINE_boolean("in_graph_decoding", False, "If true, a single model decodes a batch in one session run.")
 tf.app.flags.DEFINE_float("list_answer_prob_threshold", 0.5, "Probability threshold to include answers to list questions. Used start output unit is sigmoid.")
 tf.app.flags.DEFINE_integer("list_answer_count", 5, "Number of answers to list questions. Used start output unit is softmax.")
 
@@ -41,43 +49,63 @@ FLAGS = tf.app.flags.FLAGS
 def main():
     devices = FLAGS.devices.split(",")
 
-    sess = get_session()
-    models = [get_model(sess, config, devices, scope="model_%d" % i)
-              for i, config in enumerate(FLAGS.model_config.split(","))]
-    inferrer = Inferrer(models, sess, FLAGS.beam_size)
+    # Samplers & tagger before the session, so that their workers are forked before TensorFlow starts threads
+    model_configs = FLAGS.model_config.split(",")
+    vocab = get_vocab(model_configs[0])
+    # Only created on a preprocessing cache miss
+    tagger = get_entity_tagger(lazy=True)
 
     print("Initializing Sampler & Trainer...")
     data_dir = os.path.dirname(FLAGS.eval_data)
     data_filename = os.path.basename(FLAGS.eval_data)
     instances = FLAGS.subsample if FLAGS.subsample > 0 else None
 
-    tagger = get_entity_tagger()
-
     list_sampler = None
     if not FLAGS.is_bioasq:
-        sampler = SQuADSampler(data_dir, [data_filename], FLAGS.batch_size,
-                               models[0].embedder.vocab,
+        sampler = SQuADSampler(data_dir, [data_filename], FLAGS.batch_size, vocab,
                                instances_per_epoch=instances, shuffle=False,
                                split_contexts_on_newline=FLAGS.split_contexts,
-                               tagger=tagger)
+                               tagger=tagger, cache_dir=FLAGS.preprocessing_cache_dir,
+                               bucket_window=FLAGS.bucket_window,
+                               max_batch_tokens=FLAGS.max_batch_tokens,
+                               max_batch_contexts=FLAGS.max_batch_contexts,
+                               num_workers=FLAGS.preprocessing_workers)
     else:
-        sampler = BioAsqSampler(data_dir, [data_filename], FLAGS.batch_size,
-                                models[0].embedder.vocab,
+        sampler = BioAsqSampler(data_dir, [data_filename], FLAGS.batch_size, vocab,
                                 instances_per_epoch=instances, shuffle=False,
                                 split_contexts_on_newline=FLAGS.split_contexts,
                                 context_token_limit=FLAGS.bioasq_context_token_limit,
                                 include_synonyms=FLAGS.bioasq_include_synonyms,
-                                tagger=tagger, include_answer_spans=False)
+                                tagger=tagger, include_answer_spans=False,
+                                cache_dir=FLAGS.preprocessing_cache_dir,
+                                bucket_window=FLAGS.bucket_window,
+                                max_batch_tokens=FLAGS.max_batch_tokens,
+                                max_batch_contexts=FLAGS.max_batch_contexts,
+                                num_workers=FLAGS.preprocessing_workers)
 
 
-        list_sampler = BioAsqSampler(data_dir, [data_filename], FLAGS.batch_size,
-                                     models[0].embedder.vocab,
+        list_sampler = BioAsqSampler(data_dir, [data_filename], FLAGS.batch_size, vocab,
                                      types=["list"],
                                      instances_per_epoch=instances, shuffle=False,
                                      split_contexts_on_newline=FLAGS.split_contexts,
                                      context_token_limit=FLAGS.bioasq_context_token_limit,
                                      include_synonyms=FLAGS.bioasq_include_synonyms,
-                                     tagger=tagger, include_answer_spans=False)
+                                     tagger=tagger, include_answer_spans=False,
+                                     cache_dir=FLAGS.preprocessing_cache_dir,
+                                     bucket_window=FLAGS.bucket_window,
+                                     max_batch_tokens=FLAGS.max_batch_tokens,
+                                     max_batch_contexts=FLAGS.max_batch_contexts,
+                                     num_workers=FLAGS.preprocessing_workers)
+
+    if tagger is not None:
+        tagger.close()
+
+    sess = get_session()
+    models = [get_model(sess, config, devices, scope="model_%d" % i,
+                        embeddings_cache_dir=FLAGS.embeddings_cache_dir,
+                        in_graph_embeddings=FLAGS.in_graph_embeddings)
+              for i, config in enumerate(model_configs)]
+    inferrer = Inferrer(models, sess, FLAGS.beam_size, FLAGS.in_graph_decoding)
 
     if FLAGS.squad_evaluation:
         print("Running SQuAD Evaluation...")
@@ -110,4 +138,6 @@ def main():
         evaluator = BioAsqEvaluator(list_sampler, inferrer, terms_file)
         evaluator.evaluate(verbosity_level=2 if FLAGS.verbose else 1)
 
+    print("Padding efficiency: %.3f" % sampler.padding_efficiency)
+
 main()
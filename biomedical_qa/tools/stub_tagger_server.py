@@ -0,0 +1,27 @@
+import tensorflow as tf
+
+# Defines --terms_file
+import biomedical_qa.data.entity_tagger
+from biomedical_qa.data.stub_tagger_server import StubTaggerServer, load_term2cuis
+
+tf.app.flags.DEFINE_integer('port', 9876, 'Port to listen on.')
+tf.app.flags.DEFINE_float('latency', 0.0, 'Seconds each response is delayed.')
+tf.app.flags.DEFINE_float('failure_rate', 0.0, 'Fraction of requests that fail with status 503.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def main():
+
+    print("Loading terms...")
+    term2cuis = load_term2cuis(FLAGS.terms_file)
+    server = StubTaggerServer(term2cuis, port=FLAGS.port, latency=FLAGS.latency,
+                              failure_rate=FLAGS.failure_rate)
+    print("Serving %s and %s" % (server.get_url("olelo"), server.get_url("ctakes")))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+main()
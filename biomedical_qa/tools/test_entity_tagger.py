@@ -1,7 +1,7 @@
 import tensorflow as tf
-from nltk.tokenize import RegexpTokenizer
 
 from biomedical_qa.data.entity_tagger import DictionaryEntityTagger, OleloEntityTagger, CtakesEntityTagger
+from biomedical_qa.data.tokenizer import Tokenizer
 
 
 tf.app.flags.DEFINE_string('terms_file', None, 'UML Terms file (MRCONSO.RRF).')
@@ -21,7 +21,7 @@ def main():
     # tagger = DictionaryEntityTagger(FLAGS.terms_file, FLAGS.types_file,
     #                                 case_sensitive=True,
     #                                 blacklist_file=FLAGS.blacklist_file)
-    tokenizer = RegexpTokenizer(r'\w+|[^\w\s]')
+    tokenizer = Tokenizer()
 
     # text = "What are the indications for hydrochlorothiazide?"
     text = "Here, we show that BIBW2992, an anilino-quinazoline designed to irreversibly bind EGFR and HER2, potently suppresses the kinase activity of wild-type and activated EGFR and HER2 mutants, including erlotinib-resistant isoforms"
@@ -0,0 +1,122 @@
+import threading
+import time
+
+
+class FeedPrefetcher(object):
+    """Builds feed dicts for upcoming train steps in background threads.
+
+    Batches are drawn from the sampler in a fixed order (under a lock) and tagged
+    with a sequence number. Feed dicts are built concurrently, but handed out
+    strictly in sequence order, so training sees the same batches in the same order
+    as without prefetching. At most `capacity` batches are in flight at any time.
+    """
+
+
+    def __init__(self, sampler, get_feed_dict, capacity=4, num_threads=1):
+        """
+        :param sampler: Sampler providing get_batch().
+        :param get_feed_dict: Function mapping a batch to its feed dict, usually
+                GoalDefiner.get_feed_dict.
+        :param capacity: Maximum number of batches that are drawn but not yet consumed.
+        :param num_threads: Number of threads building feed dicts.
+        """
+
+        assert capacity >= 1 and num_threads >= 1
+
+        self._sampler = sampler
+        self._get_feed_dict = get_feed_dict
+        self.capacity = capacity
+
+        self._sampler_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._reserved = 0
+        self._drawn = 0
+        self._consumed = 0
+        self._ready = {}
+        self._error = None
+        self._stopped = False
+
+        self.reset_stats()
+
+        self._threads = [threading.Thread(target=self._work, name="feed-prefetcher-%d" % i, daemon=True)
+                         for i in range(num_threads)]
+        for thread in self._threads:
+            thread.start()
+
+
+    def _work(self):
+
+        try:
+            while True:
+                with self._cond:
+                    # Bound the number of batches in flight
+                    while not self._stopped and self._reserved - self._consumed >= self.capacity:
+                        self._cond.wait()
+                    if self._stopped:
+                        return
+                    # Reserve a slot, so the bound holds while the batch is drawn
+                    self._reserved += 1
+
+                start_time = time.time()
+                with self._sampler_lock:
+                    seq = self._drawn
+                    batch = self._sampler.get_batch()
+                    self._drawn += 1
+                feed_dict = self._get_feed_dict(batch)
+                build_time = time.time() - start_time
+
+                with self._cond:
+                    self._ready[seq] = (batch, feed_dict)
+                    self.build_time += build_time
+                    self._cond.notify_all()
+        except BaseException as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+
+
+    def get(self):
+        """
+        Returns the next (batch, feed_dict) pair, blocking until it is ready.
+        :raises: Any exception raised while drawing or building the batch.
+        """
+
+        start_time = time.time()
+        with self._cond:
+            while self._consumed not in self._ready:
+                if self._error is not None:
+                    raise self._error
+                assert not self._stopped, "FeedPrefetcher has been stopped."
+                self._cond.wait()
+            result = self._ready.pop(self._consumed)
+            self._consumed += 1
+            self._cond.notify_all()
+
+        self.wait_time += time.time() - start_time
+        self.num_batches += 1
+        return result
+
+
+    def reset_stats(self):
+
+        self.build_time = 0.0
+        self.wait_time = 0.0
+        self.num_batches = 0
+
+
+    @property
+    def hidden_time(self):
+        """Seconds of feed building that overlapped with training since the last reset."""
+
+        return max(0.0, self.build_time - self.wait_time)
+
+
+    def stop(self):
+        """Stops & joins the worker threads. Batches in flight are discarded."""
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._ready.clear()
@@ -1,6 +1,7 @@
 import os
 import sys
 import functools
+import logging
 import pickle
 import random
 import time
@@ -14,6 +15,7 @@ from biomedical_qa.models.qa_pointer import QAPointerModel
 from biomedical_qa.models.qa_simple_pointer import QASimplePointerModel
 from biomedical_qa.sampling.bioasq import BioAsqSampler
 from biomedical_qa.sampling.squad import SQuADSampler
+from biomedical_qa.sampling.streaming import StreamingSQuADSampler
 from biomedical_qa.training.qa_trainer import ExtractionGoalDefiner, BioAsqGoalDefiner
 from biomedical_qa.training.trainer import Trainer
 from biomedical_qa.training.yesno_trainer import YesNoGoalDefiner
@@ -26,6 +28,9 @@ tf.app.flags.DEFINE_string("trainset_prefix", "train", "Prefix of training files
 tf.app.flags.DEFINE_string("validset_prefix", "valid", "Prefix of validation files.")
 tf.app.flags.DEFINE_string("dataset", "squad", "[wikireading,squad, bioasq2squad].")
 tf.app.flags.DEFINE_string("task", "qa", "qa, multiple_choice, question_generation")
+tf.app.flags.DEFINE_string("preprocessing_cache_dir", None, "Directory to cache preprocessed datasets in, or None.")
+tf.app.flags.DEFINE_integer("streaming_shuffle_buffer", 0, "If > 0, training SQuAD files are streamed instead of loaded into memory, shuffling questions within a buffer of this size. Validation files are loaded into memory.")
+tf.app.flags.DEFINE_integer("bucket_window", 0, "If > 0, batches are built from questions of similar context length within windows of this many batches.")
 
 # BioASQ data loading
 tf.app.flags.DEFINE_boolean("is_bioasq", False, "Whether the provided dataset is a BioASQ json.")
@@ -59,6 +64,11 @@ tf.app.flags.DEFINE_float("learning_rate", 1e-3, "Learning rate.")
 tf.app.flags.DEFINE_float("min_learning_rate", 1e-4, "Minimal learning rate.")
 tf.app.flags.DEFINE_float("learning_rate_decay", 0.5, "Learning rate decay when loss on validation set does not improve.")
 tf.app.flags.DEFINE_integer("batch_size",128, "Number of examples in each batch for training.")
+tf.app.flags.DEFINE_integer("max_batch_tokens", None, "If set, caps the padded context tokens (#contexts * longest context) per batch.")
+tf.app.flags.DEFINE_integer("max_batch_contexts", None, "If set, caps the number of contexts per batch.")
+tf.app.flags.DEFINE_integer("preprocessing_workers", 1, "Number of processes preprocessing the dataset.")
+tf.app.flags.DEFINE_integer("prefetch_batches", 0, "If > 0, feed dicts of up to this many upcoming batches are built in background threads.")
+tf.app.flags.DEFINE_integer("prefetch_threads", 1, "Number of feed building threads per goal when prefetching.")
 tf.app.flags.DEFINE_string("devices", "/cpu:0", "Use this device.")
 tf.app.flags.DEFINE_integer("max_iterations", -1, "Maximum number of batches during training. -1 means until convergence")
 tf.app.flags.DEFINE_integer("ckpt_its", 1000, "Number of iterations until running checkpoint. Negative means after every epoch.")
@@ -88,11 +98,14 @@ random.seed(FLAGS.random_seed)
 tf.set_random_seed(FLAGS.random_seed)
 train_dir = FLAGS.save_dir
 
+if FLAGS.streaming_shuffle_buffer > 0 and FLAGS.is_bioasq:
+    raise ValueError("BioASQ datasets cannot be streamed, unset --streaming_shuffle_buffer or --is_bioasq.")
+
 config = tf.ConfigProto(allow_soft_placement=True)
 config.gpu_options.allow_growth = True
 
 
-def make_sampler(dir, filenames, vocab, types, tagger):
+def make_sampler(dir, filenames, vocab, types, tagger, streaming=False):
 
     args = {
         "dir": dir,
@@ -103,6 +116,11 @@ def make_sampler(dir, filenames, vocab, types, tagger):
         "split_contexts_on_newline": FLAGS.split_contexts,
         "types": types,
         "tagger": tagger,
+        "cache_dir": FLAGS.preprocessing_cache_dir,
+        "bucket_window": FLAGS.bucket_window,
+        "max_batch_tokens": FLAGS.max_batch_tokens,
+        "max_batch_contexts": FLAGS.max_batch_contexts,
+        "num_workers": FLAGS.preprocessing_workers,
     }
 
     if FLAGS.is_bioasq:
@@ -111,99 +129,116 @@ def make_sampler(dir, filenames, vocab, types, tagger):
             "include_synonyms": FLAGS.bioasq_include_synonyms,
         })
         return BioAsqSampler(**args)
+    elif streaming:
+        # Streamed questions are neither cached, bucketed nor preprocessed in parallel
+        for arg in ["cache_dir", "bucket_window", "num_workers"]:
+            del args[arg]
+        return StreamingSQuADSampler(shuffle_buffer_size=FLAGS.streaming_shuffle_buffer, **args)
     else:
         return SQuADSampler(**args)
 
 
-
-with tf.Session(config=config) as sess:
-    devices = FLAGS.devices.split(",")
-    train_variable_prefixes = FLAGS.train_variable_prefixes.split(",") \
-                              if FLAGS.train_variable_prefixes else []
-
-    if FLAGS.model_config is not None:
-
-        with open(FLAGS.model_config, 'rb') as f:
-            model_config = pickle.load(f)
-        model = model_from_config(model_config, devices, FLAGS.dropout)
-
+# Created on a preprocessing cache miss, which happens before the session starts TensorFlow's
+# threads, so that tagger workers are forked safely
+tagger = get_entity_tagger(lazy=True)
+
+devices = FLAGS.devices.split(",")
+train_variable_prefixes = FLAGS.train_variable_prefixes.split(",") \
+                          if FLAGS.train_variable_prefixes else []
+
+if FLAGS.model_config is not None:
+
+    with open(FLAGS.model_config, 'rb') as f:
+        model_config = pickle.load(f)
+    model = model_from_config(model_config, devices, FLAGS.dropout)
+
+else:
+    print("Creating transfer model from config %s" % FLAGS.transfer_model_config)
+    with open(FLAGS.transfer_model_config, 'rb') as f:
+        transfer_model_config = pickle.load(f)
+    transfer_model = model_from_config(transfer_model_config, devices[0:1])
+    original_transfer_model = transfer_model
+
+    if FLAGS.with_chars:
+        print("Use additional char-based word-embedder")
+        char_embedder = CharWordEmbedder(FLAGS.size, transfer_model.vocab, devices[0])
+        FLAGS.embedder_lr = FLAGS.learning_rate
+        transfer_model = ConcatEmbedder([transfer_model, char_embedder])
+
+    print("Creating model of type %s..." % FLAGS.model_type)
+    if FLAGS.model_type == "pointer":
+        model = QAPointerModel(FLAGS.size, transfer_model, devices=devices,
+                               keep_prob=1.0-FLAGS.dropout, composition=FLAGS.composition,
+                               answer_layer_depth=FLAGS.answer_layer_depth,
+                               answer_layer_poolsize=FLAGS.answer_layer_poolsize,
+                               answer_layer_type=FLAGS.answer_layer_type,
+                               start_output_unit=FLAGS.start_output_unit)
+    elif FLAGS.model_type == "simple_pointer":
+        with_inter_fusion = FLAGS.with_fusion
+        num_intrafusion_layers = 1 if FLAGS.with_fusion else 0
+        model = QASimplePointerModel(FLAGS.size, transfer_model, devices=devices,
+                                     keep_prob=1.0-FLAGS.dropout, composition=FLAGS.composition,
+                                     num_intrafusion_layers=num_intrafusion_layers,
+                                     with_inter_fusion=with_inter_fusion,
+                                     start_output_unit=FLAGS.start_output_unit,
+                                     with_question_type_features=FLAGS.with_question_type_features,
+                                     with_entity_tag_features=FLAGS.with_entity_tag_features)
+    else:
+        raise ValueError("Unknown model type: %s" % FLAGS.model_type)
+
+if FLAGS.yesno_data is not None:
+    model.add_yesno()
+
+print("Preparing Samplers ...")
+train_samplers = []
+valid_samplers = []
+
+for dir, types in [(FLAGS.data, ["factoid", "list"]), (FLAGS.yesno_data, ["yesno"])]:
+    if dir is not None:
+        train_fns = [fn for fn in os.listdir(dir) if fn.startswith(FLAGS.trainset_prefix)]
+        train_samplers.append(make_sampler(dir, train_fns,
+                                           model.transfer_model.vocab,
+                                           types, tagger,
+                                           streaming=FLAGS.streaming_shuffle_buffer > 0))
+
+        # In memory, the BioASQ goals evaluate all questions of the validation set
+        valid_fns = [fn for fn in os.listdir(dir) if fn.startswith(FLAGS.validset_prefix)]
+        valid_samplers.append(make_sampler(dir, valid_fns,
+                                           model.transfer_model.vocab,
+                                           types, tagger))
+
+streaming = any(isinstance(sampler, StreamingSQuADSampler) for sampler in train_samplers)
+if streaming and (FLAGS.preprocessing_cache_dir is not None or
+                  FLAGS.bucket_window > 0 or FLAGS.preprocessing_workers > 1):
+    logging.warning("Training sets are streamed, --preprocessing_cache_dir, --bucket_window "
+                    "and --preprocessing_workers only apply to the validation sets.")
+
+# Free memory, unless streaming samplers still tag while training
+if tagger is not None and not streaming:
+    tagger.close()
+tagger = None
+
+goal_definers = []
+if FLAGS.data is not None:
+    if FLAGS.is_bioasq or FLAGS.use_bioasq_goals:
+        goal_definers.append(BioAsqGoalDefiner(model, devices[0],
+                                               forgetting_loss_factor=FLAGS.forgetting_loss_factor,
+                                               original_weights_loss_factor=FLAGS.original_weights_loss_factor))
     else:
-        print("Creating transfer model from config %s" % FLAGS.transfer_model_config)
-        with open(FLAGS.transfer_model_config, 'rb') as f:
-            transfer_model_config = pickle.load(f)
-        transfer_model = model_from_config(transfer_model_config, devices[0:1])
-        original_transfer_model = transfer_model
-
-        if FLAGS.with_chars:
-            print("Use additional char-based word-embedder")
-            char_embedder = CharWordEmbedder(FLAGS.size, transfer_model.vocab, devices[0])
-            FLAGS.embedder_lr = FLAGS.learning_rate
-            transfer_model = ConcatEmbedder([transfer_model, char_embedder])
-
-        print("Creating model of type %s..." % FLAGS.model_type)
-        if FLAGS.model_type == "pointer":
-            model = QAPointerModel(FLAGS.size, transfer_model, devices=devices,
-                                   keep_prob=1.0-FLAGS.dropout, composition=FLAGS.composition,
-                                   answer_layer_depth=FLAGS.answer_layer_depth,
-                                   answer_layer_poolsize=FLAGS.answer_layer_poolsize,
-                                   answer_layer_type=FLAGS.answer_layer_type,
-                                   start_output_unit=FLAGS.start_output_unit)
-        elif FLAGS.model_type == "simple_pointer":
-            with_inter_fusion = FLAGS.with_fusion
-            num_intrafusion_layers = 1 if FLAGS.with_fusion else 0
-            model = QASimplePointerModel(FLAGS.size, transfer_model, devices=devices,
-                                         keep_prob=1.0-FLAGS.dropout, composition=FLAGS.composition,
-                                         num_intrafusion_layers=num_intrafusion_layers,
-                                         with_inter_fusion=with_inter_fusion,
-                                         start_output_unit=FLAGS.start_output_unit,
-                                         with_question_type_features=FLAGS.with_question_type_features,
-                                         with_entity_tag_features=FLAGS.with_entity_tag_features)
-        else:
-            raise ValueError("Unknown model type: %s" % FLAGS.model_type)
-
-    if FLAGS.yesno_data is not None:
-        model.add_yesno()
-
-    print("Preparing Samplers ...")
-    train_samplers = []
-    valid_samplers = []
-
-    tagger = get_entity_tagger()
-
-    for dir, types in [(FLAGS.data, ["factoid", "list"]), (FLAGS.yesno_data, ["yesno"])]:
-        if dir is not None:
-            train_fns = [fn for fn in os.listdir(dir) if fn.startswith(FLAGS.trainset_prefix)]
-            train_samplers.append(make_sampler(dir, train_fns,
-                                               model.transfer_model.vocab,
-                                               types, tagger))
-
-            valid_fns = [fn for fn in os.listdir(dir) if fn.startswith(FLAGS.validset_prefix)]
-            valid_samplers.append(make_sampler(dir, valid_fns,
-                                               model.transfer_model.vocab,
-                                               types, tagger))
-
-    # Free memory
-    tagger = None
-
-    goal_definers = []
-    if FLAGS.data is not None:
-        if FLAGS.is_bioasq or FLAGS.use_bioasq_goals:
-            goal_definers.append(BioAsqGoalDefiner(model, devices[0],
+        goal_definers.append(ExtractionGoalDefiner(model, devices[0],
                                                    forgetting_loss_factor=FLAGS.forgetting_loss_factor,
                                                    original_weights_loss_factor=FLAGS.original_weights_loss_factor))
-        else:
-            goal_definers.append(ExtractionGoalDefiner(model, devices[0],
-                                                       forgetting_loss_factor=FLAGS.forgetting_loss_factor,
-                                                       original_weights_loss_factor=FLAGS.original_weights_loss_factor))
 
-    if FLAGS.yesno_data is not None:
-        goal_definers.append(YesNoGoalDefiner(model, devices[0]))
+if FLAGS.yesno_data is not None:
+    goal_definers.append(YesNoGoalDefiner(model, devices[0]))
 
-    trainer = Trainer(model, FLAGS.learning_rate, goal_definers, devices[0],
-                      train_variable_prefixes)
+trainer = Trainer(model, FLAGS.learning_rate, goal_definers, devices[0],
+                  train_variable_prefixes)
 
-    print("Created %s!" % type(model).__name__)
+print("Created %s!" % type(model).__name__)
 
+# After the samplers, so that preprocessing & tagger workers are forked before TensorFlow starts threads
+with tf.Session(config=config) as sess:
     print("Setting up summary writer...")
     train_summary_writer = tf.summary.FileWriter(FLAGS.save_dir + '/train',
                                                   sess.graph)
@@ -285,6 +320,11 @@ with tf.Session(config=config) as sess:
     epochs = 0
     validate(0, trainer)
 
+    if FLAGS.prefetch_batches > 0:
+        trainer.start_prefetching(train_samplers, capacity=FLAGS.prefetch_batches,
+                                  num_threads=FLAGS.prefetch_threads)
+    trainer.reset_step_stats()
+
     while True:
         i += 1
         start_time = time.time()
@@ -311,7 +351,17 @@ with tf.Session(config=config) as sess:
             print("global step %d learning rate %.5f, step-time %.3f, loss %.4f" % (global_step,
                                                                                     trainer.learning_rate.eval(),
                                                                                     step_time, loss))
+            step_stats = trainer.get_step_stats()
+            print("input-time %.3f, run-time %.3f" % (step_stats["input_time"] / FLAGS.ckpt_its,
+                                                      step_stats["run_time"] / FLAGS.ckpt_its))
+            if "hidden_time" in step_stats:
+                print("prefetching hid %.1fs of %.1fs feed building" % (step_stats["hidden_time"],
+                                                                        step_stats["build_time"]))
+            trainer.reset_step_stats()
             step_time, loss = 0.0, 0.0
+            for train_sampler in train_samplers:
+                print("padding efficiency %.3f" % train_sampler.padding_efficiency)
+                train_sampler.reset_padding_stats()
             result = validate(global_step, trainer)
             if result < ckpt_result and epochs >= FLAGS.max_epochs:
                 print("Stop learning!")
@@ -319,6 +369,8 @@ with tf.Session(config=config) as sess:
             else:
                 ckpt_result = result
 
+    trainer.stop_prefetching()
+
     best_valid_performance = max(previous_performances) if previous_performances else 0.0
     print("Restore model to best performance on validation: %.3f" % best_valid_performance)
     trainer.all_saver.restore(sess, best_path)
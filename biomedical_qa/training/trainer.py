@@ -1,5 +1,9 @@
+import time
+
 import tensorflow as tf
 
+from biomedical_qa.training.prefetch import FeedPrefetcher
+
 class GoalDefiner:
     """Provides loss and eval method."""
 
@@ -49,6 +53,9 @@ class Trainer(object):
         if train_variable_prefixes is None:
             self._train_variable_prefixes = []
 
+        self._prefetchers = None
+        self.reset_step_stats()
+
         with tf.device(device):
             with tf.variable_scope("train/%s" % model.name):
                 self.learning_rate = tf.get_variable("lr", initializer=float(learning_rate), trainable=False)
@@ -90,19 +97,59 @@ class Trainer(object):
             goal_definer.initialize(sess, train_sampler, valid_sampler)
 
 
+    def start_prefetching(self, samplers, capacity=4, num_threads=1):
+        """
+        Builds the feed dicts of upcoming train steps in background threads, so that
+        run_train_steps() does not wait for batch sampling & feed construction.
+        Must be called after initialize(), as goal definers may depend on it.
+        :param samplers: Train samplers, one for each goal definer. From now on
+                they must only be used through run_train_steps().
+        :param capacity: Maximum number of prefetched batches per goal definer.
+        :param num_threads: Number of feed building threads per goal definer.
+        """
+
+        assert self._prefetchers is None, "Prefetching has already been started."
+        self._prefetchers = [FeedPrefetcher(sampler, goal_definer.get_feed_dict,
+                                            capacity=capacity, num_threads=num_threads)
+                             for goal_definer, sampler in zip(self.goal_definers, samplers)]
+
+
+    def stop_prefetching(self):
+
+        if self._prefetchers is not None:
+            for prefetcher in self._prefetchers:
+                prefetcher.stop()
+            self._prefetchers = None
+
+
+    def _next_feed_dict(self, index, goal_definer, train_sampler):
+
+        if self._prefetchers is not None:
+            _, feed_dict = self._prefetchers[index].get()
+            return feed_dict
+
+        batch = train_sampler.get_batch()
+        return goal_definer.get_feed_dict(batch)
+
+
     def run_train_steps(self, sess, samplers, with_summaries):
         """Runs a train step for each goal definer."""
 
         loss = 0.0
         summaries = []
 
-        for goal_definer, train_sampler in zip(self.goal_definers, samplers):
-            batch = train_sampler.get_batch()
+        for index, (goal_definer, train_sampler) in enumerate(zip(self.goal_definers, samplers)):
+            start_time = time.time()
+            feed_dict = self._next_feed_dict(index, goal_definer, train_sampler)
+            self.input_time += time.time() - start_time
+
             goals = [self._updates[goal_definer], goal_definer.loss]
             if with_summaries:
                 goals += [goal_definer.train_summaries]
 
-            results = sess.run(goals, goal_definer.get_feed_dict(batch))
+            start_time = time.time()
+            results = sess.run(goals, feed_dict)
+            self.run_time += time.time() - start_time
 
             loss += results[1]
             if with_summaries:
@@ -111,6 +158,35 @@ class Trainer(object):
         return loss, summaries
 
 
+    def reset_step_stats(self):
+
+        self.input_time = 0.0
+        self.run_time = 0.0
+        if self._prefetchers is not None:
+            for prefetcher in self._prefetchers:
+                prefetcher.reset_stats()
+
+
+    def get_step_stats(self):
+        """
+        Returns time spent in run_train_steps() since the last reset_step_stats().
+        :return: dict with the time spent waiting for input ("input_time"), in
+                sess.run ("run_time") and, when prefetching, the time spent building
+                feeds in the background ("build_time") and the part of it that was
+                hidden behind training ("hidden_time").
+        """
+
+        stats = {
+            "input_time": self.input_time,
+            "run_time": self.run_time,
+        }
+        if self._prefetchers is not None:
+            stats["build_time"] = sum(p.build_time for p in self._prefetchers)
+            stats["hidden_time"] = sum(p.hidden_time for p in self._prefetchers)
+
+        return stats
+
+
     def eval(self, sess, samplers, subsample=-1, after_batch_hook=None, verbose=False):
 
         performances, summaries = zip(*[goal_definer.eval(sess, sampler,